@@ -13,7 +13,8 @@ WATCH_INTERVAL = 60 * 5
 # Only auto-process files that are a maximum of N days old:
 MAX_AUTO_UPDATE_AGE = 3600 * 24 * 3
 
-# Only auto-process files that have been unchanged for this many minutes:
+# Files that have been unchanged for this long are processed completely (more recently modified
+# files are processed incrementally):
 MIN_AUTO_UPDATE_AGE = 3600 * 0.5
 
 # Enforce a minimal file-size, in order to not clutter the data space with 
@@ -46,14 +47,19 @@ def checkFiles(s):
     # Process newest files first
     files.sort(key=lambda x: -os.path.getmtime(x))
     
-    # Keep only files within the minimum-maximum age range
-    files = [x for x in files if fileAge(x) > MIN_AUTO_UPDATE_AGE and \
-        fileAge(x) < MAX_AUTO_UPDATE_AGE and fileSize(x) > MIN_RAW_DATA_SIZE]
+    # Files that are still being recorded are processed incrementally (i.e. only the frames that 
+    # have been added since the last check), the others are processed completely
+    files = [x for x in files if fileAge(x) < MAX_AUTO_UPDATE_AGE and fileSize(x) > MIN_RAW_DATA_SIZE]
+    activeFiles = [x for x in files if fileAge(x) <= MIN_AUTO_UPDATE_AGE]
+    staleFiles  = [x for x in files if fileAge(x) > MIN_AUTO_UPDATE_AGE]
     
     # Process?
-    if len(files) > 0:
+    for files, incremental in [(activeFiles, True), (staleFiles, False)]:
+        if len(files) == 0:
+            continue
+        
         # Create a settings object
-        settings = util.ExtractionSettings(files, False)
+        settings = util.ExtractionSettings(files, False, incremental)
         
         # Re-import any python libraries, in case this script is run over long durations, 
         # and any post-processing code changes
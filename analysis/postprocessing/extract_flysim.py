@@ -17,16 +17,9 @@ if __name__ == "__main__":
 # Imports for this script
 # =======================================================================================
 
-import msgpack, multiprocessing, threading, warnings
-import multiprocessing.pool
+import msgpack, multiprocessing, threading, warnings, collections, hashlib
 import numpy as np
-import numpy_groupies as npg
 from time import time
-import statsmodels.api as sm
-from functools import partial
-import pandas as pd
-from time import sleep
-import datetime
 
 from shared import util
 from postprocessing import extract_perching_locations
@@ -41,6 +34,9 @@ SINGLEFILE = ''
 # Set "overwrite" to True to overwrite existing files
 OVERWRITE = False
 
+# Version of the outputs
+VERSION = 1
+
 # Misc. constants
 CORTEX_NAN = 9999999
 
@@ -62,343 +58,665 @@ numSavedTraj = 0
 NUM_WORKERS_ASYNC = 12
 
 # =======================================================================================
-# Determine whether a trajectory is a FlySim trajectory, then save it
+# Trajectory storage
 # =======================================================================================
 
-def trajectoryBBox(traj):
-    minBound = np.array([ sys.float_info.max for i in range(3)])
-    maxBound = np.array([-sys.float_info.max for i in range(3)])
+#
+# Note: A trajectory stores the frame, position and distance to the nearest Yframe of each of 
+#       its points in arrays that grow as points are added (rather than as a list of tuples 
+#       holding separate arrays). 
+#
+#       The distance to the nearest Yframe is computed when a point is added, so the Yframe 
+#       positions don't have to be kept around. When a trajectory has multiple points in the 
+#       same frame, the distance is computed from the mean position of those points (as is 
+#       done when the trajectory is scored), and stored for each of them.
+#
+#       The bounding box of the points [-600:-1] (used to split stationary trajectories, see 
+#       TrajectoryTracker) is maintained incrementally, with a monotonic queue for the minimum 
+#       and maximum of each coordinate.
+#
+
+# Number of points used to determine whether a trajectory is stationary
+STATIONARY_WINDOW = 600
+
+class Trajectory:
+    __slots__ = ('id', 'numPoints', 'frames', 'positions', 'yframeDistances', 'lastFrameStart',
+                 'windowMin', 'windowMax', 'windowNumNaN')
+
+    def __init__(self, id, capacity=16):
+        self.id = id
+        self.numPoints = 0
+        self.frames = np.zeros(capacity, dtype=np.int64)
+        self.positions = np.zeros((capacity, 3))
+        self.yframeDistances = np.zeros(capacity)
+        self.lastFrameStart = 0
+        self.windowMin = [collections.deque() for i in range(3)]
+        self.windowMax = [collections.deque() for i in range(3)]
+        self.windowNumNaN = 0
+
+    def __len__(self):
+        return self.numPoints
+
+    def lastFrame(self):
+        return int(self.frames[self.numPoints - 1])
+
+    def head(self):
+        return self.positions[self.numPoints - 1]
+
+    def _grow(self):
+        capacity = 2 * len(self.frames)
+        self.frames = np.resize(self.frames, capacity)
+        self.positions = np.resize(self.positions, (capacity, 3))
+        self.yframeDistances = np.resize(self.yframeDistances, capacity)
+
+    def _enterWindow(self, i):
+        pos = self.positions[i]
+        if np.any(np.isnan(pos)):
+            self.windowNumNaN += 1
+            return
+        for c in range(3):
+            qMin, qMax = self.windowMin[c], self.windowMax[c]
+            while len(qMin) > 0 and self.positions[qMin[-1], c] >= pos[c]:
+                qMin.pop()
+            qMin.append(i)
+            while len(qMax) > 0 and self.positions[qMax[-1], c] <= pos[c]:
+                qMax.pop()
+            qMax.append(i)
+
+    def _leaveWindow(self, i):
+        if np.any(np.isnan(self.positions[i])):
+            self.windowNumNaN -= 1
+            return
+        for q in self.windowMin + self.windowMax:
+            if len(q) > 0 and q[0] == i:
+                q.popleft()
+
+    def append(self, frameID, pos, yframes):
+        n = self.numPoints
+        if n == len(self.frames):
+            self._grow()
+        self.frames[n] = frameID
+        self.positions[n] = pos
+        self.numPoints += 1
+        
+        # The previous point enters the window of the last STATIONARY_WINDOW points (excluding 
+        # the newest point), and the oldest point leaves it
+        if n >= 1:
+            self._enterWindow(n - 1)
+        if n >= STATIONARY_WINDOW:
+            self._leaveWindow(n - STATIONARY_WINDOW)
+        
+        # Distance from the (mean) position in this frame to the nearest Yframe
+        if n == 0 or self.frames[n - 1] != frameID:
+            self.lastFrameStart = n
+            meanPos = self.positions[n]
+        else:
+            meanPos = np.mean(self.positions[self.lastFrameStart:(n+1)], axis=0)
+        dst = np.linalg.norm(yframes - meanPos, axis=1)
+        dst = dst[~np.isnan(dst)]
+        self.yframeDistances[self.lastFrameStart:(n+1)] = np.min(dst) if len(dst) > 0 else np.nan
+
+    # Span of the bounding box of the points [-STATIONARY_WINDOW:-1] (NaN if any of these 
+    # points has a NaN coordinate)
+    def windowBBoxSpan(self):
+        if self.windowNumNaN > 0:
+            return np.nan
+        minBound = np.array([self.positions[q[0], c] for c, q in enumerate(self.windowMin)])
+        maxBound = np.array([self.positions[q[0], c] for c, q in enumerate(self.windowMax)])
+        return np.linalg.norm( maxBound - minBound )
+
+# =======================================================================================
+# Determine whether a trajectory is a FlySim trajectory, then save it
+# =======================================================================================
 
-    for t in traj:
-        minBound = np.minimum(t[2], minBound)
-        maxBound = np.maximum(t[2], maxBound)
+def trajectoryBBox(positions):
+    minBound = np.minimum.reduce(positions, axis=0)
+    maxBound = np.maximum.reduce(positions, axis=0)
 
     bboxSpan = np.linalg.norm( maxBound - minBound )
     
     return minBound, maxBound, bboxSpan
 
-def processTrajectory(trajectory, output, outputTracking, workerID, numTrajectories):
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore", category=RuntimeWarning)
-        
-        # Find the best matching markers in each frame (currently multiple markers are added per frame 
-        # based on proximity
-        bestMarkers = {}
-        for t in trajectory:
-            iframe = t[1]
-            if not iframe in bestMarkers:
-                bestMarkers[iframe] = []
-            bestMarkers[iframe].append(t)
-
-        # Currently, we just average the markers (in the future, e.g. take re-calibration into account,
-        # or compute Confidence Interval in way more sophisticated than just mean)
-        trajectoryNew = []
-        for iframe in sorted(bestMarkers.keys()):
-            meanPos = np.mean([x[2] for x in bestMarkers[iframe]], axis=0)
-            trajectoryNew.append( [
-                bestMarkers[iframe][0][0],
-                bestMarkers[iframe][0][1],
-                meanPos,
-                bestMarkers[iframe][0][3] ])
-        # Replace trajectory with corrected trajectory
-        trajectory = trajectoryNew
+# Average the markers of a trajectory in each frame
+def averageTrajectory(trajectory):
+    # Find the best matching markers in each frame (currently multiple markers are added per frame 
+    # based on proximity. Points are stored in frame order, so the markers of a frame are consecutive)
+    n = len(trajectory)
+    frames = trajectory.frames[:n]
+    frameStarts = np.flatnonzero(np.concatenate([[True], frames[1:] != frames[:-1]]))
+    numMarkers = np.diff(np.append(frameStarts, n))
 
-        # Can this be a flysim trajectory? Required minimum amount of displacement
-        minBound, maxBound, bboxSpan = trajectoryBBox(trajectory)
-        isDistOK = (bboxSpan > TRAJ_SAVE_MINDIST)
+    # Currently, we just average the markers (in the future, e.g. take re-calibration into account,
+    # or compute Confidence Interval in way more sophisticated than just mean)
+    positions = np.add.reduceat(trajectory.positions[:n], frameStarts, axis=0) / numMarkers[:,None]
 
-        # TODO: Check if points accompany Yframe at all times... if so, this is head/wing/etc. marker, not flysim
-        dstFromYframe = np.array([ np.nanmin([np.linalg.norm(t[2]-y) for y in t[3]]) if len(t[3])>0 \
-            else float('NaN') for t in trajectory])
-        dstFromYframeMean = np.nanmean(dstFromYframe, axis=0)
-        dstFromYframeSD   = np.nanstd(dstFromYframe, axis=0)
-        if np.isnan(dstFromYframeMean):
-            dstFromYframeMean = np.inf
-        if np.isnan(dstFromYframeSD):
-            dstFromYframeSD = 0
+    return frames[frameStarts], positions, trajectory.yframeDistances[frameStarts]
 
-        # Check direction of takeoff
-        data = np.array([x[2] for x in trajectory])
-        x    = [a[0] for a in data]
-        y    = [a[1] for a in data]
-        z    = [a[2] for a in data]
-        A    = np.vstack([x, y, np.ones(len(x))]).T
-
-        f = sm.OLS(z, A).fit() 
-        R2 = f.rsquared
-        params = f.params
-
-        isDirOK = ((R2 > 0.5) and np.linalg.norm(params[0:2] - np.array([0, 0.5])) < 2.0)
-    
+#
+# Note: Trajectories are scored in batches. Only trajectories that are long enough, and span 
+#       enough distance, are saved, so the (more expensive) scores are only computed for those. 
+#       The scores of all these trajectories are then computed at once, on the concatenated 
+#       points, with per-trajectory sums computed by np.bincount.
+#
+#       Returns (frames, positions, scores) for each of the trajectories, or None if the 
+#       trajectory should not be saved.
+#
+def scoreTrajectories(trajectories):
+    saved = []
+    savedIdx = []
+    for i, trajectory in enumerate(trajectories):
+        if len(trajectory) <= TRAJ_SAVE_MINLEN:
+            continue
+        frames, positions, dstFromYframe = averageTrajectory(trajectory)
+        
         # Check minimum length
-        isLenOK = (len(trajectory) > TRAJ_SAVE_MINLEN)
+        isLenOK = (len(frames) > TRAJ_SAVE_MINLEN)
+
+        # Can this be a flysim trajectory? Required minimum amount of displacement
+        minBound, maxBound, bboxSpan = trajectoryBBox(positions)
+        isDistOK = (bboxSpan > TRAJ_SAVE_MINDIST)
         
-        # Check minimum Z (Flysim currently never goes below ~200)
-        minz = np.nanmin(np.array(z))
+        if isLenOK and isDistOK:
+            saved.append((frames, positions, dstFromYframe, isLenOK, isDistOK))
+            savedIdx.append(i)
+    
+    results = [None for t in trajectories]
+    if len(saved) == 0:
+        return results
+    
+    with warnings.catch_warnings(), np.errstate(invalid='ignore', divide='ignore'):
+        warnings.simplefilter("ignore", category=RuntimeWarning)
         
-        # Check variance of points in each frame
-        def means(c, x): 
-            x['r'+c] = x[c] - np.repeat(x[c].mean(skipna=True), len(x.index))
-            return x
+        # Concatenate the points of all trajectories (g holds the trajectory index of each point)
+        numPoints = np.array([len(x[0]) for x in saved])
+        g = np.repeat(np.arange(len(saved)), numPoints)
+        starts = np.concatenate([[0], np.cumsum(numPoints)[:-1]])
+        positions = np.concatenate([x[1] for x in saved])
+        dstFromYframe = np.concatenate([x[2] for x in saved])
         
-        df = pd.DataFrame( {'f': [t[1] for t in trajectory], 'x': x, 'y': y, 'z': z} )
-        df = df.groupby('f').apply(partial(means, 'x'))
-        df = df.groupby('f').apply(partial(means, 'y'))
-        df = df.groupby('f').apply(partial(means, 'z'))
+        def _sum(values):
+            return np.bincount(g, weights=values, minlength=len(saved))
         
-        stds = [df['r'+c].std (skipna=True) for c in ['x','y','z']]
-        ptStd = np.nansum(stds)
+        # TODO: Check if points accompany Yframe at all times... if so, this is head/wing/etc. marker, not flysim
+        hasDst = ~np.isnan(dstFromYframe)
+        numDst = _sum(hasDst)
+        dstFromYframeMean = _sum(np.where(hasDst, dstFromYframe, 0)) / numDst
+        dstFromYframeSD = np.sqrt(_sum(np.where(hasDst, (dstFromYframe - dstFromYframeMean[g])**2, 0)) / numDst)
+        dstFromYframeMean[np.isnan(dstFromYframeMean)] = np.inf
+
+        # Check direction of takeoff: fit a plane z = a*x + b*y + c through the (centered) points,
+        # by solving the 2x2 normal equations of each trajectory
+        means = np.array([_sum(positions[:,c]) for c in range(3)]).T / numPoints[:,None]
+        x, y, z = (positions - means[g]).T
+        M = np.zeros((len(saved), 2, 2))
+        M[:,0,0] = _sum(x*x)
+        M[:,0,1] = M[:,1,0] = _sum(x*y)
+        M[:,1,1] = _sum(y*y)
+        b = np.array([_sum(x*z), _sum(y*z)]).T
+        isFinite = np.all(np.isfinite(M.reshape(-1, 4)), axis=1) & np.all(np.isfinite(b), axis=1)
+        M[~isFinite] = 0
+        params = np.einsum('kij,kj->ki', np.linalg.pinv(M), np.where(isFinite[:,None], b, 0))
+        params[~isFinite] = np.nan
+        residuals = z - params[g,0] * x - params[g,1] * y
+        R2 = 1 - _sum(residuals**2) / _sum(z*z)
+        scoreDir = np.linalg.norm(params - np.array([0, 0.5]), axis=1)
+
+        isDirOK = (R2 > 0.5) & (scoreDir < 2.0)
         
-        # Find start and end point of motion (first acceleration)
-        """
-        def _firstMotionFrame(v):
-            curpos
-            return 0
-        motionStartFrame = _firstMotionFrame(trajectory)
-        motionEndFrame   = _firstMotionFrame(reversed(trajectory))
-        """
+        # Check minimum Z (Flysim currently never goes below ~200)
+        minz = np.fmin.reduceat(positions[:,2], starts)
         
+        # Check variance of points in each frame (Note: The points have already been averaged per 
+        # frame, so as before, this is the standard deviation of the residuals w.r.t. the frame 
+        # averages, with one point per frame)
+        frameGroup = np.arange(len(positions))
+        stds = []
+        for c in range(3):
+            v = positions[:,c]
+            hasValue = ~np.isnan(v)
+            frameMean = np.bincount(frameGroup, weights=np.where(hasValue, v, 0)) / \
+                np.bincount(frameGroup, weights=hasValue)
+            r = v - frameMean[frameGroup]
+            n = _sum(hasValue)
+            rMean = _sum(np.where(hasValue, r, 0)) / n
+            stds.append(np.sqrt(_sum(np.where(hasValue, (r - rMean[g])**2, 0)) / (n - 1)))
+            stds[-1][n < 2] = np.nan
+        stds = np.array(stds).T
+        ptStd = np.nansum(stds, axis=1)
+    
+    for i, (frames, positions, _, isLenOK, isDistOK) in enumerate(saved):
         # Enforce: 
         #   o minimum trajectory length of 70 frames, 
         #   o minimum distance traveled
         #   o direction along x dimension
-        is_flysim = isDistOK and isLenOK and ptStd < 5.5 and dstFromYframeMean > 80 and minz >= 200
+        is_flysim = isDistOK and isLenOK and ptStd[i] < 5.5 and dstFromYframeMean[i] > 80 and minz[i] >= 200
+        
+        results[savedIdx[i]] = (frames, positions, [is_flysim, scoreDir[i], R2[i], dstFromYframeMean[i], 
+            dstFromYframeSD[i] if numDst[i] > 0 else 0, isDistOK, isLenOK, isDirOK[i], ptStd[i]] + list(stds[i]))
+    
+    return results
 
-        if isLenOK and isDistOK:
-            # Save trajectory 
-            trajID = numTrajectories + (workerID+1) * 100000
-            fStart = min([t[1] for t in trajectory])
-            fEnd   = max([t[1] for t in trajectory])
-            output.put( ','.join([str(x) for x in [trajID, fStart, fEnd, is_flysim, 
-                np.linalg.norm(params[0:2] - np.array([0, 0.5])), 
-                R2, dstFromYframeMean, dstFromYframeSD, isDistOK, isLenOK, isDirOK, ptStd] + stds]))
-            
-            # Save the flysim trajectory
-            for t in trajectory:
-                outputTracking.put( ','.join([str(x) for x in [trajID, t[1], ] + t[2].tolist() ]))
-            
-            # Increment trajectory ID
-            numTrajectories += 1
+def saveTrajectory(fo, foTracking, trajID, scoredTrajectory):
+    frames, positions, scores = scoredTrajectory
     
-    return numTrajectories
+    # Save trajectory 
+    fo.write( ','.join([str(x) for x in [trajID, frames[0], frames[-1]] + scores]) + '\n' )
+    
+    # Save the flysim trajectory
+    for f, pos in zip(frames, positions):
+        foTracking.write( ','.join([str(x) for x in [trajID, f, ] + pos.tolist() ]) + '\n' )
 
 # =======================================================================================
-# Extract trajectories (async supported)
+# Associate unidentified markers with open trajectories
 # =======================================================================================
 
-# Worker function
-def extractFlysim_Worker(tasks, output, outputTracking):
-        
-    # TODO: Check if this workerID matches the workerID sent by main process! (-1 because process ID's are 1-indexed)
-    workerIDFromProcess = (multiprocessing.process.current_process()._identity[0]-1) if not DEBUG else 0
-    
-    # Working variables
-    openTrajectories = []
-    trajectoryID = 0 
-    done = False
-    numTrajectories = 0
-    
-    while not done:
-        taskList = None
-        try:
-            taskList = tasks[workerIDFromProcess].get()
-        except Exception as e:
-            raise e # Allows setting debugging breakpoint
-        # Are all frames read?
-        if isinstance(taskList, str) and taskList == 'NO_FRAMES_LEFT':
-            # Process the remaining trajectories
-            for t in openTrajectories:
-                numTrajectories = processTrajectory(t, output, outputTracking, workerID, numTrajectories)
-            # Signal that we're done!!
-            output.put('DONE:'+str(workerIDFromProcess))
-            done = True
+#
+# Note: Each unidentified marker is added to the open trajectory whose last point (head) is 
+#       nearest, if that head is closer than TRAJ_MAXDIST. Otherwise, the marker starts a new 
+#       trajectory. Markers are assigned one by one, in the order in which they appear in the 
+#       frame, and ties go to the oldest trajectory. 
+#
+#       Rather than comparing every marker to every open trajectory, trajectory heads are kept 
+#       in a uniform grid with cells of TRAJ_MAXDIST, so only heads in the 27 cells surrounding 
+#       a marker can be close enough. For each frame, the distances between all markers and the 
+#       nearby heads (and between the markers themselves, as heads move to markers of the same
+#       frame while they are being assigned) are computed at once.
+#
+#       Trajectories are kept ordered by the frame in which they were last extended, so timed 
+#       out trajectories are always at the front.
+#
+
+class TrajectoryTracker:
+    def __init__(self):
+        self.trajectories = collections.OrderedDict()
+        self.grid = {}
+        self.cells = {}
+        self.tooLong = set()
+        self.numCreated = 0
+
+    def __len__(self):
+        return len(self.trajectories)
+
+    def _cell(self, pos):
+        if np.any(np.isnan(pos)):
+            return None
+        return tuple(np.floor(pos / TRAJ_MAXDIST).astype(np.int64).tolist())
+
+    def _place(self, seq):
+        cell = self._cell(self.trajectories[seq].head())
+        oldCell = self.cells.get(seq)
+        if cell == oldCell:
+            return
+        if oldCell != None:
+            self.grid[oldCell].discard(seq)
+            if len(self.grid[oldCell]) == 0:
+                del self.grid[oldCell]
+        if cell != None:
+            self.grid.setdefault(cell, set()).add(seq)
+            self.cells[seq] = cell
         else:
-            # Loop through each frame
-            for frame, maxNewTrajFrame, workerID in taskList:
-                # Calculate Yframe mean positions
-                yframes = [np.nanmean(x.vertices, axis=0) for x in frame.yframes]
-            
-                # o Remove "trajectories" that have too many points... (currently > 20 second = 4000 frames).
-                #   These are not flysim trajectories but likely stationary points, and we will loose much 
-                #   time and RAM space by keeping around such trajectories
-                # o Also remove trajectories that are too old (haven't been updated recently)
-                i = 0
-                while i < len(openTrajectories):
-                    
-                    if len( openTrajectories[i] ) > MAX_FLYSIM_DURATION_FRAMES or \
-                        (frame.frameID - openTrajectories[i][-1][1]) > TRAJ_TIMEOUT:
-                        if len( openTrajectories[i] ) <= MAX_FLYSIM_DURATION_FRAMES:
-                            numTrajectories = processTrajectory(openTrajectories[i], \
-                                output, outputTracking, workerIDFromProcess, numTrajectories)    
-                        del openTrajectories[i]
-                        i = 0
-                    else:
-                        i += 1
-                
-                # Are we done with processing?
-                if len(openTrajectories) == 0 and frame.frameID > maxNewTrajFrame:
-                    output.put('DONE:'+str(workerIDFromProcess))
-                    done = True
-            
-                # Loop through unIDed points
-                for pos in frame.unidentifiedVertices:
-                    # Find corresponding trajectory index 
-                    minDist = 1e6
+            self.cells.pop(seq, None)
+
+    def _remove(self, seq):
+        cell = self.cells.pop(seq, None)
+        if cell != None:
+            self.grid[cell].discard(seq)
+            if len(self.grid[cell]) == 0:
+                del self.grid[cell]
+        self.tooLong.discard(seq)
+        return self.trajectories.pop(seq)
+
+    # Remove trajectories that are too long or too old, and return those that should be 
+    # scored, oldest first
+    def expire(self, frameID):
+        # Trajectories that have too many points are not FlySim trajectories, but likely 
+        # stationary points (these are dropped)
+        for seq in list(self.tooLong):
+            self._remove(seq)
+        
+        expired = []
+        for seq, traj in self.trajectories.items():
+            if (frameID - traj.lastFrame()) <= TRAJ_TIMEOUT:
+                break
+            expired.append(seq)
+        return [self._remove(seq) for seq in sorted(expired)]
+
+    # Summary of all open trajectories (two trackers with the same fingerprint will produce the 
+    # same results from here on)
+    def fingerprint(self):
+        h = hashlib.md5()
+        for seq in sorted(self.trajectories.keys()):
+            traj = self.trajectories[seq]
+            h.update(np.int64(traj.numPoints).tobytes())
+            h.update(traj.frames[:traj.numPoints].tobytes())
+            h.update(traj.positions[:traj.numPoints].tobytes())
+        return h.hexdigest()
+
+    # Remove all trajectories, oldest first
+    def flush(self):
+        return [self._remove(seq) for seq in sorted(self.trajectories.keys())]
+
+    # Assign the unidentified markers of a frame, and return the trajectories that have been 
+    # split off because they were stationary for too long
+    def addFrame(self, frameID, vertices, yframes, allowNewTrajectories=True):
+        finished = []
+        vertices = np.asarray(vertices, dtype=np.float64).reshape(-1, 3)
+        yframes = np.asarray(yframes, dtype=np.float64).reshape(-1, 3)
+        n = len(vertices)
+        if n == 0:
+            return finished
+        
+        # Trajectories with a head near any of the markers
+        nearbyCells = set()
+        for pos in vertices:
+            cell = self._cell(pos)
+            if cell != None:
+                for dx in (-1, 0, 1):
+                    for dy in (-1, 0, 1):
+                        for dz in (-1, 0, 1):
+                            nearbyCells.add((cell[0]+dx, cell[1]+dy, cell[2]+dz))
+        candidates = set()
+        for cell in nearbyCells:
+            candidates.update(self.grid.get(cell, ()))
+        
+        # Slots hold the candidate trajectories and the trajectories created in this frame, 
+        # sorted from old to new
+        slots = sorted(candidates)
+        m = len(slots)
+        heads = np.array([self.trajectories[seq].head() for seq in slots], dtype=np.float64).reshape(-1, 3)
+        distToHead = np.full((n, m + n), np.inf)
+        distToHead[:, :m] = np.sqrt(((vertices[:, None, :] - heads[None, :, :])**2).sum(axis=2))
+        distToVertex = np.sqrt(((vertices[:, None, :] - vertices[None, :, :])**2).sum(axis=2))
+        slotHead = np.full(m + n, -1, dtype=np.int64)
+        slotAlive = np.zeros(m + n, dtype=bool)
+        slotAlive[:m] = True
+        
+        moved = set()
+        for k in range(n):
+            numSlots = len(slots)
+            t = -1
+            if numSlots > 0:
+                h = slotHead[:numSlots]
+                d = np.where(h >= 0, distToVertex[k, h], distToHead[k, :numSlots])
+                d[~slotAlive[:numSlots] | np.isnan(d)] = np.inf
+                t = int(np.argmin(d))
+                if not d[t] < TRAJ_MAXDIST:
                     t = -1
-                    for i in range(len(openTrajectories)):
-                        d = np.linalg.norm(pos - openTrajectories[i][-1][2])
-                        if d < minDist:
-                            minDist = d
-                            t = i
-                    
-                    # Recent enough... add data to existing or new trajectory 
-                    if t != -1 and minDist < TRAJ_MAXDIST: # and openTrajectories[t][-1][1] != iframe:
-                        openTrajectories[t].append( (openTrajectories[t][-1][0], frame.frameID, pos, yframes) )
-                        # If this trajectory has been stationary for too long, split it
-                        # This happens when the FlySim bead doesn't go completely out of view... What are multiple 
-                        # trajectories will then be seen as one
-                        #     - Compute volume spanned by last 3 seconds (600 frames) of points
-                        if len(openTrajectories[t]) > 600:
-                            minBound, maxBound, bboxSpan = trajectoryBBox(openTrajectories[t][(-600):(-1)])
-                            if bboxSpan < 10:
-                                numTrajectories = processTrajectory(openTrajectories[t], output, \
-                                    outputTracking, workerIDFromProcess, numTrajectories)
-                                del openTrajectories[t]
-                    else:
-                        # Create new trajectory (only if allowed)
-                        if frame.frameID <= maxNewTrajFrame:
-                            trajectoryID += 1
-                            openTrajectories.append([(trajectoryID, frame.frameID, pos, yframes),])
-            # Signal that this worker finished processing this chunk of frames
-            tasks[workerIDFromProcess].task_done()
+            
+            if t != -1:
+                seq = slots[t]
+                traj = self.trajectories[seq]
+                traj.append(frameID, vertices[k], yframes)
+                self.trajectories.move_to_end(seq)
+                slotHead[t] = k
+                moved.add(seq)
+                if len(traj) > MAX_FLYSIM_DURATION_FRAMES:
+                    self.tooLong.add(seq)
+                # If this trajectory has been stationary for too long, split it
+                # This happens when the FlySim bead doesn't go completely out of view... What are multiple 
+                # trajectories will then be seen as one
+                #     - Compute volume spanned by last 3 seconds (600 frames) of points
+                if len(traj) > STATIONARY_WINDOW:
+                    if traj.windowBBoxSpan() < 10:
+                        finished.append(self._remove(seq))
+                        slotAlive[t] = False
+                        moved.discard(seq)
+            elif allowNewTrajectories:
+                # Create new trajectory
+                self.numCreated += 1
+                seq = self.numCreated
+                self.trajectories[seq] = Trajectory(seq)
+                self.trajectories[seq].append(frameID, vertices[k], yframes)
+                slotHead[numSlots] = k
+                slotAlive[numSlots] = True
+                slots.append(seq)
+                moved.add(seq)
+        
+        # Update the grid with the new heads
+        for seq in moved:
+            self._place(seq)
+        
+        return finished
+
+# =======================================================================================
+# Extract trajectories (in parallel)
+# =======================================================================================
 
 #
 # Note: To parallelize the discovery of FlySim trajectories, the processFile(...) function 
-#       splits the motion capture file into N contiguous blocks of frames. Each worker 
-#       process will process these frames in parallel. However, the frames are still linearly 
-#       read in, in a multiplexed way, but are then passed to the working processes.
+#       splits the motion capture file into N contiguous partitions of frames (using the frame 
+#       index). Each worker process reads the frames of its own partition directly from the file 
+#       (or frame store), and tracks the trajectories in it.
+#
+#       Workers start without any open trajectories, whereas a serial run would still have the 
+#       trajectories that were open at the end of the previous partition. Each worker therefore 
+#       first tracks the FLYSIM_WARMUP_FRAMES frames before its partition (the trajectories that 
+#       finish in these frames are discarded). The partitions 
+#       are then joined in a seam stitching pass: starting from the state at the end of the 
+#       previous partition, the main process continues tracking into the next partition, until 
+#       its open trajectories are identical to those of the worker at one of the checkpoints 
+#       recorded by the worker (usually as soon as the trajectories that crossed the seam have 
+#       finished). From there on, the results of the worker are identical to those of a serial 
+#       run, and the worker's final state is used to stitch the next partition. 
+#
+#       The open trajectories may never match, e.g. when a stationary marker is split every 
+#       STATIONARY_WINDOW points (the split points depend on where tracking started). The main 
+#       process then stops after FLYSIM_WARMUP_FRAMES frames, and the results of the worker are 
+#       used from there on. These can only differ from those of a serial run for the 
+#       trajectories that are open at that frame, which the worker has been tracking for at 
+#       least 2 * FLYSIM_WARMUP_FRAMES frames.
 #
-def processFile(fname, async=True):
+
+# Number of frames between checkpoints
+FLYSIM_CHECKPOINT_INTERVAL = 500
+
+# Number of frames tracked by each worker before its partition, and the maximum number of frames
+# tracked by the main process to stitch a partition
+FLYSIM_WARMUP_FRAMES = MAX_FLYSIM_DURATION_FRAMES + TRAJ_TIMEOUT
+
+# Number of finished trajectories that are scored at once
+FLYSIM_SCORE_BATCH_SIZE = 200
+
+# Iterate over (frameID, unidentified vertices, Yframe positions) of a range of frames
+def iterFlysimFrames(fname, startFrame, numFrames):
+    for batch in util.MocapBatchIterator(fname, startFrame=startFrame, numFrames=numFrames):
+        for i in range(len(batch.frameIDs)):
+            yield (int(batch.frameIDs[i]),
+                batch.unidentifiedVertices[batch.unidentifiedOffsets[i]:batch.unidentifiedOffsets[i+1]],
+                batch.yframePositions[batch.yframeOffsets[i]:batch.yframeOffsets[i+1]])
+
+# Track trajectories over a range of frames. Returns the scored trajectories that should be saved,
+# as (index of the frame in which the trajectory finished, scored trajectory), in the order in 
+# which they finished (finished trajectories are discarded without scoring them if score=False).
+def trackFrames(tracker, frames, checkpoints=None, stopAtCheckpoint=None, flush=False, verbose=None, 
+                score=True):
+    saved = []
+    finished = []
+    
+    def _score():
+        if score:
+            for (j, t), scored in zip(finished, scoreTrajectories([t for _, t in finished])):
+                if scored != None:
+                    saved.append((j, scored))
+        del finished[:]
+    
+    for j, (frameID, vertices, yframes) in enumerate(frames):
+        # o Remove "trajectories" that have too many points... (currently > 20 second = 4000 frames).
+        #   These are not flysim trajectories but likely stationary points, and we will loose much 
+        #   time and RAM space by keeping around such trajectories
+        # o Also remove trajectories that are too old (haven't been updated recently)
+        finished += [(j, t) for t in tracker.expire(frameID)]
+        
+        # Add unIDed points to existing or new trajectories
+        finished += [(j, t) for t in tracker.addFrame(frameID, vertices, yframes)]
+        
+        if len(finished) >= FLYSIM_SCORE_BATCH_SIZE:
+            _score()
+        
+        if (j % FLYSIM_CHECKPOINT_INTERVAL) == 0:
+            if checkpoints != None:
+                checkpoints[j] = tracker.fingerprint()
+            if stopAtCheckpoint != None and stopAtCheckpoint(j, tracker):
+                break
+        
+        if verbose != None and (j % 100000) == 0:
+            print("["+verbose+"] Processed "+str(j)+" frames, "+str(len(tracker))+" open trajectories")
+    
+    # Process the remaining trajectories
+    if flush:
+        finished += [(None, t) for t in tracker.flush()]
+    _score()
     
-    # Number of CPUs to use (due to IO reading limits, only ? workers appear to be necessary 
-    # for maximum performance)
+    return saved
+
+# Worker function
+def extractFlysim_Worker(task):
+    fname, partition, tracker, warmupFrame, numWarmupFrames, startFrame, numFrames, recordCheckpoints = task
+    
+    # Track the frames before the partition, to pick up the trajectories that cross the seam
+    if tracker is None:
+        tracker = TrajectoryTracker()
+    if numWarmupFrames > 0:
+        trackFrames(tracker, iterFlysimFrames(fname, warmupFrame, numWarmupFrames), score=False)
+    
+    checkpoints = {}
+    saved = trackFrames(tracker, iterFlysimFrames(fname, startFrame, numFrames), 
+        checkpoints=checkpoints if recordCheckpoints else None, verbose="Partition "+str(partition))
+    
+    return saved, checkpoints, tracker
+
+# Index position of the first frame of the oldest open trajectory (all trajectories in the frames 
+# before it have been saved)
+def getCompleteFrames(idx, tracker):
+    if len(tracker) == 0:
+        return len(idx)
+    firstFrame = min([t.frames[0] for t in tracker.trajectories.values()])
+    return int(idx.find(firstFrame))
+
+def processFile(fname, incremental=False):
+    
+    # Number of CPUs to use
     NUM_WORKERS = NUM_WORKERS_ASYNC if not DEBUG else 1
 
     # Output file names
     foName         = fname.replace('.raw.msgpack','.msgpack').replace('.msgpack','.flysim.csv')
     foNameTracking = fname.replace('.raw.msgpack','.msgpack').replace('.msgpack','.flysim.tracking.csv')
     
-    # Determine total number of frames (this also forces the creation of the data file index... important!)
-    totalNumFrames, minFrameIdx, maxFrameIdx = util.countRecords(fname, includeFrameRange=True)
+    # Split the frames into contiguous partitions (this also forces the creation of the data file 
+    # index... important!)
+    idx = util.openMocapIndex(fname)
+    totalNumFrames = len(idx)
     print("Total number of records: "+str(totalNumFrames))
     
-    # An array of queues of frames to process, one queue for each worker process
-    tasks = [multiprocessing.JoinableQueue() for i in range(NUM_WORKERS)]
-    
-    # An output queue for .flysim.csv data
-    output = multiprocessing.Queue()
-    
-    # An output queue for .flysim.tracking.csv data
-    outputTracking = multiprocessing.Queue()
-
-    # Create worker threads
-    pool = None
-    if async:
-        if DEBUG:
-            pool = multiprocessing.pool.ThreadPool(NUM_WORKERS, extractFlysim_Worker, (tasks, output, outputTracking))
-        else:
-            pool = multiprocessing.Pool(NUM_WORKERS, extractFlysim_Worker, (tasks, output, outputTracking))
-    
-    # Current reading positions in file for each of the worker processes
-    currentStartFramesOfTasks = [int(minFrameIdx + (maxFrameIdx-minFrameIdx) * i/NUM_WORKERS) \
-        for i in range(NUM_WORKERS)]
-    
-    # The maximum frame index at which the worker process is allowed to start a new trajectory (but it's 
-    # still allowed to continue an old trajectory)
-    maxNewTrajFrameOfTasks = [int(x + (maxFrameIdx-minFrameIdx) / NUM_WORKERS)+1 for x in currentStartFramesOfTasks]
+    # Continue from the previous run?
+    if incremental and util.isCheckpointCurrent(fname, 'flysim'):
+        print("FlySim trials are up to date: "+fname)
+        return
+    checkpoint = util.loadCheckpoint(fname, 'flysim', [foName, foNameTracking], incremental)
+    if checkpoint != None:
+        firstFrame = checkpoint[0]['numFrames']
+        tracker, numTrajectories = checkpoint[1]
+    else:
+        util.removeCheckpoint(fname, 'flysim')
+        firstFrame = 0
+        tracker, numTrajectories = TrajectoryTracker(), 0
     
-    # Worker status
-    workerDone = [False for i in range(NUM_WORKERS)]
+    # Where possible, partitions start right after a gap in the frameIDs that is longer than 
+    # TRAJ_TIMEOUT. All trajectories time out there, so the worker starts from the same state as 
+    # a serial run would, and the partitions can be joined at the first checkpoint.
+    # Note: Partitions are at least FLYSIM_WARMUP_FRAMES long, as each worker tracks as many 
+    #       frames before its partition
+    numFramesToProcess = totalNumFrames - firstFrame
+    numPartitions = max(1, min(NUM_WORKERS, numFramesToProcess // FLYSIM_WARMUP_FRAMES))
+    gaps = np.flatnonzero(np.diff(idx.frameIDs[firstFrame:]) > TRAJ_TIMEOUT) + 1
+    maxShift = numFramesToProcess // (4 * numPartitions)
+    partitionStarts = []
+    for i in range(numPartitions):
+        start = int(numFramesToProcess * i / numPartitions)
+        if i > 0 and len(gaps) > 0:
+            k = np.searchsorted(gaps, start)
+            nearest = min(gaps[max(0, k-1):(k+1)], key=lambda x: abs(x - start))
+            if abs(nearest - start) <= maxShift:
+                start = int(nearest)
+        partitionStarts.append(firstFrame + start)
+    partitionStarts = [x for x in sorted(set(partitionStarts)) if x < totalNumFrames]
+    partitions = []
+    for i in range(len(partitionStarts)):
+        # The last partition continues to the last indexed frame (the file may still be growing)
+        end = partitionStarts[i+1] if i+1 < len(partitionStarts) else totalNumFrames
+        # Note: The first partition continues from the state of the previous run (if any), so it 
+        #       doesn't have to be stitched
+        stitch = i > 0
+        warmupStart = max(0, partitionStarts[i] - FLYSIM_WARMUP_FRAMES) if stitch else partitionStarts[i]
+        partitions.append((fname, i, tracker if i == 0 and firstFrame > 0 else None, 
+            int(idx.frameIDs[warmupStart]), partitionStarts[i] - warmupStart, 
+            int(idx.frameIDs[partitionStarts[i]]), end - partitionStarts[i], stitch))
     
-    # Counter to keep track of how many frames we've processed
-    numFramesProcessed = 0
+    # Track each partition
+    if NUM_WORKERS == 1:
+        results = [extractFlysim_Worker(x) for x in partitions]
+    else:
+        with multiprocessing.Pool(NUM_WORKERS) as pool:
+            results = pool.map(extractFlysim_Worker, partitions)
     
-    # Start queueing frames
-    lastProgressReportTime = datetime.datetime.now()
-    with open(foName,'w') as fo, open(foNameTracking,'w') as foTracking:
-        
-        # Write header
-        fo.write('flysimTraj, framestart, frameend, is_flysim, score_dir, score_r2, distanceFromYframe, '+
-                 'distanceFromYframeSD, dist_ok, len_ok, dir_ok, std, stdX, stdY, stdZ\n')
+    with open(foName,'a' if firstFrame > 0 else 'w') as fo, \
+        open(foNameTracking,'a' if firstFrame > 0 else 'w') as foTracking:
         
-        # Write header
-        foTracking.write('trajectory,frame,x,y,z\n')
+        if firstFrame == 0:
+            # Write header
+            fo.write('flysimTraj, framestart, frameend, is_flysim, score_dir, score_r2, distanceFromYframe, '+
+                     'distanceFromYframeSD, dist_ok, len_ok, dir_ok, std, stdX, stdY, stdZ\n')
+            
+            # Write header
+            foTracking.write('trajectory,frame,x,y,z\n')
         
-        # Process all frames
-        while True:
-            # Add frames to each worker queue
-            for workerID in range(len(tasks)):
-                # If there are fewer than 3 chunks of frames left for a given worker process, add more frames
-                readAllFrames = False
-                if not workerDone[workerID]:
-                    if tasks[workerID].qsize() < 3:
-                        # Create an iterator over MoCap frames
-                        mocap = util.MocapFrameIterator(fname, \
-                            startFrame=currentStartFramesOfTasks[workerID])
-                        # We send frames to be processed in batches, which should speed up processing
-                        frames = []
-                        try:
-                            for i in range(2000):
-                                frames.append( (mocap.__next__(), maxNewTrajFrameOfTasks[workerID], workerID) )
-                            # Close iterator
-                            mocap.stopIteration(raiseStopIteration=False)
-                        except StopIteration:
-                            readAllFrames = True
-                        
-                        # Keep counter of number of processed frames
-                        numFramesProcessed += len(frames)
-                        # Submit frames for processing
-                        tasks[workerID].put( frames )
-                        # Now remember to continue with the following frame
-                        currentStartFramesOfTasks[workerID] = frames[-1][0].frameID + 1
-                
-                # Now see if this worker should shut down
-                if readAllFrames:
-                    # By pushing "NO_FRAMES_LEFT", we are signaling to the worker processes that all frames have been read
-                    tasks[workerID].put( 'NO_FRAMES_LEFT' )
-                    print("No frames left for worker "+str(workerID))
+        # Stitch the partitions together, and save the trajectories (numbered as in a serial run)
+        for i, (saved, checkpoints, workerTracker) in enumerate(results):
+            if partitions[i][7]:
+                # Continue tracking from the state at the end of the previous partition, until 
+                # the open trajectories match those of the worker (for at most FLYSIM_WARMUP_FRAMES
+                # frames)
+                converged = []
+                def _isConverged(j, tracker):
+                    if checkpoints.get(j) == tracker.fingerprint():
+                        converged.append(j)
+                    return len(converged) > 0
+                _, _, _, _, _, startFrame, numFrames, _ = partitions[i]
+                numStitched = min(numFrames, FLYSIM_WARMUP_FRAMES)
+                stitched = trackFrames(tracker, iterFlysimFrames(fname, startFrame, numStitched), 
+                    stopAtCheckpoint=_isConverged)
                 
-            # Update on progress
-            if (datetime.datetime.now() - lastProgressReportTime).total_seconds() > 5:
-                lastProgressReportTime = datetime.datetime.now()
-                s = "/" + str(totalNumFrames)+" ("+'{0:.{1}f}'.format(
-                        100*numFramesProcessed/totalNumFrames, 3)+'%)'
-                print("Processed "+str(numFramesProcessed)+s+" frames")
-                
-            # Limit how often this runs
-            sleep(0.5)
-                
-            # Write output
-            while not output.empty():
-                s = output.get()
-                if 'DONE:' in s:
-                    wid = int(s.replace('DONE:',''))
-                    print("Worker done: "+str(wid))
-                    workerDone[wid] = True
+                if len(converged) > 0:
+                    print("Partition "+str(i)+" joined at frame "+str(converged[0]))
+                    saved = stitched + [x for x in saved if x[0] > converged[0]]
+                    tracker = workerTracker
+                elif numStitched < numFrames:
+                    print("Partition "+str(i)+" could not be joined, continuing from the worker at "+
+                        "frame "+str(numStitched))
+                    saved = stitched + [x for x in saved if x[0] >= numStitched]
+                    tracker = workerTracker
                 else:
-                    fo.write(s+'\n')
-                    fo.flush()
-                
-            # Write tracking info
-            while not outputTracking.empty():
-                s = outputTracking.get()
-                foTracking.write(s+'\n')
-                foTracking.flush()
-                
-            # Break when all worker processes have exited
-            allWorkersDone = True if len([x for x in workerDone if not x])==0 else False
-            if allWorkersDone: 
-                break
+                    saved = stitched
+            else:
+                tracker = workerTracker
+            
+            for j, scored in saved:
+                saveTrajectory(fo, foTracking, numTrajectories + 100000, scored)
+                numTrajectories += 1
+        
+        # Save the open trajectories, so the next run can continue from here
+        fo.flush()
+        foTracking.flush()
+        util.saveCheckpoint(fname, 'flysim', totalNumFrames, [foName, foNameTracking], 
+            (tracker, numTrajectories), final=not incremental, 
+            completeFrames=totalNumFrames if not incremental else getCompleteFrames(idx, tracker))
+        
+        # Process the remaining trajectories
+        if not incremental:
+            for j, scored in trackFrames(tracker, [], flush=True):
+                saveTrajectory(fo, foTracking, numTrajectories + 100000, scored)
+                numTrajectories += 1
+    
     # Done!
     print("Done extracting FlySim trials!")
 
@@ -407,6 +725,11 @@ def processFile(fname, async=True):
 # =======================================================================================
 
 def processTrajectorySync(trajectory, fo, foTracking):
+    # Only this deprecated function still depends on statsmodels and pandas
+    import statsmodels.api as sm
+    import pandas as pd
+    from functools import partial
+
     with warnings.catch_warnings():
         warnings.simplefilter("ignore", category=RuntimeWarning)
 
@@ -583,16 +906,10 @@ def run(async=False, settings = None):
         if settings == None:
             settings = util.askForExtractionSettings()
         
-        if not DEBUG:
-            if len(settings.files) == 1:
-                processFile(settings.files[0])
-            else:
-                with multiprocessing.Pool(processes=16) as pool:
-                    (pool.map_async if async else pool.map)(processFile, settings.files)
-                    return pool
-        else:
-            for file in settings.files:
-                processFile(file)
+        # Note: Each file is split over all workers (see processFile), so files are processed 
+        # one at a time
+        for file in settings.files:
+            processFile(file, settings.incremental)
 
     return None
 
@@ -19,6 +19,10 @@ if __name__ == "__main__":
 
 import os, sqlite3, re
 from datetime import datetime
+from shared import artifacts
+
+# Version of the outputs
+VERSION = 1
 
 # Helper function
 def getTimeStr(time): return datetime.fromtimestamp(time//1000).strftime('%Y-%m-%d %H:%M:%S')
@@ -33,7 +37,7 @@ def processFile(dataFile):
     fnameLogOut = file.replace('.log','.log.txt')
     fnameOut = file.replace('.log','.trials.csv')
     
-    with open(fnameOut, 'w') as fo:
+    with artifacts.openArtifact(fnameOut) as fo:
         # Write header
         fo.write('timestamp, time, speed, height, wait\n')
 
@@ -61,7 +65,7 @@ def processFile(dataFile):
                     buf = buf[buf.find('\r\n')+2:]
         
         # Write log to file
-        with open(fnameLogOut, 'w') as foLog:
+        with artifacts.openArtifact(fnameLogOut) as foLog:
             for line in logFlysim:
                 foLog.write(','.join([str(x) for x in list(line)]) + '\n')
         
@@ -5,6 +5,9 @@
 DEBUG = False
 DEBUG_STARTFRAME = 16884134
 
+# Version of the outputs
+VERSION = 1
+
 # =======================================================================================
 # Change working directory so this script can be run independently as well as as a module
 # =======================================================================================
@@ -20,14 +23,12 @@ if __name__ == "__main__":
 # =======================================================================================
 
 import multiprocessing
-from time import sleep
 import pandas as pd, numpy as np
 from ggplot import *
 import matplotlib.pyplot as plt
 import scipy.misc
-from shared import util
-import re, datetime
-import traceback
+from shared import util, artifacts
+import re, datetime, itertools
 import seaborn as sns
 
 # =======================================================================================
@@ -49,196 +50,341 @@ def getMaxCamID(fname):
 # Find triggerbox markers in a given frame
 # =======================================================================================
 
-def findTriggerBoxInFrame(frame, camID, spacing=None, debug=True):
-                
-    # Result variables
-    centroids = []
-    if camID in frame.centroids:
-        for c in frame.centroids[camID].centroids:
-            npt = np.array([c.x, c.y])
-            if len(centroids)==0 or min([np.linalg.norm(npt-c2) for c2 in centroids]) >= 0:
-                centroids.append( npt )
-    centroids = np.array(centroids)
-
-    # Find co-linear, equi-distantly spaced triplet of centroids
-    syncbox = []
-    for i1,c1 in zip(range(len(centroids)),centroids):
-        for i2,c2 in zip(range(len(centroids)),centroids):
-            for i3,c3 in zip(range(len(centroids)),centroids):
-                if i2 > i1 and i3 > i2:
-                    a = c1 - c2
-                    b = c2 - c3 
-                    c = c1 - c3 
-                    colinearity = abs(np.dot( a, b ) * np.dot( b, c ) / 
-                      (np.linalg.norm(a)*np.linalg.norm(b)*np.linalg.norm(b)*np.linalg.norm(c)))
-                    d1 = np.linalg.norm(b-a)
-                    d2 = np.linalg.norm(c-b)
-                    d3 = np.linalg.norm(c-a)
-                    maxdist = np.max([d1,d2,d3])
-                    if colinearity > 0.9 and maxdist < 200:
-                        na = np.linalg.norm(a)
-                        nb = np.linalg.norm(b)
-                        syncbox.append({'c1': c1, 'c2': c2, 'c3': c3, 'frame': frame.frameID, 
-                                        'spacing': 0.5 * (na + nb), 'timestamp': frame.time, 
-                                        'camID': camID, 'equidist': max(na/nb,nb/na)})
-    
-    if len(syncbox) > 0:
-        # Did we specify a known spacing? If so, sort by spacing, using a reasonable equidist threshold
-        if spacing != None:
-            syncbox = [x for x in syncbox if x['equidist'] < 1.3]
-            syncbox = sorted(syncbox, key=lambda x: abs(spacing-x['spacing']))
-            if len(syncbox) > 0:
-                
-                # Save original syncbox ranking as debug info
-                if debug:
-                    syncbox[0]['ranking'] = syncbox
-                
-                # Choose top one
-                syncbox = syncbox[0]
-            
+# Note: The sync box is the co-linear, equi-distantly spaced triplet of centroids that best 
+#       matches the expected spacing, and a trigger is signalled by at least 3 additional 
+#       centroids lit up between/next to the sync box. Rather than testing every triplet in 
+#       a Python loop, all triplets are tested at once with broadcasted array operations, 
+#       for all frames (of a batch) that have the same number of centroids. Triplets are 
+#       enumerated in the same order (i1 < i2 < i3) as the original loop, and ties are broken 
+#       by taking the first triplet, so the same sync box is found.
+
+# Maximum number of (frame, triplet) pairs tested at once (frames with many centroids are 
+# tested in smaller groups, so each array of triplet points stays within 16 MB)
+TRIGGERBOX_MAX_TRIPLETS = 2**20
+
+# Triplets of centroid indices (i1 < i2 < i3), by number of centroids
+_triplets = {}
+
+def getTriplets(n):
+    if not n in _triplets:
+        _triplets[n] = np.array(list(itertools.combinations(range(n), 3)), 
+                                dtype=np.int64).reshape(-1, 3)
+    return _triplets[n]
+
+# Dot product and length of (arrays of) 2D vectors (computed with matmul, which rounds the 
+# same as np.dot and np.linalg.norm on single vectors)
+def _dot(v1, v2):
+    return np.matmul(v1[...,None,:], v2[...,:,None])[...,0,0]
+
+def _norm(v):
+    return np.sqrt(_dot(v, v))
+
+# Find the sync box in a list of (N x 2) centroid arrays, returns a list with, for each 
+# array, either None or a tuple (triplet indices, spacing, equidist, additional point indices)
+def findTriggerBoxes(centroids, spacing=None):
+    results = [None] * len(centroids)
+
+    # Group frames by number of centroids
+    groups = {}
+    for i, c in enumerate(centroids):
+        if len(c) >= 3:
+            groups.setdefault(len(c), []).append(i)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for n, groupFrames in groups.items():
+            T = getTriplets(n)
+            chunkSize = max(1, TRIGGERBOX_MAX_TRIPLETS // len(T))
+            for chunkStart in range(0, len(groupFrames), chunkSize):
+                frames = groupFrames[chunkStart:(chunkStart + chunkSize)]
+                C = np.stack([centroids[i] for i in frames])
+                c1, c2, c3 = C[:, T[:,0]], C[:, T[:,1]], C[:, T[:,2]]
+
+                # Find co-linear, equi-distantly spaced triplet of centroids
+                a = c1 - c2
+                b = c2 - c3
+                c = c1 - c3
+                na, nb, nc = _norm(a), _norm(b), _norm(c)
+                colinearity = np.abs(_dot(a, b) * _dot(b, c) / (na * nb * nb * nc))
+                maxdist = np.maximum(np.maximum(_norm(b - a), _norm(c - b)), _norm(c - a))
+                boxSpacing = 0.5 * (na + nb)
+                equidist = np.maximum(na / nb, nb / na)
+                valid = (colinearity > 0.9) & (maxdist < 200)
+
+                # Did we specify a known spacing? If so, choose by spacing, using a reasonable 
+                # equidist threshold
+                if spacing != None:
+                    valid &= equidist < 1.3
+                    key = np.abs(spacing - boxSpacing)
+                else:
+                    key = -equidist
+                best = np.argmin(np.where(valid, key, np.inf), axis=1)
+                found = valid[np.arange(len(frames)), best]
+                if not np.any(found):
+                    continue
+
                 # Now check if triggers occurred
-                additionalPts = []
-                for i,c in zip(range(len(centroids)),centroids):
-                    syncboxPts = None
-                    try:
-                        syncboxPts = [syncbox[m] for m in ['c1','c2','c3']]
-                    except Exception as e:
-                        traceback.print_exc()
-                    mindist = np.min([np.linalg.norm(c-c2) for c2 in syncboxPts+additionalPts])
-                    if mindist > 5:
-                        colinearity = []
-                        for sbp in [(syncboxPts[0],syncboxPts[1]),(syncboxPts[0],syncboxPts[2]),(syncboxPts[1],syncboxPts[2])]:
-                            v1 = sbp[0] - c
-                            v2 = c - sbp[1]
-                            v3 = sbp[0] - sbp[1]
-                            colinearity.append(np.abs(np.dot(v1, v2) * np.dot(v2, v3) * np.dot(v1, v3) /
-                                (np.linalg.norm(v1) * np.linalg.norm(v2) *
-                                 np.linalg.norm(v2) * np.linalg.norm(v3) *
-                                 np.linalg.norm(v1) * np.linalg.norm(v3))))
-
-                        isColinear = min(colinearity) > 0.95
-                        isNearby = mindist < 0.7 * spacing
-
-                        if isNearby and isColinear:
-                            additionalPts.append(c)
-                            syncbox['colinearity'] = [(mindist, colinearity), ] + (
-                                [] if not 'colinearity' in syncbox else syncbox['colinearity'])
-
-                syncbox['additionalPts'] = additionalPts
-            else:
-                syncbox = None
-        else:
-            syncbox = sorted(syncbox, key=lambda x: -x['equidist'])
-            syncbox = syncbox[0]
-            syncbox['additionalPts'] = []
-    else:
-        syncbox = None        
+                k = np.flatnonzero(found)
+                best = best[k]
+                box = np.stack([c1[k, best], c2[k, best], c3[k, best]], axis=1)
+                additionalPts = [[]] * len(k)
+                if spacing != None:
+                    additionalPts = findAdditionalPoints(C[k], box, spacing)
+
+                for j, i in enumerate(frames[x] for x in k):
+                    t = best[j]
+                    results[i] = (T[t], boxSpacing[k[j], t], equidist[k[j], t], additionalPts[j])
+
+    return results
+
+# Find the additional (trigger) points next to the sync box, given (F x N x 2) centroids and 
+# (F x 3 x 2) sync box points, returns a list with the indices of the points for each frame
+def findAdditionalPoints(C, box, spacing):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        minBoxDist = np.min(_norm(C[:,:,None,:] - box[:,None,:,:]), axis=2)
+        colinearity = []
+        for p1, p2 in [(0, 1), (0, 2), (1, 2)]:
+            v1 = box[:,None,p1] - C
+            v2 = C - box[:,None,p2]
+            v3 = box[:,None,p1] - box[:,None,p2]
+            n1, n2, n3 = _norm(v1), _norm(v2), _norm(v3)
+            colinearity.append(np.abs(_dot(v1, v2) * _dot(v2, v3) * _dot(v1, v3) / 
+                (n1 * n2 * n2 * n3 * n1 * n3)))
+        candidates = (np.min(colinearity, axis=0) > 0.95) & (minBoxDist > 5)
+
+    additionalPts = []
+    for j in range(C.shape[0]):
+        # Points are only accepted when they're not too close to the sync box or 
+        # previously accepted points, so the (few) candidates are checked in order
+        pts = []
+        for m in np.flatnonzero(candidates[j]):
+            mindist = minBoxDist[j, m]
+            if len(pts) > 0:
+                mindist = min(mindist, np.min(_norm(C[j, pts] - C[j, m])))
+            if mindist > 5 and mindist < 0.7 * spacing:
+                pts.append(m)
+        additionalPts.append(pts)
+    
+    return additionalPts
+
+# Build the sync box as a dictionary (or None)
+def makeTriggerBox(result, centroids, camID, frameID, timestamp, debug=True):
+    if result is None:
+        return None, False
+
+    triplet, spacing, equidist, additionalPts = result
+    syncbox = {'c1': centroids[triplet[0]], 'c2': centroids[triplet[1]], 
+               'c3': centroids[triplet[2]], 'frame': frameID, 'spacing': spacing, 
+               'timestamp': timestamp, 'camID': camID, 'equidist': equidist, 
+               'additionalPts': [centroids[i] for i in additionalPts]}
     
     # Add all centroids (useful for debugging)
-    if syncbox != None and debug:
+    if debug:
         syncbox['allcentroids'] = centroids
     
     # Triggered?
-    triggered = False
-    if syncbox != None:
-        if len(syncbox['additionalPts']) >= 3:
-            triggered = True
+    triggered = len(additionalPts) >= 3
 
     # Done!
     return syncbox, triggered
 
+def findTriggerBoxInFrame(frame, camID, spacing=None, debug=True):
+    centroids = np.zeros((0, 2))
+    if camID in frame.centroids:
+        centroids = np.array([[c.x, c.y] for c in frame.centroids[camID].centroids]).reshape(-1, 2)
+    
+    result = findTriggerBoxes([centroids], spacing=spacing)[0]
+    return makeTriggerBox(result, centroids, camID, frame.frameID, frame.time, debug=debug)
+
+# Find the sync box in all frames of a batch (see util.FrameBatch) for one camera, returns a 
+# list of (syncbox, triggered) tuples (optionally using a SyncBoxTracker for this camera)
+def findTriggerBoxesInBatch(batch, camID, spacing=None, debug=True, tracker=None):
+    numFrames = len(batch.frameIDs)
+    
+    # Get the centroids of this camera for every frame
+    centroids = [np.zeros((0, 2))] * numFrames
+    raws = np.flatnonzero(batch.rawCameras[:,0] == camID)
+    for i, r in zip(np.searchsorted(batch.rawOffsets, raws, side='right') - 1, raws):
+        centroids[i] = batch.centroids[batch.centroidOffsets[r]:batch.centroidOffsets[r+1], 0:2]
+    
+    if tracker is None:
+        results = findTriggerBoxes(centroids, spacing=spacing)
+    else:
+        results = [tracker.update(c) for c in centroids]
+    return [makeTriggerBox(results[i], centroids[i], camID, int(batch.frameIDs[i]), 
+                           int(batch.times[i]), debug=debug) for i in range(numFrames)]
+
 # =======================================================================================
-# Find triggerbox points in all frames
+# Track the sync box across frames
 # =======================================================================================
 
-def findTriggerBoxInFrames(fname, camID, startFrame=None, numFrames=None):
+# Note: The sync box is physically fixed, so once it has been found in a camera there's no 
+#       need to search all triplets of centroids in every frame. The tracker locks onto the 
+#       pixel positions of the sync box, and in subsequent frames only looks for centroids 
+#       within SYNCBOX_LOCK_RADIUS pixels of them (following any slow drift). The trigger 
+#       points are then checked as usual, which is linear in the number of centroids.
+#
+#       The confidence of the lock increases with every frame in which the sync box is found 
+#       (up to SYNCBOX_MAX_CONFIDENCE), and is halved whenever it isn't (e.g. when it is 
+#       occluded). Frames in which the sync box isn't found while the lock is held have no 
+#       sync box. Once the confidence reaches zero the lock is lost, and a full search 
+#       (findTriggerBoxes) is done until the sync box has been found again.
+
+SYNCBOX_LOCK_RADIUS = 5
+SYNCBOX_MAX_CONFIDENCE = 200
+
+class SyncBoxTracker:
+    def __init__(self, spacing):
+        self.spacing = spacing
+        self.box = None
+        self.confidence = 0
+
+    # Find the sync box in the (N x 2) centroids of the next frame, returns None or a tuple 
+    # (triplet indices, spacing, equidist, additional point indices) as findTriggerBoxes
+    def update(self, centroids):
+        result = None
+        if self.box is None:
+            result = findTriggerBoxes([centroids], spacing=self.spacing)[0]
+        elif len(centroids) >= 3:
+            result = self.match(centroids)
+
+        if result is not None:
+            self.box = centroids[result[0]]
+            self.confidence = min(self.confidence + 1, SYNCBOX_MAX_CONFIDENCE)
+        elif self.box is not None:
+            self.confidence = self.confidence // 2
+            if self.confidence == 0:
+                self.box = None
+
+        return result
+
+    # Match the locked sync box to the nearest centroids
+    def match(self, centroids):
+        dist = _norm(centroids[:,None,:] - self.box[None,:,:])
+        nearest = np.argmin(dist, axis=0)
+        if np.any(dist[nearest, [0, 1, 2]] >= SYNCBOX_LOCK_RADIUS) or len(set(nearest)) < 3:
+            return None
+
+        # Check that the points still form a (co-linear, equi-distantly spaced) sync box
+        triplet = np.sort(nearest)
+        c1, c2, c3 = centroids[triplet]
+        a = c1 - c2
+        b = c2 - c3
+        c = c1 - c3
+        na, nb, nc = _norm(a), _norm(b), _norm(c)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            colinearity = np.abs(_dot(a, b) * _dot(b, c) / (na * nb * nb * nc))
+            equidist = max(na / nb, nb / na)
+        if not (colinearity > 0.9 and equidist < 1.3):
+            return None
+
+        additionalPts = findAdditionalPoints(centroids[None], centroids[triplet][None], 
+                                             self.spacing)[0]
+        return triplet, 0.5 * (na + nb), equidist, additionalPts
 
-    i = -1
-    numFramesProcessed = 0
+# =======================================================================================
+# Find triggerbox points in all frames
+# =======================================================================================
 
-    for frame in util.iterMocapFrames(fname, startFrame=startFrame, numFrames=100):
-
-        if camID not in frame.centroids:
-            continue
-
-        tb, triggered = findTriggerBoxInFrame(frame, camID, spacing=38)
-
-        if tb != None:
-            tbc = []
-            for m in ['c1','c2','c3']:
-                tbc.append([tb['camID'],tb['frame'],tb[m][0],tb[m][1],'syncbox'])
-            for c in tb['additionalPts']:
-                tbc.append([tb['camID'],tb['frame'],c[0],c[1],'additionalpt'])
-            for c in tb['allcentroids']:
-                notYetIncluded = True
-                for pt in [tb[m] for m in ['c1','c2','c3']] + tb['additionalPts']:
-                    if np.linalg.norm(pt - c) < 1:
-                        notYetIncluded = False
-                        break
-                if notYetIncluded:
-                    tbc.append([tb['camID'],tb['frame'],c[0],c[1],'all'])
-
-            yield tbc
-            i += 1
-
-        numFramesProcessed += 1
-        if numFrames is not None and numFramesProcessed >= numFrames:
-            break
+# Sync box, additional and all other points of a sync box, as rows of 
+# [camID, frame, x, y, type] (for debugging)
+def getTriggerBoxPoints(tb):
+    tbc = []
+    for m in ['c1','c2','c3']:
+        tbc.append([tb['camID'],tb['frame'],tb[m][0],tb[m][1],'syncbox'])
+    for c in tb['additionalPts']:
+        tbc.append([tb['camID'],tb['frame'],c[0],c[1],'additionalpt'])
+    for c in tb['allcentroids']:
+        notYetIncluded = True
+        for pt in [tb[m] for m in ['c1','c2','c3']] + tb['additionalPts']:
+            if np.linalg.norm(pt - c) < 1:
+                notYetIncluded = False
+                break
+        if notYetIncluded:
+            tbc.append([tb['camID'],tb['frame'],c[0],c[1],'all'])
+    return tbc
+
+def findTriggerBoxInFrames(fname, camID, startFrame=None, numFrames=None):
+    for batch in util.MocapBatchIterator(fname, startFrame=startFrame, numFrames=numFrames):
+        for tb, triggered in findTriggerBoxesInBatch(batch, camID, spacing=38):
+            if tb != None:
+                yield getTriggerBoxPoints(tb)
 
 # =======================================================================================
 # Find triggers in parallel
 # =======================================================================================
 
-def findTriggerAsync(frame, camID):
-    try:
-        syncbox, triggered = findTriggerBoxInFrame(frame, camID, spacing=38)
-        if not DEBUG:
-            if triggered:
-                timestamp_str = str(datetime.datetime.fromtimestamp(syncbox['timestamp']/1000))
-                return 'trigger', syncbox['camID'], syncbox['frame'], syncbox['timestamp'], timestamp_str
-            else:
-                return None
+def formatTrigger(syncbox, triggered, camID, frameID):
+    if not DEBUG:
+        if triggered:
+            timestamp_str = str(datetime.datetime.fromtimestamp(syncbox['timestamp']/1000))
+            return 'trigger', syncbox['camID'], syncbox['frame'], syncbox['timestamp'], timestamp_str
         else:
-            # Output more extensive debug info
-            sb = []
-            if syncbox is not None:
-                for c in ['c1','c2','c3']:
-                    sb.append(syncbox[c][0])
-                    sb.append(syncbox[c][1])
-
-            if len(sb) == 6:
-                return tuple( ['debug', triggered,
-                               len(syncbox['additionalPts']),
-                               camID, frame.frameID, 0, ''] + sb )
-            else:
-                return None # Don't print info for frames with no Syncbox found
+            return None
+    else:
+        # Output more extensive debug info
+        sb = []
+        if syncbox is not None:
+            for c in ['c1','c2','c3']:
+                sb.append(syncbox[c][0])
+                sb.append(syncbox[c][1])
+
+        if len(sb) == 6:
+            return tuple( ['debug', triggered,
+                           len(syncbox['additionalPts']),
+                           camID, frameID, 0, ''] + sb )
+        else:
+            return None # Don't print info for frames with no Syncbox found
+
+# Find triggers in all frames of a batch for one camera
+def findTriggerAsync(batch, camID, tracker=None):
+    try:
+        return [formatTrigger(syncbox, triggered, camID, frameID) for (syncbox, triggered), frameID in 
+                zip(findTriggerBoxesInBatch(batch, camID, spacing=38, debug=DEBUG, tracker=tracker), 
+                    batch.frameIDs)]
     except Exception as e:
         return e
        
 # Worker function    
-def findTriggers_Worker(tasks, output, async=True):
+def findTriggers_Worker(tasks, output, transport, async=True, trackers=None):
+    # Sync box trackers (by camera ID), these are kept across the batches processed by this worker
+    if trackers is None:
+        trackers = {}
     while True:
-        taskList = tasks.get()
-        for frame, camIDs in taskList:
-            if not frame is None:
-                for camID in camIDs:
-                    r = findTriggerAsync(frame, camID)
-                    if isinstance(r, Exception):
-                        print(r)
-                    elif r != None:
-                        # When a trigger was detected write the frame number and camera ID to file
-                        output.put(','.join([str(y) for y in r]))
+        descriptor, camIDs = tasks.get()
+        # Frames are passed as a batch in shared memory, which is returned to the pool once 
+        # all frames have been processed
+        batch = transport.get(descriptor)
+        results = []
+        for camID in camIDs:
+            if not camID in trackers:
+                trackers[camID] = SyncBoxTracker(spacing=38)
+            r = findTriggerAsync(batch, camID, tracker=trackers[camID])
+            if isinstance(r, Exception):
+                print(r)
+            else:
+                results.append(r)
+        for i in range(len(batch.frameIDs)):
+            for r in results:
+                if r[i] != None:
+                    # When a trigger was detected write the frame number and camera ID to file
+                    output.put(','.join([str(y) for y in r[i]]))
+        transport.release(descriptor)
+        # Mark the batch as done
+        output.put(None)
         tasks.task_done()
         # If async is false, we break the for loop, so control goes back to findTriggers while loop
         if not async:
             break
 
-def findTriggers(fname, camIDs, async=True, startFrame=None):
+# Note: To continue a previous (non-async) search, pass the sync box trackers it ended with, and 
+#       set append to True
+def findTriggers(fname, camIDs, async=True, startFrame=None, numFrames=None, trackers=None, 
+                 append=False):
 
     fnameLedTriggers = fname.replace('.raw.msgpack','').replace('.msgpack','')+'.led_triggers_tmp'
 
     # Don't process if file already exists
-    if os.path.exists(fnameLedTriggers):
+    if os.path.exists(fnameLedTriggers) and not append:
         print("Skipping trigger search, file already exists: " + fnameLedTriggers)
         return
 
@@ -246,48 +392,65 @@ def findTriggers(fname, camIDs, async=True, startFrame=None):
     # for maximum performance)
     NUM_CPUS = 8
     
-    # Create an iterator over MoCap frames
-    mocap = util.MocapFrameIterator(fname, startFrame=startFrame)
-    
     # Get total number of frames
     totalNumFrames = util.countRecords(fname)
 
     tasks = multiprocessing.JoinableQueue()
     output = multiprocessing.Queue()
 
+    # Shared memory slots to pass batches of frames to the workers (the number of slots 
+    # limits the number of batches queued at any time)
+    transport = util.SharedBatchPool(2 * NUM_CPUS + 2 if async else 1)
+
     # Create worker threads
     pool = None
+    if trackers is None:
+        trackers = {}
     if async:
-        pool = multiprocessing.Pool(NUM_CPUS, findTriggers_Worker, (tasks, output))
+        pool = multiprocessing.Pool(NUM_CPUS, findTriggers_Worker, (tasks, output, transport))
     
+    # Write output (if wait is True, wait for all queued batches to be processed)
+    def writeOutput(fOut, wait=False):
+        nonlocal numBatchesDone
+        while numBatchesDone < numBatchesQueued and (wait or not output.empty()):
+            s = output.get()
+            if s is None:
+                numBatchesDone += 1
+                continue
+            print("Wrote to file: "+s)
+            fOut.write(s+'\n')
+            fOut.flush()
+
     # Start queueing frames
     numFramesProcessed = 0
-    with open(fnameLedTriggers,'w') as fOut:
-        fOut.write('camID,frame,timestamp,timestamp_str\n')
-        while True:
-            try:
-                numFramesProcessed += 1000
-                # We send frames to be processed in batches, which should speed up processing
-                newTasks = [(mocap.__next__(), camIDs) for i in range(1000)]
-                tasks.put( newTasks )
-                if tasks.qsize() > 100:
-                    sleep(1)
-                if (numFramesProcessed%5000)==0:
-                    s = "/" + str(totalNumFrames)+" ("+'{0:.{1}f}'.format(
-                            100*numFramesProcessed/totalNumFrames, 3)+'%)'
-                    print("Processed "+str(numFramesProcessed)+s+" frames (frame="+
-                          str(newTasks[0][0].frameID)+")")
-                # If not async, process the newly queued item now
-                if not async:
-                    findTriggers_Worker(tasks, output, async=False)
-                # Write output
-                while not output.empty():
-                    s = output.get()
-                    print("Wrote to file: "+s)
-                    fOut.write(s+'\n')
-                    fOut.flush()
-            except StopIteration as esi:
-                break
+    numBatchesQueued = 0
+    numBatchesDone = 0
+    # Note: A new search is only published once it has finished, so a half-written file is 
+    #       never mistaken for a complete one (an appended search is made consistent again 
+    #       by its checkpoint)
+    with (open(fnameLedTriggers, 'a') if append else artifacts.openArtifact(fnameLedTriggers)) as fOut:
+        if not append:
+            fOut.write('camID,frame,timestamp,timestamp_str\n')
+        # We send frames to be processed in batches, which should speed up processing
+        for batch in util.MocapBatchIterator(fname, startFrame=startFrame, numFrames=numFrames):
+            tasks.put( (transport.put(batch), camIDs) )
+            numBatchesQueued += 1
+            numFramesProcessed += len(batch.frameIDs)
+            if (numFramesProcessed%5000)==0:
+                s = "/" + str(totalNumFrames)+" ("+'{0:.{1}f}'.format(
+                        100*numFramesProcessed/totalNumFrames, 3)+'%)'
+                print("Processed "+str(numFramesProcessed)+s+" frames (frame="+
+                      str(batch.frameIDs[0])+")")
+            # If not async, process the newly queued item now
+            if not async:
+                findTriggers_Worker(tasks, output, transport, async=False, trackers=trackers)
+            writeOutput(fOut)
+
+        # Wait for the remaining batches to be processed
+        writeOutput(fOut, wait=True)
+
+    if pool is not None:
+        pool.terminate()
     
     print("Done searching for triggers.")
 
@@ -295,6 +458,34 @@ def findTriggers(fname, camIDs, async=True, startFrame=None):
 # Find the camera containing the syncbox
 # =======================================================================================
 
+# Note: Rather than checking every camera separately (decoding the same sample windows 
+#       over and over again), each sample window is decoded once and all cameras that 
+#       appear in it are checked on the same batch, with the windows spread over a pool of 
+#       worker processes. Once a camera has been found to contain the sync box in every frame 
+#       of a window (so the maximum fraction over all windows is known), it is no longer 
+#       checked in subsequent windows.
+
+# Sample small chunks of the file at many different points
+# (100 frames (.5 second) every 60 seconds)
+SYNC_SAMPLE_INTERVAL = 60 * 200
+SYNC_SAMPLE_NUM_FRAMES = 100
+
+# Minimum fraction of frames in a sample window with a sync box
+SYNC_MIN_FRACTION = 0.90
+
+# Find the sync box in a sample window for all cameras (except the ones given), returns a 
+# dictionary of lists of sync box points (see getTriggerBoxPoints) by camera ID
+def findTriggerBoxesInSample(task):
+    fname, startFrame, skipCamIDs = task
+    tbs = {}
+    for batch in util.MocapBatchIterator(fname, startFrame=startFrame, 
+            numFrames=SYNC_SAMPLE_NUM_FRAMES, batchSize=SYNC_SAMPLE_NUM_FRAMES):
+        for camID in np.unique(batch.rawCameras[:,0]).tolist():
+            if not camID in skipCamIDs:
+                tbs[camID] = [getTriggerBoxPoints(tb) for tb, triggered in 
+                              findTriggerBoxesInBatch(batch, camID, spacing=38) if tb != None]
+    return tbs
+
 def findCameraWithSync(fname):
 
     # Write debug image with all 2d markers
@@ -302,38 +493,34 @@ def findCameraWithSync(fname):
 
     print("Finding camera's with sync box")
 
-    maxCamID = getMaxCamID(fname)
-
-    NUM_FRAMES_TO_CHECK = 100
+    # Number of CPUs to use
+    NUM_CPUS = 8
 
-    camsWithSync = []
+    camsWithSync = {}
     tbs = {}
 
-    # Sample small chunks of the file at many different points
-    # (100 frames (.5 second) every 60 seconds)
-    startFrames = []
-    for i, id in util.iterMocapFrameIDs(fname):
-        if (i % (60 * 200)) == 0:
-            startFrames.append(id)
-
-    for camID in range(maxCamID+1):
-        print("Checking if camera "+str(camID)+" contains the sync box...")
-        fractions = []
-        for startFrame in startFrames:
-            if not camID in tbs:
-                tbs[camID] = []
-            tbsn = [x for x in findTriggerBoxInFrames(
-                fname, camID, numFrames=NUM_FRAMES_TO_CHECK, startFrame=startFrame)]
-            tbs[camID] += tbsn
-            fractions.append( len(tbsn) / NUM_FRAMES_TO_CHECK )
-        if max(fractions) >= 0.90:
-            camsWithSync.append( (camID, max(fractions)) )
+    startFrames = util.openMocapIndex(fname).frameIDs[::SYNC_SAMPLE_INTERVAL].tolist()
+
+    with multiprocessing.Pool(NUM_CPUS) as pool:
+        for i in range(0, len(startFrames), NUM_CPUS):
+            complete = set([camID for camID, fraction in camsWithSync.items() if fraction >= 1.0])
+            tasks = [(fname, startFrame, complete) for startFrame in 
+                     startFrames[i:(i + NUM_CPUS)]]
+            for r in pool.map(findTriggerBoxesInSample, tasks):
+                for camID, tbsn in r.items():
+                    if not camID in tbs:
+                        print("Checking if camera "+str(camID)+" contains the sync box...")
+                        tbs[camID] = []
+                    tbs[camID] += tbsn
+                    fraction = len(tbsn) / SYNC_SAMPLE_NUM_FRAMES
+                    if fraction >= SYNC_MIN_FRACTION:
+                        camsWithSync[camID] = max(fraction, camsWithSync.get(camID, 0))
 
     # Write debug image with identified triggerboxes
     plotTriggerboxes(fname, tbs)
 
     # Done!
-    return camsWithSync
+    return [(camID, camsWithSync[camID]) for camID in sorted(camsWithSync)]
 
 # =======================================================================================
 # Produce overlay image of all camera centroids to confirm that triggerbox exists
@@ -344,50 +531,41 @@ def plot2dCentroids(fname):
 
     os.makedirs(os.path.join(os.path.dirname(fname), 'debug'), exist_ok=True)
 
-    # Skip if files already exist
-    if len([x for x in os.listdir(os.path.join(os.path.dirname(fname), 'debug/'))
-        if 'MaxProjection' in x]) > 0:
-        # Skip... (we assume if there is one .png file, they're all there...)
-        return
-
     if not fname.endswith('.raw.msgpack'):
         fname = fname.replace('.msgpack','.raw.msgpack')
 
-    # Figure out width and height of cameras
-    w, h = None, None
-    for frame in util.iterMocapFrames(fname):
-        if w != None and h != None: break
-        for cid in frame.centroids:
-            w = frame.centroids[cid].width
-            h = frame.centroids[cid].height
-            break
-
-    # Gather camera 2d histogram
-    camImgs = [np.zeros((h, w)) for x in range(18)]
-    totalRecords = util.countRecords(fname)
-    iRecord = 0
-
-    for x in util.iterMocapFrames(fname):
-
-        iRecord += 1
-        if (iRecord%20000) == 0:
-            print("Plotting camera centroids ("+'{:.2f}'.format(100*iRecord/totalRecords)+" %)")
-
-        for frameID, frame in x.centroids.items():
-            for c in frame.centroids:
-                for dx in range(0,1): #range(-1, 2):
-                    for dy in range(0,1): #range(-1, 2):
-                        camImgs[frameID - 1][max(0, min(h - 1, int(c.y + dy)))]\
-                            [max(0, min(w - 1, int(c.x + dx)))] += 1
+    # Camera 2d histograms are cached, so the images can be regenerated without scanning the 
+    # file again, unless the file has changed since (e.g. it was still being recorded)
+    fnameHistograms = fname.replace('.raw.msgpack','').replace('.msgpack','')+'.centroids.npz'
+    isHistogramsCurrent = os.path.exists(fnameHistograms) and \
+        os.path.getmtime(fnameHistograms) >= os.path.getmtime(fname)
+
+    # Skip if files already exist, and were made from the current histograms
+    images = [os.path.join(os.path.dirname(fname), 'debug', x) for x in 
+        os.listdir(os.path.join(os.path.dirname(fname), 'debug/')) if 'MaxProjection' in x]
+    if len(images) > 0 and isHistogramsCurrent and \
+        min([os.path.getmtime(x) for x in images]) >= os.path.getmtime(fnameHistograms):
+        # Skip... (we assume if there is one .png file, they're all there...)
+        return
 
-    # Save images (max-proj)
-    for camID in range(18):
+    if isHistogramsCurrent:
+        camImgs = util.CentroidHistograms.load(fnameHistograms)
+    else:
+        print("Plotting camera centroids")
+        camImgs = util.CentroidHistograms()
+        for h in util.scanMocapFile(fname, util.getBatchCentroids, 
+                reduceFunc=util.accumulateCentroids, verbose=True):
+            if h is not None:
+                camImgs.merge(h)
+        camImgs.save(fnameHistograms)
+
+    for camID, img in sorted(camImgs.images.items()):
+        # Save images (max-proj)
         scipy.misc.imsave(os.path.join(os.path.dirname(fname),
-            'debug/MaxProjection_Camera_' + str(camID) + '.png'), camImgs[camID] >= 1)
+            'debug/MaxProjection_Camera_' + str(camID) + '.png'), img >= 1)
 
-    # Save images (log)
-    for camID in range(18):
-        img = np.log(camImgs[camID] + 1)
+        # Save images (log)
+        img = np.log(img + 1)
         img *= (255.0 / np.max(img))
         scipy.misc.imsave(os.path.join(os.path.dirname(fname),
             'debug/LogProjection_Camera_' + str(camID) + '.png'), img)
@@ -461,7 +639,7 @@ def finalizeTriggers(fname):
                 actualTriggers[r[0]] = [[camID], r[0], r[1]]
 
     # Now output a new file with following data: triggerFrame, camIDs (i.e. list), timestamp, timestamp_str
-    with open(fnameLedTriggersFinal, 'w') as fOut:
+    with artifacts.openArtifact(fnameLedTriggersFinal) as fOut:
         fOut.write('camIDs,frameID,timestamp,timestamp_str\n')
         for _, actualTrigger in actualTriggers.items():
 
@@ -527,7 +705,7 @@ def plotTriggerSignals(fname):
 # Process file
 # =======================================================================================
 
-def processFile(fname):
+def processFile(fname, incremental=False):
 
     if not fname.endswith('.msgpack'):
         raise Exception("extract_mocap_trigger.processFile requires .msgpack input.")
@@ -536,34 +714,77 @@ def processFile(fname):
     if not fname.endswith('.raw.msgpack'):
         fname = fname.replace('.msgpack', '.raw.msgpack')
 
-    # Don't process if file already exists
+    # Continue from the previous run? (Searches without a checkpoint are only done once)
+    # Note: The sync cameras are determined by the first run that finds any, and the sync box 
+    #       trackers are saved with the checkpoint. Incremental runs only sample the part of the
+    #       file recorded at the time of that first run, and the raw camera data is joined again 
+    #       by the final run (see extract_raw_mac_data.py), so the final run discards the 
+    #       checkpoint of the incremental runs and searches the entire file again.
     fnameLedTriggers = fname.replace('.raw.msgpack','').replace('.msgpack','')+'.led_triggers_tmp'
-    if os.path.exists(fnameLedTriggers):
+    meta = util.readCheckpoint(fname, 'triggers')
+    checkpoint = None
+    if meta != None and not incremental and not meta['final']:
+        print("Discarding the trigger search of the incremental runs: " + fnameLedTriggers)
+        util.removeCheckpoint(fname, 'triggers')
+        if os.path.exists(fnameLedTriggers):
+            os.remove(fnameLedTriggers)
+    elif meta != None and incremental:
+        if util.isCheckpointCurrent(fname, 'triggers'):
+            print("Trigger search is up to date: " + fnameLedTriggers)
+            return
+        checkpoint = util.loadCheckpoint(fname, 'triggers', [fnameLedTriggers], incremental)
+        if checkpoint is None and os.path.exists(fnameLedTriggers):
+            os.remove(fnameLedTriggers)
+
+    if checkpoint is None and os.path.exists(fnameLedTriggers):
         print("Skipping trigger search, file already exists: " + fnameLedTriggers)
     else:
-        # Find the camera with the sync signal
-        camsWithSync = findCameraWithSync(fname) # [(10,1),]
+        idx = util.openMocapIndex(fname)
+        if checkpoint != None:
+            firstFrame = checkpoint[0]['numFrames']
+            camsWithSync, trackers = checkpoint[1]
+        else:
+            util.removeCheckpoint(fname, 'triggers')
+            firstFrame = 0
+            trackers = {}
+
+            # Find the camera with the sync signal
+            camsWithSync = findCameraWithSync(fname) # [(10,1),]
 
-        # Get the camera with the maximum fraction of triggerboxes found
-        camsWithSync = sorted(camsWithSync, key=lambda x:-x[1])
+            # Get the camera with the maximum fraction of triggerboxes found
+            camsWithSync = sorted(camsWithSync, key=lambda x:-x[1])
 
         # No cams?
         if len(camsWithSync) == 0:
             print("Can't extract trigger signals, no sync signal found.")
+            if incremental:
+                # Try again once more data has been recorded
+                return
         else:
             print("Found multiple sync cameras:")
             for camWithSync in camsWithSync:
                 print("Camera "+str(camWithSync[0])+" ("+str(camWithSync[1])+").")
 
             # Search for triggers
-            findTriggers(fname, [x[0] for x in camsWithSync], async=False,
-                         startFrame=(DEBUG_STARTFRAME if DEBUG else None))
+            if DEBUG:
+                findTriggers(fname, [x[0] for x in camsWithSync], async=False,
+                             startFrame=DEBUG_STARTFRAME)
+            else:
+                if firstFrame == 0 or firstFrame < len(idx):
+                    findTriggers(fname, [x[0] for x in camsWithSync], async=False,
+                                 startFrame=int(idx.frameIDs[firstFrame]) if firstFrame > 0 else None, 
+                                 numFrames=len(idx) - firstFrame, trackers=trackers, 
+                                 append=firstFrame > 0)
+                util.saveCheckpoint(fname, 'triggers', len(idx), [fnameLedTriggers], 
+                    (camsWithSync, trackers), final=not incremental)
 
     # Finalize trigger signals
     finalizeTriggers(fname)
 
-    # Having found the triggers, now plot them for manual inspection
-    plotTriggerSignals(fname)
+    # Having found the triggers, now plot them for manual inspection (this is left for the 
+    # final run)
+    if not incremental:
+        plotTriggerSignals(fname)
 
     # Done!
     pass
@@ -580,7 +801,7 @@ def run(async=False, settings=None):
 
     # Process all log files:
     for file in settings.files:
-        processFile(file)
+        processFile(file, settings.incremental)
 
 if __name__ == "__main__":
     run(None)
@@ -13,13 +13,19 @@ if __name__ == "__main__":
 # Imports for this script
 # =======================================================================================
 
-import msgpack
 import numpy as np
 import math, os, multiprocessing
+from shared import util, artifacts
 
 # Set "overwrite" to True to overwrite existing files
 OVERWRITE = False
 
+# Version of the outputs
+VERSION = 1
+
+# Save one out of every SUBSAMPLE frames
+SUBSAMPLE = 100000
+
 # Misc. constants
 CORTEX_NAN  = 9999999
 
@@ -31,28 +37,26 @@ def processFile(file):
         if not OVERWRITE and os.path.isfile( outfile ): 
             print("Skipping file: "+file)
         else:
-            i = 0
-            with open(outfile, 'w') as fo:
-                with open(file,'rb') as f:
-                    filename = file
-                    if '/' in filename:
-                        filename = filename[filename.rfind('/')+1:]
-                    for x in msgpack.Unpacker(f):
-                        # Save only a very small subsample. This data is only meant for determining the position (and variation in position / stability) 
-                        # of the physical perch objects, which are currently all stationary.
-                        if ((i%100000)==0): 
-                            if not isinstance(x, int):
-                                for b in x[2]:
-                                    # Extract marker points
-                                    pos = [[z if z!=CORTEX_NAN else float('NaN') for z in y] for y in b[1]]
-                                    for mi in range(len(pos)):
-                                        fo.write(','.join([filename, str(b[0]), str(x[0]), str(mi)] + [str(y) for y in pos[mi]]) + '\n')
-                        i+=1
-                        if ((i%1000000)==0): 
-                            print("[" + file + "] Processed "+str(i)+" frames")
+            with artifacts.openArtifact(outfile) as fo:
+                filename = file
+                if '/' in filename:
+                    filename = filename[filename.rfind('/')+1:]
+                # Save only a very small subsample. This data is only meant for determining the position (and variation in position / stability) 
+                # of the physical perch objects, which are currently all stationary. The subsampled frames are looked up in the index, 
+                # so only those frames have to be decoded.
+                idx = util.openMocapIndex(file)
+                for i in range(0, len(idx), SUBSAMPLE):
+                    for batch in util.MocapBatchIterator(file, startFrame=int(idx.frameIDs[i]), numFrames=1):
+                        for b in range(batch.bodyOffsets[0], batch.bodyOffsets[1]):
+                            # Extract marker points
+                            name = str(batch.bodyNames[batch.bodyNameIDs[b]].encode())
+                            pos = batch.markers[batch.markerOffsets[b]:batch.markerOffsets[b+1]]
+                            for mi in range(len(pos)):
+                                fo.write(','.join([filename, name, str(batch.frameIDs[0]), str(mi)] + [str(y) for y in pos[mi]]) + '\n')
+                    if ((i%1000000)==0): 
+                        print("[" + file + "] Processed "+str(i)+" frames")
     except Exception as e:
         print(str(e))
-        os.remove(outfile)
 
 def run(async=False, settings=None):
 
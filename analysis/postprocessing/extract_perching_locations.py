@@ -21,10 +21,7 @@ import numpy as np
 import msgpack, collections, math, os, multiprocessing, sys, csv
 from time import time
 #from datetime import datetime
-import statsmodels.api as sm
-import statsmodels.formula.api as smf
 import pandas as pd
-from scipy import stats
 import gc
 from shared import util
 
@@ -35,6 +32,9 @@ from shared import util
 # Set "overwrite" to True to overwrite existing files
 OVERWRITE = True
 
+# Version of the outputs
+VERSION = 2
+
 # ...
 DEBUG = False
 #SINGLEFILE = '2016-11-11 12-20-41_Cortex.msgpack'
@@ -66,14 +66,283 @@ FLYSIM_AXIS_PT2 = np.array([ 450, -15])
 # Change working directory
 os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)),'../../data'))
 
+# =======================================================================================
+# Link Yframes into trajectories
+# =======================================================================================
+
+#
+# Note: Each Yframe is added to the open trajectory whose last point (head) is nearest, if that 
+#       head is closer than TRAJ_MAXDIST, and otherwise starts a new trajectory. Ties go to the 
+#       oldest trajectory. Trajectories of which the head is more than TRAJ_TIMEOUT frames old 
+#       when a Yframe comes in are finished (oldest first).
+#
+#       The heads of the open trajectories are kept in arrays, so each Yframe is compared to 
+#       all of them at once. Usually, a Yframe is added to the same trajectory as the Yframe 
+#       before it (there's mostly a single animal in the arena). Rather than assigning the 
+#       Yframes one by one, the linker therefore checks for a whole run of Yframes at once 
+#       whether each of them would be added to the trajectory of the previous one: it has to 
+#       be closer to that Yframe than TRAJ_MAXDIST and than any of the other (stationary) 
+#       heads, and no trajectory may time out. The run is then added as a single block. Only 
+#       the Yframe at which the run ends is assigned on its own.
+#
+#       The points of a trajectory are stored in arrays, and finished trajectories are passed 
+#       on as contiguous arrays (TrajectorySegment). The results are identical to assigning 
+#       the Yframes one by one.
+#
+
+TrajectorySegment = collections.namedtuple('TrajectorySegment', 'trajectory frames times positions')
+
+# Number of Yframes checked at once for the first run (the next ones are checked in increasingly 
+# larger blocks)
+YFRAME_RUN_BLOCK_SIZE = 16
+
+class YframeTrajectory:
+    __slots__ = ('id', 'numPoints', 'frames', 'times', 'positions')
+
+    def __init__(self, id, capacity=256):
+        self.id = id
+        self.numPoints = 0
+        self.frames = np.zeros(capacity, dtype=np.int64)
+        self.times = np.zeros(capacity, dtype=np.int64)
+        self.positions = np.zeros((capacity, 3))
+
+    def __len__(self):
+        return self.numPoints
+
+    def append(self, frames, times, positions):
+        n, m = self.numPoints, len(frames)
+        if n + m > len(self.frames):
+            capacity = max(2 * len(self.frames), n + m)
+            self.frames = np.resize(self.frames, capacity)
+            self.times = np.resize(self.times, capacity)
+            self.positions = np.resize(self.positions, (capacity, 3))
+        self.frames[n:(n+m)] = frames
+        self.times[n:(n+m)] = times
+        self.positions[n:(n+m)] = positions
+        self.numPoints += m
+
+    def segment(self):
+        n = self.numPoints
+        return TrajectorySegment(self.id, self.frames[:n], self.times[:n], self.positions[:n])
+
+class YframeLinker:
+    def __init__(self):
+        # Open trajectories (oldest first), and the frame and position of their heads
+        self.trajectories = []
+        self.headFrames = np.zeros(0, dtype=np.int64)
+        self.headPositions = np.zeros((0, 3))
+        self.numCreated = 0
+
+    def __len__(self):
+        return len(self.trajectories)
+
+    # Distances from the positions to the heads (NaN distances never match)
+    def _distToHeads(self, positions, heads):
+        d = np.sqrt(((positions[:, None, :] - heads[None, :, :])**2).sum(axis=2))
+        d[np.isnan(d)] = np.inf
+        return d
+
+    def _remove(self, keep):
+        finished = [t.segment() for t, k in zip(self.trajectories, keep) if not k]
+        self.trajectories = [t for t, k in zip(self.trajectories, keep) if k]
+        self.headFrames = self.headFrames[keep]
+        self.headPositions = self.headPositions[keep]
+        return finished
+
+    def _append(self, t, frames, times, positions):
+        self.trajectories[t].append(frames, times, positions)
+        self.headFrames[t] = frames[-1]
+        self.headPositions[t] = positions[-1]
+
+    # Number of Yframes from j on that are added to trajectory t, one after the other
+    def _runLength(self, t, frames, positions, j):
+        others = np.arange(len(self.trajectories)) != t
+        older = np.arange(len(self.trajectories)) < t
+        numRun = 0
+        blockSize = YFRAME_RUN_BLOCK_SIZE
+        while j + numRun < len(frames):
+            start = j + numRun
+            end = min(len(frames), start + blockSize)
+            F, P = frames[start:end], positions[start:end]
+            
+            # Closer than TRAJ_MAXDIST to the previous Yframe, without trajectory t timing out
+            dist = np.sqrt(((P - positions[(start-1):(end-1)])**2).sum(axis=1))
+            isRun = (dist < TRAJ_MAXDIST) & ((F - frames[(start-1):(end-1)]) <= TRAJ_TIMEOUT)
+            
+            # ... and closer than the other heads (which mustn't time out either)
+            if np.any(others):
+                isRun &= (F - np.min(self.headFrames[others])) <= TRAJ_TIMEOUT
+                distOthers = self._distToHeads(P, self.headPositions)
+                isRun &= np.all((dist[:, None] < distOthers) | (~older[None, :] & 
+                    (dist[:, None] <= distOthers)) | ~others[None, :], axis=1)
+            
+            if not np.all(isRun):
+                return numRun + int(np.argmin(isRun))
+            numRun += len(isRun)
+            blockSize *= 4
+        return numRun
+
+    # Add a batch of Yframes (in frame order), and return the trajectories that have finished
+    def addYframes(self, frames, times, positions):
+        finished = []
+        j = 0
+        while j < len(frames):
+            # Finish the trajectories that timed out
+            keep = (frames[j] - self.headFrames) <= TRAJ_TIMEOUT
+            if not np.all(keep):
+                finished += self._remove(keep)
+            
+            # Find the nearest head
+            t = -1
+            if len(self.trajectories) > 0:
+                dist = self._distToHeads(positions[j:(j+1)], self.headPositions)[0]
+                t = int(np.argmin(dist))
+                if not dist[t] < TRAJ_MAXDIST:
+                    t = -1
+            
+            # Add the Yframe to that trajectory, or start a new one
+            if t == -1:
+                self.numCreated += 1
+                self.trajectories.append(YframeTrajectory(self.numCreated))
+                self.headFrames = np.append(self.headFrames, frames[j])
+                self.headPositions = np.append(self.headPositions, positions[j:(j+1)], axis=0)
+                t = len(self.trajectories) - 1
+            self._append(t, frames[j:(j+1)], times[j:(j+1)], positions[j:(j+1)])
+            j += 1
+            
+            # Add the following Yframes that go to the same trajectory at once
+            n = self._runLength(t, frames, positions, j)
+            if n > 0:
+                self._append(t, frames[j:(j+n)], times[j:(j+n)], positions[j:(j+n)])
+                j += n
+        
+        return finished
+
+    # Finish all open trajectories (oldest first)
+    def flush(self):
+        return self._remove(np.zeros(len(self.trajectories), dtype=bool))
+
+# =======================================================================================
+# FlySim positions
+#
+# Note: The FlySim position of each frame (of the FlySim trials, see util.loadFlySim) is kept in
+#       arrays sorted by frame, so the positions in a range of trajectory frames are looked up
+#       at once with searchsorted. If there are several rows for a frame, the last one is used.
+# =======================================================================================
+
+class FlySimLookup:
+    
+    def __init__(self, fsTracking=None):
+        self.frames       = np.zeros(0, dtype=np.int64)
+        self.trajectories = np.zeros(0)
+        self.positions    = np.zeros((0, 3))
+        if fsTracking is None: 
+            return
+        
+        frames = fsTracking['frame'].values.astype(np.int64)
+        valid  = fsTracking['is_flysim'].values.astype(bool) & \
+            (fsTracking['framestart'].values <= frames) & (frames <= fsTracking['frameend'].values)
+        order  = np.flatnonzero(valid)[np.argsort(frames[valid], kind='stable')]
+        isLast = np.append(frames[order][1:] != frames[order][:-1], True)
+        order  = order[isLast]
+        
+        self.frames       = frames[order]
+        self.trajectories = fsTracking['flysimTraj'].values[order]
+        self.positions    = fsTracking[['flysim.x','flysim.y','flysim.z']].values[order]
+    
+    def __len__(self):
+        return len(self.frames)
+    
+    # Returns the indices of the given (sorted) frames that have a FlySim position, and the 
+    # FlySim trajectory ID and position in each of them
+    def lookup(self, frames):
+        i = np.searchsorted(self.frames, frames)
+        found = np.flatnonzero(self.frames[np.minimum(i, len(self.frames) - 1)] == frames) \
+            if len(self.frames) > 0 else np.zeros(0, dtype=np.int64)
+        return found, self.trajectories[i[found]], self.positions[i[found]]
+
+# Least squares fit of d = p1 + p2 * f + p3 * f^2. Returns [p1, p2, p3] and R^2.
+# Note: Solved with lstsq (as the OLS fit from statsmodels was), which gives the minimum-norm 
+#       parameters when there are fewer than 3 distinct frames. np.polyfit rescales the columns 
+#       first, so it doesn't give the same parameters in that case.
+def fitQuadratic(f, d):
+    X = np.vander(f.astype(float), 3, increasing=True)
+    params = np.linalg.lstsq(X, d, rcond=None)[0]
+    # (R^2 is undefined (NaN) if d is constant, e.g. if there is a single FlySim frame)
+    tss = np.sum((d - np.mean(d))**2)
+    if tss == 0:
+        return params.tolist(), np.nan
+    with np.errstate(invalid='ignore', divide='ignore'):
+        R2 = 1.0 - np.sum((d - X.dot(params))**2) / tss
+    return params.tolist(), R2
+
+# The most common value (the smallest one for ties), or -1 if there are none
+def mostCommon(values):
+    if len(values) == 0:
+        return -1
+    unique, counts = np.unique(values, return_counts=True)
+    return unique[np.argmax(counts)]
+
 # =======================================================================================
 # Process trajectory (either stable/perching or takeoff)
 # =======================================================================================
 
+#
+# Note: A trajectory is split into stationary blocks: runs of consecutive points of which the 
+#       bounding box stays within MAX_STATIONARY_MOVEMENT in each dimension. The point at which 
+#       the box grows too large still belongs to the block, and the next block starts after it.
+#       The running bounding box is computed for chunks of points at once (increasingly larger 
+#       chunks for long blocks), so a block takes time linear in its number of points.
+#
+#       Per-block averages are computed from cumulative sums of the positions, and as the points 
+#       of a trajectory are in frame order, frame ranges (e.g. the 400 frames after a takeoff, or 
+#       the takeoff preceding each point) are looked up with searchsorted. Processing a 
+#       trajectory thus takes linear time overall.
+#
+
+# Number of points of which the running bounding box is computed at once (the chunk size grows 
+# for long blocks)
+STATIONARY_CHUNK_SIZE = 64
+
+# Returns the (first, last) point index of each block, and its bounding box. The last block 
+# is still open (it ends with the trajectory rather than with a point that exceeds the bounds), 
+# or None if the trajectory ends with a closed block.
+def findStationaryBlocks(positions):
+    blocks = []
+    openBlock = None
+    n = len(positions)
+    start = 0
+    while start < n:
+        boundsMin = np.full(3,  np.inf)
+        boundsMax = np.full(3, -np.inf)
+        chunkStart, chunkSize = start, STATIONARY_CHUNK_SIZE
+        end = None
+        while end is None and chunkStart < n:
+            chunk = positions[chunkStart:(chunkStart+chunkSize)]
+            # (NaN coordinates are ignored)
+            runMin = np.fmin(np.fmin.accumulate(chunk, axis=0), boundsMin)
+            runMax = np.fmax(np.fmax.accumulate(chunk, axis=0), boundsMax)
+            exceeds = np.any((runMax - runMin) > MAX_STATIONARY_MOVEMENT, axis=1)
+            i = int(np.argmax(exceeds)) if np.any(exceeds) else len(chunk) - 1
+            boundsMin, boundsMax = runMin[i], runMax[i]
+            if exceeds[i]:
+                end = chunkStart + i
+            chunkStart += len(chunk)
+            chunkSize *= 4
+        if end is None:
+            openBlock = (start, n - 1, boundsMin, boundsMax)
+            break
+        blocks.append((start, end, boundsMin, boundsMax))
+        start = end + 1
+    return blocks, openBlock
+
+# (trajectory is a TrajectorySegment)
 def processTrajectory(trajectory, foPerches, foTakeoffs, foTracking, foDebug, takeoffID, flysim):
     
+    frames, times, positions = trajectory.frames, trajectory.times, trajectory.positions
+
     # Enforce minimum trajectory length
-    if len(trajectory) < TRAJ_SAVE_MINLEN: return takeoffID
+    if len(frames) < TRAJ_SAVE_MINLEN: return takeoffID
     
     # Look for:
     #    o Point of takeoff
@@ -81,57 +350,51 @@ def processTrajectory(trajectory, foPerches, foTakeoffs, foTracking, foDebug, ta
     #  
     # In addition, label the following:
     #    o Motion towards center FlySim axis
-    
-    boundsMin  = [ float("inf"),  float("inf"),  float("inf")]
-    boundsMax  = [-float("inf"), -float("inf"), -float("inf")]
-    frameRange = ( float("inf"), -float("inf") )
-    timeRange  = ( float("inf"), -float("inf") )
-    numFrames, avg = (None, None)
+
+    # Time range from the start of the trajectory up to each point
+    timeMin = np.minimum.accumulate(times)
+    timeMax = np.maximum.accumulate(times)
+
+    # Cumulative sums of the (non-NaN) coordinates, for the average position in each block
+    hasValue = ~np.isnan(positions)
+    cumSum = np.concatenate([np.zeros((1, 3)), np.cumsum(np.where(hasValue, positions, 0), axis=0)])
+    cumCount = np.concatenate([np.zeros((1, 3)), np.cumsum(hasValue, axis=0)])
+    def _average(frameRange):
+        i0 = np.searchsorted(frames, frameRange[0], side='left')
+        i1 = np.searchsorted(frames, frameRange[1], side='left')
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return (cumSum[i1] - cumSum[i0]) / (cumCount[i1] - cumCount[i0])
     
     # Ranges of frame indices that were detected as "stationary"
     # We can then use the complement of these ranges to detect takeoff characteristics
     frameRanges= []
 
     # Find frame ranges
-    for ti in range(len(trajectory)): 
-        
-        t = trajectory[ti]        
-        
-        # Update bounds                   
-        boundsMin = np.nanmin( [t.pos, boundsMin], axis=0 )
-        boundsMax = np.nanmax( [t.pos, boundsMax], axis=0 )
+    blocks, openBlock = findStationaryBlocks(positions)
+    numFrames = None
+    for start, end, boundsMin, boundsMax in blocks:
+        frameRange = (frames[start], frames[end])
         
-        # Update frame and time range
-        frameRange = ( min(frameRange[0], t.frame), max(frameRange[1], t.frame) )
-        timeRange  = ( min( timeRange[0], t.time ), max( timeRange[1], t.time ) )
-            
-        # Does any bounding box dimension exceed that allowed?
-        if (len([x for x in (boundsMax-boundsMin) if x > MAX_STATIONARY_MOVEMENT]) > 0):
-                        
-            # If so, save the box and its length, start a new one
-                        
-            # Compute number of frames
-            numFrames = len([x for x in trajectory if x.frame > frameRange[0] and x.frame < frameRange[1]])
-
-            # Save data (only if minimum number of perching frames was detected)
-            if (frameRange[1]-frameRange[0]) > 10:
-                # Store range for additional processing
-                frameRanges.append( frameRange ) 
-                # Save
-                savePerchInfo(foPerches, trajectory, frameRange, numFrames, \
-                    timeRange, boundsMin, boundsMax)
-                        
-            # Reset bounding box
-            boundsMin  = [ float("inf"),  float("inf"),  float("inf")]
-            boundsMax  = [-float("inf"), -float("inf"), -float("inf")]
-            frameRange = ( float("inf"), -float("inf") )
-
-    # Add remaining open frame range
-    frameRanges.append(frameRange)
-
-    # Save frame ranges
-    savePerchInfo(foPerches, trajectory, frameRange, numFrames, \
-        timeRange, boundsMin, boundsMax)
+        # Compute number of frames
+        numFrames = max(0, int(np.searchsorted(frames, frameRange[1], side='left') - 
+            np.searchsorted(frames, frameRange[0], side='right')))
+
+        # Save data (only if minimum number of perching frames was detected)
+        if (frameRange[1]-frameRange[0]) > 10:
+            # Store range for additional processing
+            frameRanges.append( frameRange ) 
+            # Save
+            savePerchInfo(foPerches, trajectory.trajectory, frameRange, numFrames, \
+                (timeMin[end], timeMax[end]), _average(frameRange), boundsMin, boundsMax)
+
+    # Add remaining open frame range, and save it
+    # Note: This uses the number of frames of the last closed block (as it always has)
+    if openBlock != None:
+        start, end, boundsMin, boundsMax = openBlock
+        frameRange = (frames[start], frames[end])
+        frameRanges.append(frameRange)
+        savePerchInfo(foPerches, trajectory.trajectory, frameRange, numFrames, \
+            (timeMin[end], timeMax[end]), _average(frameRange), boundsMin, boundsMax)
 
     # Temporarily save takeoff info
     takeoffs = []
@@ -139,52 +402,46 @@ def processTrajectory(trajectory, foPerches, foTakeoffs, foTracking, foDebug, ta
     # Detect takeoff characteristics
     for fr in frameRanges:
         ## Is this an upward trajectory? (during the first 2 sec, i.e. 400 frames) (Indicating takeoff)
-        frames = [x for x in trajectory if x.frame >= fr[1] and x.frame < fr[1] + 400]
+        i0 = np.searchsorted(frames, fr[1], side='left')
+        i1 = np.searchsorted(frames, fr[1] + 400, side='left')
+        toFrames, toTimes, toPositions = frames[i0:i1], times[i0:i1], positions[i0:i1]
                 
         # Minimum takeoff length required
-        if len(frames) < TRAJ_TAKEOFF_MINLEN: continue
+        if len(toFrames) < TRAJ_TAKEOFF_MINLEN: continue
         
         # Is any position in trajectory at least 100 mm higher than starting position?
         #isUpward = ( len([x for x in frames if x.pos[2] > frames[0].pos[2]+100]) > 0 )
         delta = int(0.2 * CORTEX_FPS)
-        maxUpwardSpeed = max([(frames[i+delta].pos[2]-frames[i].pos[2]) for i in range(len(frames) - delta)])
+        maxUpwardSpeed = np.max(toPositions[delta:,2] - toPositions[:-delta,2])
         
         ## Save framenumber when trajectory reached its peak
-        framePeak = max(frames, key=lambda x:x.pos[2]).frame
+        framePeak = toFrames[np.argmax(toPositions[:,2])]
         
         ## Is this trajectory never diverging from flysim point?
-        data = { 'f': [], 'd': [] }
-        minframe = min([x.frame for x in frames])
-        flysimTraj = []
-        for fi in range(len(frames)):
-            frame = frames[fi].frame
-            if frame in flysim:
-                flysimPos = flysim[frame][1]
-                flysimTraj.append(flysim[frame][0])
-                data['f'].append( frame - minframe )
-                data['d'].append( np.linalg.norm( flysimPos - frames[fi].pos ) )
-                foDebug.write(','.join([str(x) for x in [fr[1],frame,frames[0].trajectory,data['f'][-1],data['d'][-1]]+flysimPos.tolist()])+'\n')
+        found, fsTrajs, fsPositions = flysim.lookup(toFrames)
+        fsFrames = toFrames[found]
+        f = fsFrames - toFrames[0]
+        d = np.linalg.norm(fsPositions - toPositions[found], axis=1)
+        if len(found) > 0:
+            columns = [[str(fr[1])] * len(found), map(str, fsFrames.tolist()), 
+                [str(trajectory.trajectory)] * len(found), map(str, f.tolist()), map(str, d.tolist())] + \
+                [map(str, fsPositions[:,c].tolist()) for c in range(3)]
+            foDebug.write( ''.join([line + '\n' for line in map(','.join, zip(*columns))]) )
 
         # The flysim trajectory ID we save is the most common one (they should all be the same in the first place)
-        flysimTraj = stats.mode(flysimTraj)
-        if len(flysimTraj)>0 and len(flysimTraj[0])>0:
-            flysimTraj = flysimTraj[0][0]
-        else:
-            flysimTraj = -1
+        flysimTraj = mostCommon(fsTrajs)
         
         ## Range of the first 2 seconds (400 frames)
-        bboxSize = np.linalg.norm(np.ptp([x.pos for x in trajectory if x.frame >= fr[1] and x.frame < fr[1] + 400], axis=0))
+        bboxSize = np.linalg.norm(np.ptp(toPositions, axis=0))
 
         # Compute the fraction of the trajectory frames that did not diverge from flysim axis
         R2 = -1
         params = [0, 0, 0]
-        if len(data['f'])>0:
-            f = smf.ols(formula="d ~  f + np.power(f,2)", data=data).fit() 
-            R2 = f.rsquared
-            params = f.params.tolist()
+        if len(found)>0:
+            params, R2 = fitQuadratic(f, d)
         
         ## Save
-        takeoff = [fr[1], fr[1]-fr[0], frames[0].trajectory, frames[0].time, util.getTimeStr(frames[0].time), 
+        takeoff = [fr[1], fr[1]-fr[0], trajectory.trajectory, toTimes[0], util.getTimeStr(toTimes[0]), 
             bboxSize, maxUpwardSpeed,framePeak,flysimTraj] + params + [R2,]
         takeoffs.append( [takeoffID, ] + takeoff )
         takeoffID += 1
@@ -192,25 +449,31 @@ def processTrajectory(trajectory, foPerches, foTakeoffs, foTracking, foDebug, ta
         foTakeoffs.write( ','.join([str(x) for x in takeoff]) + '\n' )
         foTakeoffs.flush()
 
-    # Write tracking info
-    for t in trajectory:
-        # Find closest takeoff
-        a = [(takeoff, (t.frame-takeoff[1])) for takeoff in \
-            takeoffs if (t.frame-takeoff[1])>=0]
-        takeoff  = min(a, key=lambda x:x[1])[0][0] if len(a)>0 else -1
-        relFrame = min(a, key=lambda x:x[1])[0][1] if len(a)>0 else ''
-        # Save
-        foTracking.write( ','.join([str(x) for x in [t.frame, relFrame, t.trajectory, t.time, util.getTimeStr(t.time), takeoff, ] + t.pos.tolist()]) + '\n' )
+    # Write tracking info (with the closest preceding takeoff of each point; the first one if 
+    # several takeoffs start in the same frame)
+    takeoffFrames = np.array([takeoff[1] for takeoff in takeoffs], dtype=np.int64)
+    k = np.searchsorted(takeoffFrames, frames, side='right') - 1
+    k[k >= 0] = np.searchsorted(takeoffFrames, takeoffFrames[k[k >= 0]], side='left')
+    takeoffIDs = [takeoffs[i][0] if i >= 0 else -1 for i in k.tolist()]
+    # Note: The relframe column holds the frame of the takeoff (as it always has)
+    relFrames  = [str(takeoffs[i][1]) if i >= 0 else '' for i in k.tolist()]
+    
+    # (points in the same second share their time string)
+    seconds, timeIdx = np.unique(times // 1000, return_inverse=True)
+    timeStrs = [util.getTimeStr(s * 1000) for s in seconds.tolist()]
+    
+    # Save (formatted column by column)
+    columns = [map(str, frames.tolist()), relFrames, [str(trajectory.trajectory)] * len(frames), 
+        map(str, times.tolist()), [timeStrs[i] for i in timeIdx.tolist()], map(str, takeoffIDs)] + \
+        [map(str, positions[:,c].tolist()) for c in range(3)]
+    foTracking.write( ''.join([line + '\n' for line in map(','.join, zip(*columns))]) )
     
     return takeoffID
 
-def savePerchInfo(foPerches, trajectory, frameRange, numFrames, timeRange, boundsMin, boundsMax):
+def savePerchInfo(foPerches, trajectoryID, frameRange, numFrames, timeRange, avg, boundsMin, boundsMax):
     if frameRange[1]-frameRange[0] > TRAJ_SAVE_MINLEN:      
 
-        # Compute average
-        avg = np.nanmean(np.array([f.pos for f in trajectory if f.frame >= frameRange[0] and f.frame < frameRange[1]]), axis=0)
-
-        foPerches.write( ','.join([str(x) for x in list(frameRange)+[numFrames,]+[trajectory[0].trajectory, ]+avg.tolist()+
+        foPerches.write( ','.join([str(x) for x in list(frameRange)+[numFrames,]+[trajectoryID, ]+avg.tolist()+
             boundsMin.tolist()+boundsMax.tolist()+list(timeRange)+
             [util.getTimeStr(timeRange[0]), util.getTimeStr(timeRange[1])]]) + '\n' )
         foPerches.flush()
@@ -219,7 +482,7 @@ def savePerchInfo(foPerches, trajectory, frameRange, numFrames, timeRange, bound
 # Process file
 # =======================================================================================
 
-def processFile(file):
+def processFile(file, incremental=False):
     
     # Output file names
     fnamePerches  = file.replace('.msgpack', '.perches.csv')
@@ -235,84 +498,88 @@ def processFile(file):
     # Debug header
     dbgHeader = "["+file.replace('_Cortex.msgpack','')[0:30]+"] "
 
+    # Continue from the previous run?
+    outputs = [fnamePerches, fnameTakeoffs, fnameTracking, fnameDebug]
+    if incremental and util.isCheckpointCurrent(file, 'perching'):
+        print(dbgHeader+"Perching locations are up to date")
+        return
+    checkpoint = util.loadCheckpoint(file, 'perching', outputs, incremental)
+    if checkpoint != None:
+        firstFrame = checkpoint[0]['numFrames']
+        linker, takeoffID = checkpoint[1]
+    else:
+        util.removeCheckpoint(file, 'perching')
+        firstFrame = 0
+        linker, takeoffID = YframeLinker(), 0
+
+    # Trajectories can only be processed once the FlySim trials in their frames are known, so only 
+    # the frames for which all FlySim trajectories have been saved are processed
+    idx = util.openMocapIndex(file)
+    lastFrame = len(idx)
+    if incremental:
+        fsCheckpoint = util.readCheckpoint(file, 'flysim')
+        lastFrame = max(firstFrame, min(lastFrame, 
+            fsCheckpoint['completeFrames'] if fsCheckpoint != None else 0))
+
     # Read known flysim locations
     print(dbgHeader+"Started reading flysim")
     fsTracking = util.loadFlySim(file) 
-    flysim = {}
-    if fsTracking != None:
-        for (rowid, row) in fsTracking.iterrows():
-            frame = int(row['frame'])
-            if row['is_flysim'] and row['framestart'] <= frame and \
-                frame <= row['frameend']:
-                flysim[frame] = (row['flysimTraj'], np.array([row['flysim.'+c] for c in ['x','y','z']]))
-        print(dbgHeader+"Finished reading flysim")
+    flysim = FlySimLookup(fsTracking)
+    if fsTracking is not None:
+        print(dbgHeader+"Finished reading flysim ("+str(len(flysim))+" frames)")
     else:
         print(dbgHeader+"Failed to read flysim... processed flysim data not found")
     
-    # Open trajectories
-    openTrajectories = []
-    trajectoryID = 0
-
     # Start loop
     lastInfoTime = time()
-    numRecords = 0
-    totalNumRecords = util.countRecords(file)
-
-    takeoffID = 0
+    numRecords = firstFrame
+    totalNumRecords = len(idx)
 
     # ...
-    with open(fnamePerches,'w') as foPerches, \
-        open(fnameTakeoffs,'w') as foTakeoffs, open(fnameTracking,'w') as foTracking, \
-        open(fnameDebug,'w') as foFsDbg:
+    mode = 'a' if firstFrame > 0 else 'w'
+    with open(fnamePerches,mode) as foPerches, \
+        open(fnameTakeoffs,mode) as foTakeoffs, open(fnameTracking,mode) as foTracking, \
+        open(fnameDebug,mode) as foFsDbg:
         
         # Write headers for output files
+        if firstFrame == 0:
+            foTakeoffs.write('frame,perchframes,trajectory,timestamp,time,bboxsize,upwardVelocityMax,framepeak,flysimTraj,p1,p2,p3,r2\n')
         
-        foTakeoffs.write('frame,perchframes,trajectory,timestamp,time,bboxsize,upwardVelocityMax,framepeak,flysimTraj,p1,p2,p3,r2\n')
+            foPerches.write('framestart,frameend,numframes,trajectory,x,y,z,minx,miny,minz,' + \
+                'maxx,maxy,maxz,timestampstart,timestampend,timestart,timeend\n')
         
-        foPerches.write('framestart,frameend,numframes,trajectory,x,y,z,minx,miny,minz,' + \
-            'maxx,maxy,maxz,timestampstart,timestampend,timestart,timeend\n')
-        
-        foTracking.write('frame,relframe,trajectory,timestamp,time,takeoffTraj,x,y,z\n')
-
-        for frame in util.readYFrames(file):
+            foTracking.write('frame,relframe,trajectory,timestamp,time,takeoffTraj,x,y,z\n')
+
+        # Yframes are decoded in batches (or read from the frame store)
+        batches = []
+        if lastFrame > firstFrame:
+            batches = util.MocapBatchIterator(file, startFrame=int(idx.frameIDs[firstFrame]), 
+                numFrames=lastFrame - firstFrame)
+        for batch in batches:
             # Print debug info
-            numRecords += 1
+            numRecords += len(batch.frameIDs)
             if (time() - lastInfoTime) > 5.0:
                 lastInfoTime = time()
                 print( (dbgHeader + str(numRecords) +
-                    " frames [{0:.2f}%], " + str(len(openTrajectories)) +
+                    " frames [{0:.2f}%], " + str(len(linker)) +
                     " open traj").format(numRecords*100.0/totalNumRecords) )
 
-            # Find corresponding trajectory index 
-            minDist = 1e6
-            t = -1
-            i = 0
-            while i < len(openTrajectories):
-                # Check if trajectory timed out
-                if frame.frame - openTrajectories[i][-1].frame > TRAJ_TIMEOUT:
-                    takeoffID = processTrajectory(openTrajectories[i], foPerches, foTakeoffs, foTracking, foFsDbg, takeoffID, flysim)
-                    del openTrajectories[i]
-                else:
-                    # If not, evaluate whether it's the closest one
-                    d = np.linalg.norm(frame.pos - openTrajectories[i][-1].pos)
-                    if d < minDist:
-                        minDist = d
-                        t = i
-                    i+=1
-            
-            # add data to existing or new trajectory
-            p = None
-            if t != -1 and minDist < TRAJ_MAXDIST:
-                p = util.updateYFrame(frame, trajectory=openTrajectories[t][-1].trajectory)
-                openTrajectories[t].append( p )
-            else:
-                trajectoryID += 1
-                p = util.updateYFrame(frame, trajectory=trajectoryID)
-                openTrajectories.append([p,])
+            # Link the Yframes to trajectories, and process the trajectories that have finished
+            numYframes = np.diff(batch.yframeOffsets)
+            for trajectory in linker.addYframes(np.repeat(batch.frameIDs, numYframes), 
+                    np.repeat(batch.times, numYframes), batch.yframePositions):
+                takeoffID = processTrajectory(trajectory, foPerches, foTakeoffs, foTracking, foFsDbg, takeoffID, flysim)
+        
+        # Save the open trajectories, so the next run can continue from here
+        for fo in [foPerches, foTakeoffs, foTracking, foFsDbg]:
+            fo.flush()
+        util.saveCheckpoint(file, 'perching', lastFrame, outputs, 
+            (linker, takeoffID), final=not incremental)
         
         # Process remaining open trajectories
-        for t in openTrajectories:
-            takeoffID = processTrajectory(t, foPerches, foTakeoffs, foTracking, foFsDbg, takeoffID, flysim)
+        if not incremental:
+            for trajectory in linker.flush():
+                takeoffID = processTrajectory(trajectory, foPerches, foTakeoffs, foTracking, foFsDbg, takeoffID, flysim)
     
     # Done
     gc.collect()
@@ -332,14 +599,15 @@ def run(async=False, settings=None):
 
         if not DEBUG:
             if len(settings.files) == 1:
-                processFile(settings.files[0])
+                processFile(settings.files[0], settings.incremental)
             else:
                 with multiprocessing.Pool(processes=16) as pool:
-                    (pool.map_async if async else pool.map)(processFile, settings.files)
+                    (pool.starmap_async if async else pool.starmap)(processFile, 
+                        [(file, settings.incremental) for file in settings.files])
                     return pool
         else:
             for file in settings.files:
-                processFile(file)
+                processFile(file, settings.incremental)
 
     return None
 
@@ -13,9 +13,9 @@ if __name__ == "__main__":
 # Imports for this script
 # =======================================================================================
 
-import msgpack
 import numpy as np
-import math, os, multiprocessing, warnings
+import math, os, warnings
+from shared import util, artifacts
 
 # Debug switch
 DEBUG = False
@@ -23,6 +23,9 @@ DEBUG = False
 # Set "overwrite" to True to overwrite existing files
 OVERWRITE = False
 
+# Version of the outputs
+VERSION = 1
+
 # Reference vectors
 vZenith = np.array( [0 , 0 , 1] )
 vX      = np.array( [1 , 0 , 0] )
@@ -43,11 +46,49 @@ def findPerchRangeIdx(frame, perchRanges, lastPerchRange):
                 return i
     return -1
 
-def processFile(file):
+# Compute the orientation of every Yframe in a batch of frames
+def processBatch(batch, filename, perchRanges):
+    lines = []
+    lastPerchRange = -1
+    # Skip Yframes whose position is NaN, or that don't have all markers
+    numMarkers = np.diff(batch.markerOffsets)[batch.yframeBodies]
+    valid = ~np.any(np.isnan(batch.yframePositions), axis=1) & (numMarkers >= 3)
+    frameOfYframe = util._rowOwners(batch.yframeOffsets)
+    for j in np.flatnonzero(valid):
+        try:
+            # Get frame index
+            frameIdx = int(batch.frameIDs[frameOfYframe[j]])
+            name = batch.bodyNames[batch.bodyNameIDs[batch.yframeBodies[j]]]
+            # Find the perch block this frame is in
+            perchRangeIdx = findPerchRangeIdx(frameIdx, perchRanges, lastPerchRange)
+            if perchRangeIdx != -1: lastPerchRange = perchRangeIdx
+            # Position and 3D Yframe points
+            pos = batch.yframePositions[j]
+            pts = [np.array(y) for y in batch.yframeVertices[j]]
+            markers = [list(y) for y in batch.yframeVertices[j]]
+            # Compute the YFrame primary axis
+            axis1   = pts[1]  - (.5 * pts[0] + .5 * pts[2])
+            axis1_h = (axis1[0], axis1[1], 0)
+            # Compute the YFrame secondary axis
+            axis2 = pts[0] -  pts[2]
+            # Normalize axes
+            axis1   /= np.linalg.norm(axis1)
+            axis1_h /= np.linalg.norm(axis1_h)
+            axis2   /= np.linalg.norm(axis2)
+            # Compute angles
+            angleAltitude = math.acos(np.dot( vZenith, axis1   ))
+            angleAzimuth  = math.acos(np.dot( vX     , axis1_h ))
+            # Save
+            lines.append(','.join([filename, name, str(frameIdx), str(perchRangeIdx)] + [str(y) for y in list(pos) + 
+                list(axis1) + list(axis2) + [angleAltitude, angleAzimuth] + perchRanges[perchRangeIdx] + list(markers[0]) + list(markers[1]) + list(markers[2]) ]) + '\n')
+        except Exception as e:
+            print("error...")
+    return ''.join(lines)
+
+def processFile(file, numProcesses=None):
 
     outfile   = file.replace('.msgpack','.angles.csv')
     perchfile = file.replace('.msgpack','.perches.csv')
-    i = 0
 
     # Suppress errors relating to "mean of empty slice" due to frames with only NaNs
     warnings.simplefilter("ignore", category=RuntimeWarning)
@@ -58,66 +99,25 @@ def processFile(file):
         if os.path.isfile(perchfile):
             with open(perchfile, 'r') as fp:
                 perchRanges = [ [int(y) for y in x.split(',')[10:12]] for x in fp.read().split('\n')]
-        lastPerchRange = -1
-        # Start processing
-        with open(outfile , 'w') as fo:
-            with open(file,'rb') as f:
-                filename = file
-                if '/' in filename:
-                    filename = filename[filename.rfind('/')+1:]
-                for x in msgpack.Unpacker(f):
-                    try:
-                        if not isinstance(x, int):
-                            for b in x[2]:
-                                if "Yframe" in str(b[0]):
-                                    # Get frame index
-                                    frameIdx = x[0]
-                                    # Find the perch block this frame is in
-                                    perchRangeIdx = findPerchRangeIdx(frameIdx, perchRanges, lastPerchRange)
-                                    if perchRangeIdx != -1: lastPerchRange = perchRangeIdx
-                                    # Markers
-                                    markers = [[z if z!=CORTEX_NAN else float('NaN') for z in y] for y in b[1]]                                
-                                    # Position
-                                    pos = np.nanmean(markers, axis=0)
-                                    # Skip if position is NaN
-                                    if len([x for x in pos if math.isnan(x)]) > 0: continue
-                                    # Gather 3D Yframe points
-                                    pts = [np.array([z if z!=CORTEX_NAN else float('NaN') for z in y]) 
-                                        for y in b[1]]
-                                    # Compute the YFrame primary axis
-                                    axis1   = pts[1]  - (.5 * pts[0] + .5 * pts[2])
-                                    axis1_h = (axis1[0], axis1[1], 0)
-                                    # Compute the YFrame secondary axis
-                                    axis2 = pts[0] -  pts[2]
-                                    # Normalize axes
-                                    axis1   /= np.linalg.norm(axis1)
-                                    axis1_h /= np.linalg.norm(axis1_h)
-                                    axis2   /= np.linalg.norm(axis2)
-                                    # Compute angles
-                                    angleAltitude = math.acos(np.dot( vZenith, axis1   ))
-                                    angleAzimuth  = math.acos(np.dot( vX     , axis1_h ))
-                                    # Save
-                                    fo.write(','.join([filename, str(b[0].decode('utf8')), str(frameIdx), str(perchRangeIdx)] + [str(y) for y in list(pos) + 
-                                        list(axis1) + list(axis2) + [angleAltitude, angleAzimuth] + perchRanges[perchRangeIdx] + list(markers[0]) + list(markers[1]) + list(markers[2]) ]) + '\n')
-                    except Exception as e:
-                        print("error...")
-                    
-                    i+=1
-                    if ((i%1000000)==0): 
-                        print("Processed "+str(i)+" frames.")
+        # Start processing (frames are decoded in parallel, and written in order)
+        with artifacts.openArtifact(outfile) as fo:
+            filename = file
+            if '/' in filename:
+                filename = filename[filename.rfind('/')+1:]
+            for lines in util.scanMocapFile(file, processBatch, args=(filename, perchRanges), 
+                    numProcesses=numProcesses, verbose=True):
+                fo.write(lines)
 
 def run(async=False):
     files = [x for x in os.listdir('./') if x.endswith('.msgpack')]
 
+    # Note: Each file is scanned by all cores (see util.scanMocapFile), so files are processed 
+    # one at a time
     if DEBUG:
-        processFile(files[0])
+        processFile(files[0], numProcesses=1)
     else:
-        if len(settings.files) == 1:
-            processFile(settings.files[0])
-        else:
-            with multiprocessing.Pool(processes=16) as pool:
-                (pool.map_async if async else pool.map)(processFile, files)
-                return pool
+        for file in files:
+            processFile(file)
     
 if __name__ == '__main__':    
     run()
@@ -18,9 +18,12 @@ if __name__ == "__main__":
 
 import msgpack, json
 import datetime, time, re
+import mmap, struct
+import collections, queue
+import numpy as np
 import sqlite3
-import subprocess, shutil
-from multiprocessing import Pool, cpu_count
+import shutil
+from multiprocessing import Pool, Process, Queue, Event, cpu_count
 from shared import util
 
 # Directory to search for Cortex data
@@ -33,14 +36,167 @@ DEBUG_FILE = ''
 # Use non-parallel processing to allow debugging
 DEBUG = False
 
-#
-CONVERTER_EXE = os.path.abspath(os.path.join(
-    os.path.dirname(os.path.abspath(__file__)),'../bin/cortex-raw-utils.exe'))
+# Version of the outputs
+VERSION = 1
 
 #
 MAX_RAW_TIME_MISMATCH = 10 # 10 seconds max mismatch (average mismatch appears to be ~0.4 seconds,
                            # although in the evening (or other times?) there is sometimes a ~4 second mismatch...
 
+# Number of mocap frames joined with the raw camera data at a time
+RAW_JOIN_BATCH_SIZE = 10000
+
+# Number of rows sent to the vc.sqlite writer process at a time, and the number of rows 
+# committed per transaction
+VC_ROW_BATCH_SIZE = 10000
+VC_TRANSACTION_SIZE = 1000000
+
+# Seconds a worker waits for room in the queue to the writer before checking that the writer 
+# is still running
+VC_QUEUE_TIMEOUT = 10
+
+# =======================================================================================
+# Read raw camera data (.vcN files)
+# =======================================================================================
+
+# Note: This is a port of the .vc reader in cortex-raw-utils (see VC_File_Reading.cpp and the 
+#       "VC File Format" document in cortex-raw), so the files can be read directly 
+#       (on any OS) instead of converting them to JSON first. The file is memory-mapped, the 
+#       frames are found with a single pass over the frame headers, and all centroid blocks 
+#       are then gathered at once with numpy.
+#
+#       The file starts with a header of (key, count) items, followed by "count" 32-bit 
+#       words each. Each frame is preceded by one or more zero words, followed by a word 
+#       with the data type (byte 1) and the frame index (bytes 2-3). Centroid frames are 
+#       followed by the number of centroids (int32) and the centroids themselves (x and y 
+#       as float32, and q as uint32, where bits 0-15 are the quality and bits 16-27 the 
+#       number of pixels). As in cortex-raw-utils, reading stops at the first frame with an 
+#       index >= the number of requested frames, and only the first VC_MAX_CENTROIDS 
+#       centroids of a frame are kept.
+
+VC_CENTROID_DTYPE = np.dtype([('x', '<f4'), ('y', '<f4'), ('q', '<u4')])
+VC_MAX_CENTROIDS = 1024
+
+# Header keys and frame data types
+VC_KEY_CPUFORMAT = 0x0101
+VC_KEY_TYPE = 0x0102
+VC_KEY_CAMRATE = 0x0103
+VC_KEY_PROCRATE = 0x0104
+VC_KEY_MAXXY = 0x0105
+VC_KEY_REQUESTEDFRAMES = 0x0115
+VC_DATA_EDGES = 1
+VC_DATA_CENTROIDS = 2
+VC_DATA_RAWEDGES = 8
+
+# Frames of a .vc file. The centroids of frame i are centroids[offsets[i]:offsets[i+1]]
+VCFile = collections.namedtuple('VCFile', 'width height fps frames offsets centroids')
+
+def readVCHeader(buf):
+    if len(buf) < 12 or struct.unpack_from('<II', buf, 0) != (0, 0xFFFFFFFF):
+        raise Exception("Invalid .vc file header")
+    header = {'cpuFormat': 0, 'type': 0, 'camRate': 0.0, 'procRate': 0.0,
+              'width': 0, 'height': 0, 'numFrames': 0}
+    pos = 12
+    while pos + 4 <= len(buf):
+        key, count = struct.unpack_from('<HH', buf, pos)
+        pos += 4
+        if key == 0 and count == 0:
+            break
+        # The CPU format key is special: the count is part of the value (0x0101)
+        if key == VC_KEY_CPUFORMAT:
+            header['cpuFormat'] = buf[pos]
+            count = 1
+        elif key == VC_KEY_TYPE:
+            # The type is stored in the second byte of the first word
+            header['type'] = buf[pos + 1]
+        elif key == VC_KEY_CAMRATE:
+            header['camRate'] = struct.unpack_from('<f', buf, pos)[0]
+        elif key == VC_KEY_PROCRATE:
+            header['procRate'] = struct.unpack_from('<f', buf, pos)[0]
+        elif key == VC_KEY_MAXXY:
+            header['width'], header['height'] = struct.unpack_from('<HH', buf, pos)
+        elif key == VC_KEY_REQUESTEDFRAMES:
+            hi, lo = struct.unpack_from('<HH', buf, pos)
+            header['numFrames'] = (hi << 16) | lo
+        pos += 4 * count
+    if header['cpuFormat'] != 1:
+        raise Exception("Only little-endian .vc files are supported")
+    if header['width'] == 0 or header['height'] == 0:
+        raise Exception("Invalid .vc file dimensions")
+    # The camera rate should always be set, but fall back to the processing rate just in case
+    if header['camRate'] <= 0:
+        header['camRate'] = header['procRate']
+    if header['camRate'] <= 0:
+        raise Exception("Invalid .vc file frame rate")
+    return header, pos
+
+def readVCFile(fname):
+    with open(fname, 'rb') as f:
+        # Empty files can't be memory-mapped
+        if os.fstat(f.fileno()).st_size == 0:
+            raise Exception("Empty .vc file: " + fname)
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        header, pos = readVCHeader(buf)
+
+        # Find the frames (and their centroid blocks)
+        frames, starts, counts = [], [], []
+        size = len(buf)
+        while pos + 4 <= size:
+            # Skip the zero words between frames
+            events, dataType, frame = struct.unpack_from('<BBH', buf, pos)
+            if events == 0 and dataType == 0 and frame == 0:
+                pos += 4
+                continue
+            if frame >= header['numFrames']:
+                break
+            pos += 4
+            
+            n = 0
+            if dataType == VC_DATA_CENTROIDS and pos + 4 <= size:
+                numCentroids = struct.unpack_from('<i', buf, pos)[0]
+                pos += 4
+                if numCentroids > 0:
+                    n = min(numCentroids, VC_MAX_CENTROIDS)
+                    if pos + n * VC_CENTROID_DTYPE.itemsize > size:
+                        n = 0
+                    else:
+                        starts.append(pos)
+                    pos += numCentroids * VC_CENTROID_DTYPE.itemsize
+            elif dataType == VC_DATA_EDGES and header['type'] == VC_DATA_EDGES and pos + 4 <= size:
+                blockSize = struct.unpack_from('<H', buf, pos + 2)[0]
+                pos += 4 + 2 * max(0, 2 * blockSize - 6)
+            elif dataType == VC_DATA_EDGES and header['type'] == VC_DATA_RAWEDGES:
+                # Raw edges end with two zero (16-bit) words
+                end = buf.find(b'\x00\x00', pos)
+                while end >= 0 and (end - pos) % 2 != 0:
+                    end = buf.find(b'\x00\x00', end + 1)
+                pos = size if end < 0 else end + 4
+            frames.append(frame)
+            counts.append(n)
+
+        # Gather all centroids
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        # (by the byte offset of each centroid, taken from a view of the file with a record 
+        # starting at every byte)
+        counts = np.array([x for x in counts if x > 0], dtype=np.int64)
+        starts = np.array(starts, dtype=np.int64)
+        itemSize = VC_CENTROID_DTYPE.itemsize
+        idx = np.arange(counts.sum(), dtype=np.int64) * itemSize
+        if len(idx) > 0:
+            idx += np.repeat(starts - (np.cumsum(counts) - counts) * itemSize, counts)
+        fileBytes = np.frombuffer(buf, dtype=np.uint8)
+        records = np.lib.stride_tricks.as_strided(fileBytes, 
+            shape=(max(0, len(fileBytes) - itemSize + 1), itemSize), strides=(1, 1))
+        centroids = records[idx].view(VC_CENTROID_DTYPE).reshape(-1)
+        del fileBytes, records
+    finally:
+        buf.close()
+    
+    return VCFile(header['width'], header['height'], header['camRate'], 
+        np.array(frames, dtype=np.int64), offsets, centroids)
+
 # =======================================================================================
 # Convert entire cortex directory to SQLite and/or csv file
 # =======================================================================================
@@ -54,7 +210,99 @@ def openVCDB(outputDir):
     c = conn.cursor()
     return conn, c, existed
 
-def extractVCFile(capFileIdx, capFile, outputDir):
+# Note: Centroids are stored in the vc table as a BLOB: the width and height of the camera 
+#       (2 x int32), followed by the centroids exactly as they are stored in the .vc file 
+#       (VC_CENTROID_DTYPE). This is several times smaller than JSON, and can be decoded 
+#       without copying. Databases with JSON centroids (created before this change) can 
+#       still be read.
+
+def encodeCentroids(width, height, centroids):
+    return np.array([width, height], dtype='<i4').tobytes() + \
+        np.asarray(centroids, dtype=VC_CENTROID_DTYPE).tobytes()
+
+# Returns width, height and the centroids (as a VC_CENTROID_DTYPE array)
+def decodeCentroids(value):
+    if isinstance(value, str):
+        js = json.loads(value)
+        return js["width"], js["height"], np.array(
+            [(c["x"], c["y"], c["q"]) for c in js["centroids"]], dtype=VC_CENTROID_DTYPE)
+    width, height = np.frombuffer(value, dtype='<i4', count=2).tolist()
+    return width, height, np.frombuffer(value, dtype=VC_CENTROID_DTYPE, offset=8)
+
+# Note: Capture files are parsed by a pool of worker processes, which send the rows in 
+#       batches (of VC_ROW_BATCH_SIZE) to a single writer process, so the workers never wait 
+#       for each other to get a lock on the database. The writer uses WAL mode and large 
+#       transactions, and only creates the indices once all rows have been inserted.
+#
+#       As the writer is the only connection, it holds an exclusive lock (so WAL doesn't need 
+#       shared memory, which doesn't work on network drives), and the database is switched 
+#       back to the default journal mode when done.
+#
+#       If a worker or the writer fails, the others are stopped (the writer is sent None, and
+#       workers stop once the writer has), and the partially written database is deleted, so 
+#       it is extracted again on the next run.
+
+def createVCIndices(c):
+    c.execute('CREATE INDEX IF NOT EXISTS i1 ON vc (frameID)')
+    c.execute('CREATE INDEX IF NOT EXISTS i2 ON vc (timestampPOSIX)')
+    c.execute('CREATE INDEX IF NOT EXISTS i3 ON vc (cameraID)')
+
+# Writer process, inserts batches of rows from the queue until it receives None
+def writeVC(outputDir, rows, stopped):
+    try:
+        _writeVC(outputDir, rows)
+    finally:
+        stopped.set()
+
+def _writeVC(outputDir, rows):
+    conn, c, dbExisted = openVCDB(outputDir)
+    c.execute('PRAGMA locking_mode=EXCLUSIVE')
+    c.execute('PRAGMA journal_mode=WAL')
+    c.execute('PRAGMA synchronous=NORMAL')
+
+    t0 = time.time()
+    numRows, numRowsCommitted = 0, 0
+    while True:
+        batch = rows.get()
+        if batch is None:
+            break
+        c.executemany('insert into vc (frameID, timestampPOSIX, cameraID, centroids, capfile) values (?,?,?,?,?)', batch)
+        numRows += len(batch)
+        if numRows - numRowsCommitted >= VC_TRANSACTION_SIZE:
+            conn.commit()
+            numRowsCommitted = numRows
+            print("Wrote "+str(numRows)+" rows to vc.sqlite ("+
+                  '{:.0f}'.format(numRows / (time.time() - t0))+" rows/s)")
+    conn.commit()
+    print("Wrote "+str(numRows)+" rows to vc.sqlite in "+'{:.1f}'.format(time.time() - t0)+" s, creating indices...")
+
+    # Create indices after the bulk load
+    createVCIndices(c)
+    conn.commit()
+    c.execute('PRAGMA journal_mode=DELETE')
+    conn.close()
+    print("Done writing vc.sqlite ("+'{:.1f}'.format(time.time() - t0)+" s)")
+
+# Queue to the writer process, and the event that is set once the writer has stopped (set 
+# for each worker process)
+_vcRows = None
+_vcWriterStopped = None
+
+def initVCWorker(rows, writerStopped):
+    global _vcRows, _vcWriterStopped
+    _vcRows = rows
+    _vcWriterStopped = writerStopped
+
+def putVCRows(batch):
+    while True:
+        try:
+            _vcRows.put(batch, timeout=VC_QUEUE_TIMEOUT)
+            return
+        except queue.Full:
+            if _vcWriterStopped.is_set():
+                raise Exception("The vc.sqlite writer has stopped")
+
+def extractVCFile(capFileIdx, capFile):
     # Find raw camera data filename
     rawCameraDataFile = ''
     with open(capFile,'r') as f:
@@ -86,6 +334,11 @@ def extractVCFile(capFileIdx, capFile, outputDir):
     
     # Try all cameras (this script checks for the presence of up to 64 cameras)
     sqliteCache = []
+    def flush():
+        if len(sqliteCache) > 0:
+            putVCRows(list(sqliteCache))
+            sqliteCache.clear()
+
     for camID in range(1,64):
         # Construct the actual filename for each camera
         vcFile = rawCameraDataFile.replace('.vc1','.vc'+str(camID))
@@ -94,70 +347,109 @@ def extractVCFile(capFileIdx, capFile, outputDir):
         if not os.path.isfile(vcFile):
             continue
 
-        # Use external C application to convert raw VC files to .json format
-        rawCameraDataFileConverted = vcFile + '.json'
+        # Read the raw camera data
         try:
-            subprocess.check_output([CONVERTER_EXE, vcFile, rawCameraDataFileConverted])
-        except:
-            print("Error running file conversion tool for file: " + vcFile)
+            vc = readVCFile(vcFile)
+        except Exception as e:
+            print("Error reading file: " + vcFile + " (" + str(e) + ")")
+            continue
 
-        # Read this json data
-        try:
-            data = None
-            with open(rawCameraDataFileConverted,'r') as f:
-                data = json.load(f)
-
-            # delete the temporary .json file
-            os.remove(rawCameraDataFileConverted)
-
-            # Loop through each frame
-            for x in data:
-                # Estimate time that this frame arrived... This is very approximate (could be e.g. many seconds off), but should be
-                # precise enough to disambiguate identical frameIDs that correspond to different re-starts.
-                estimatedTime = startTime + datetime.timedelta(
-                    seconds = x["frame"] / x["fps"] )
-                estimatedTime = time.mktime(estimatedTime.timetuple())
-
-                # Add to database (TODO: Is the "-1" in frame computation correct?)
-                sqliteCache.append( [startFrame + x["frame"] - 1, estimatedTime, camID, json.dumps(x), capFile] )
-        except:
-            print("Error converting file: " + vcFile)
+        # The centroids are stored as-is, so the BLOBs can be sliced from the raw bytes
+        header = encodeCentroids(vc.width, vc.height, [])
+        centroidBytes = vc.centroids.tobytes()
+        offsets = (vc.offsets * VC_CENTROID_DTYPE.itemsize).tolist()
+
+        # Loop through each frame
+        for i, frame in enumerate(vc.frames.tolist()):
+            # Estimate time that this frame arrived... This is very approximate (could be e.g. many seconds off), but should be
+            # precise enough to disambiguate identical frameIDs that correspond to different re-starts.
+            estimatedTime = startTime + datetime.timedelta(
+                seconds = frame / vc.fps )
+            estimatedTime = time.mktime(estimatedTime.timetuple())
+
+            # Add to database (TODO: Is the "-1" in frame computation correct?)
+            sqliteCache.append( [startFrame + frame - 1, estimatedTime, camID, 
+                header + centroidBytes[offsets[i]:offsets[i+1]], capFile] )
+            if len(sqliteCache) >= VC_ROW_BATCH_SIZE:
+                flush()
 
         # Status update
         print("Converted capture file "+str(capFileIdx)+" cam file "+str(camID))
 
-    # Commit all data to DB
-    conn, c, dbExisted = openVCDB(outputDir)
-    c.executemany('insert into vc (frameID, timestampPOSIX, cameraID, centroids, capfile) values (?,?,?,?,?)', sqliteCache)
-    conn.commit()
-    conn.close()
+    # Send the remaining rows to the writer
+    flush()
+
+# Delete the database (and its journal files)
+def removeVCDB(outputDir):
+    for x in ['', '-wal', '-shm', '-journal']:
+        if os.path.exists(os.path.join(outputDir, 'vc.sqlite' + x)):
+            os.remove(os.path.join(outputDir, 'vc.sqlite' + x))
 
-def extractVC(directoryPath, outputDir):
+# Convert the capture files in one or more directories
+def extractVC(directoryPaths, outputDir):
+    if isinstance(directoryPaths, str):
+        directoryPaths = [directoryPaths, ]
 
-    # If the DB was just created, initialize it
+    # If the DB was just created, initialize it (indices are created by the writer)
     conn, c, dbExisted = openVCDB(outputDir)
     if not dbExisted:
         c.execute('''CREATE TABLE vc
-                     (frameID integer, timestampPOSIX integer, cameraID integer, centroids TEXT, capfile TEXT)''')
-        c.execute('CREATE INDEX i1 ON vc (frameID)')
-        c.execute('CREATE INDEX i2 ON vc (timestampPOSIX)')
-        c.execute('CREATE INDEX i3 ON vc (cameraID)')
+                     (frameID integer, timestampPOSIX integer, cameraID integer, centroids BLOB, capfile TEXT)''')
         conn.commit()
     conn.close()
 
     # Get a list of all capture files
-    cortexCapFiles = [os.path.join(directoryPath,x) for x in \
+    cortexCapFiles = [os.path.join(directoryPath,x) for directoryPath in directoryPaths for x in \
         os.listdir(directoryPath) if x.endswith('.cap')]
 
+    # Start the writer process
+    numWorkers = max(1, cpu_count() - 1)
+    rows = Queue(maxsize=4 * numWorkers)
+    writerStopped = Event()
+    writer = Process(target=writeVC, args=(outputDir, rows, writerStopped))
+    writer.start()
+
     # Now process each capture file
-    params = [[i,f,outputDir] for i,f in zip(range(len(cortexCapFiles)), cortexCapFiles, )]
-    if not DEBUG:
-        with Pool(cpu_count()) as pool:
-            pool.starmap(extractVCFile, params)
-    else:
-        for param in params:
-            extractVCFile(param[0], param[1], param[2])
-    
+    params = [[i,f] for i,f in zip(range(len(cortexCapFiles)), cortexCapFiles, )]
+    success = False
+    try:
+        if not DEBUG:
+            with Pool(numWorkers, initVCWorker, (rows, writerStopped)) as pool:
+                result = pool.starmap_async(extractVCFile, params)
+                while not result.ready():
+                    result.wait(VC_QUEUE_TIMEOUT)
+                    # (the writer can also be killed without setting the event)
+                    if not writer.is_alive():
+                        writerStopped.set()
+                # Raises the exception of a failed worker
+                result.get()
+                # Let the workers exit normally, so they finish sending their rows to the writer 
+                # (terminating them could leave a partially sent batch in the queue)
+                pool.close()
+                pool.join()
+        else:
+            initVCWorker(rows, writerStopped)
+            for param in params:
+                extractVCFile(param[0], param[1])
+        success = True
+    finally:
+        # Wait for the writer to finish
+        while writer.is_alive():
+            try:
+                rows.put(None, timeout=VC_QUEUE_TIMEOUT)
+                break
+            except queue.Full:
+                pass
+        if not success:
+            # (rows that the writer will never read mustn't keep this process from exiting)
+            rows.cancel_join_thread()
+        writer.join()
+        if not success or writer.exitcode != 0:
+            # Delete the partially written database, so it is extracted again
+            removeVCDB(outputDir)
+    if writer.exitcode != 0:
+        raise Exception("Error writing to vc.sqlite in " + outputDir)
+
     # Done!
     return
 
@@ -200,11 +492,145 @@ def getCalibrationFile(capFile, dataFile):
         # Done!
         return calFileName
     
+# =======================================================================================
+# Join mocap frames with the raw camera data
+# =======================================================================================
+
+# Note: Rather than querying the database for every single mocap frame, the vc table is read 
+#       in blocks sorted by time, alongside the (time-ordered) mocap frames. The rows that 
+#       are within MAX_RAW_TIME_MISMATCH of a batch of mocap frames are kept in a sliding 
+#       window, and are matched to the frames by frame ID. For every frame, the row with the 
+#       closest timestamp is chosen for each camera (ties are broken by rowid, as in the 
+#       original per-frame query). 
+
+class VCWindow:
+    def __init__(self, c):
+        self.c = c
+        self.rowids = np.zeros(0, dtype=np.int64)
+        self.frameIDs = np.zeros(0, dtype=np.int64)
+        self.times = np.zeros(0, dtype=np.float64)
+        self.cameraIDs = np.zeros(0, dtype=np.int64)
+        self.centroids = []
+        self.capFiles = []
+        self.tMin = None
+        self.tMax = None
+
+    # Make sure all rows with a timestamp in [tMin, tMax) are loaded (and no rows before tMin)
+    def load(self, tMin, tMax):
+        if self.tMin is None or tMin < self.tMin or tMin >= self.tMax:
+            self.set([], tMin)
+        else:
+            keep = np.searchsorted(self.times, tMin, side='left')
+            self.set(range(keep, len(self.times)), tMin)
+
+        if tMax > self.tMax:
+            rows = self.c.execute('select rowid, frameID, timestampPOSIX, cameraID, centroids, capfile '
+                'from vc where timestampPOSIX>=? and timestampPOSIX<? ORDER BY timestampPOSIX ASC', 
+                [self.tMax, tMax]).fetchall()
+            self.rowids    = np.concatenate((self.rowids,    np.array([x[0] for x in rows], dtype=np.int64)))
+            self.frameIDs  = np.concatenate((self.frameIDs,  np.array([x[1] for x in rows], dtype=np.int64)))
+            self.times     = np.concatenate((self.times,     np.array([x[2] for x in rows], dtype=np.float64)))
+            self.cameraIDs = np.concatenate((self.cameraIDs, np.array([x[3] for x in rows], dtype=np.int64)))
+            self.centroids += [x[4] for x in rows]
+            self.capFiles  += [x[5] for x in rows]
+            self.tMax = tMax
+
+    def set(self, idx, tMin):
+        idx = np.array(idx, dtype=np.int64)
+        self.rowids, self.frameIDs = self.rowids[idx], self.frameIDs[idx]
+        self.times, self.cameraIDs = self.times[idx], self.cameraIDs[idx]
+        self.centroids = [self.centroids[i] for i in idx]
+        self.capFiles = [self.capFiles[i] for i in idx]
+        self.tMin = tMin
+        if len(idx) == 0:
+            self.tMax = tMin
+
+    # Match mocap frames (original Cortex frame IDs, times in seconds) to the rows in the 
+    # window. Returns, for each frame, the time mismatch of the closest row with its frame ID 
+    # (or None), the number of rows within MAX_RAW_TIME_MISMATCH and the matched rows (by 
+    # increasing mismatch)
+    def match(self, frameIDs, frameTimes):
+        # All (frame, row) pairs with the same frame ID
+        order = np.argsort(self.frameIDs, kind='mergesort')
+        lo = np.searchsorted(self.frameIDs[order], frameIDs, side='left')
+        counts = np.searchsorted(self.frameIDs[order], frameIDs, side='right') - lo
+        frames = np.repeat(np.arange(len(frameIDs)), counts)
+        rows = order[np.arange(len(frames)) - np.repeat(np.cumsum(counts) - counts - lo, counts)]
+        
+        # Sort by frame, then by time mismatch
+        dt = self.times[rows] - frameTimes[frames]
+        i = np.lexsort((self.rowids[rows], np.abs(dt), frames))
+        frames, rows, dt = frames[i], rows[i], dt[i]
+
+        closest = [None] * len(frameIDs)
+        first = np.flatnonzero(np.diff(np.concatenate(([-1], frames))) != 0)
+        for f, d in zip(frames[first].tolist(), dt[first].tolist()):
+            closest[f] = d
+
+        # The closest row of a frame may lie outside the window, if there is none within 
+        # MAX_RAW_TIME_MISMATCH (it is never matched, but its mismatch is written to the .dbg file)
+        for f in range(len(frameIDs)):
+            if closest[f] is None or abs(closest[f]) >= MAX_RAW_TIME_MISMATCH:
+                row = self.c.execute('select timestampPOSIX from vc where frameID=? '
+                    'ORDER BY ABS(timestampPOSIX-?) ASC LIMIT 1', 
+                    [int(frameIDs[f]), float(frameTimes[f])]).fetchone()
+                if row is not None:
+                    closest[f] = row[0] - float(frameTimes[f])
+
+        # Only keep the closest row for each camera, within MAX_RAW_TIME_MISMATCH
+        valid = np.abs(dt) < MAX_RAW_TIME_MISMATCH
+        numValid = np.bincount(frames[valid], minlength=len(frameIDs))
+        frames, rows = frames[valid], rows[valid]
+        _, first = np.unique(np.stack((frames, self.cameraIDs[rows])), axis=1, return_index=True)
+        first = np.sort(first)
+        matches = [[] for i in range(len(frameIDs))]
+        for f, r in zip(frames[first].tolist(), rows[first].tolist()):
+            matches[f].append(r)
+
+        return closest, numValid, matches
+
+def joinRawFrames(frames, window, dataFile, fOut, fOutDbg):
+    # Recover the original Cortex frameID (first 24 bits)
+    frameIDs = np.array([x[0] for x in frames], dtype=np.int64) & (2**24 - 1)
+    # Get time (in seconds, hence divide by 1000)
+    frameTimes = np.array([x[5] for x in frames], dtype=np.float64) / 1000
+    
+    # Load the raw data within MAX_RAW_TIME_MISMATCH of these frames
+    window.load(np.min(frameTimes) - MAX_RAW_TIME_MISMATCH, np.max(frameTimes) + MAX_RAW_TIME_MISMATCH)
+    closest, numValid, matches = window.match(frameIDs, frameTimes)
+
+    for frame, frameTime, dt, n, rows in zip(frames, frameTimes.tolist(), closest, numValid, matches):
+        rawData = []
+        if dt is not None:
+            # Print timing mismatch between raw frame found, and frame stored by ArenaAutomation
+            fOutDbg.write( str(dt) + '\n' )
+            if n > len(rows):
+                print("Possible error. Multiple frames with the same frame index "
+                      "occurred within MAX_RAW_TIME_MISMATCH of the XYZ data frame "
+                      "recorded by the ArenaAutomation software... FrameID="+str(frame[0])+
+                      "frameTime="+str(frameTime)+". The closest frame was selected.")
+            # Process each result
+            for r in rows:
+                width, height, centroids = decodeCentroids(window.centroids[r])
+                calFile = getCalibrationFile(window.capFiles[r], dataFile)
+                rawData.append([
+                    int(window.cameraIDs[r]),
+                    width,
+                    height,
+                    centroids.tolist(), 
+                    calFile
+                ])
+
+        # Now, *finally* assign the centroids to the frame (we copy the original dataset, in
+        # order to get a complete reference.)
+        newframe = frame + [rawData,]
+        msgpack.dump(newframe, fOut)
+
 # =======================================================================================
 # Process log
 # =======================================================================================
 
-def processFile(dataFile):
+def processFile(dataFile, incremental=False):
 
     # Get time the current file was modified...
     ctime = re.search('[0-9]{4}-[0-9]{2}-[0-9]{2}', dataFile).group(0)
@@ -215,10 +641,20 @@ def processFile(dataFile):
                 datetime.datetime.fromtimestamp(os.path.getctime(os.path.join(
                     CORTEX_DIR,y))).strftime('%Y-%m-%d') == ctime]
 
+    # Start from scratch if the previous run was an incremental one
+    # Note: vc.sqlite only contains the capture files that existed when it was created, so if 
+    #       it was created by an incremental run, the captures recorded since are missing from 
+    #       it (and from the frames joined so far). The final run thus converts the capture files
+    #       and joins the entire file again.
+    meta = util.readCheckpoint(dataFile, 'raw')
+    if not incremental and meta != None and not meta['final']:
+        print("Discarding the raw camera data of the incremental runs: " + dataFile)
+        util.removeCheckpoint(dataFile, 'raw')
+        removeVCDB(os.path.dirname(dataFile))
+
     # Produce converted files
     if not os.path.exists(os.path.join(os.path.dirname(dataFile), 'vc.sqlite')):
-        for cortexCapDir in cortexCapDirs:
-            extractVC(cortexCapDir, os.path.dirname(dataFile))
+        extractVC(cortexCapDirs, os.path.dirname(dataFile))
 
     # Open output database
     conn, c, _ = openVCDB(os.path.dirname(dataFile))
@@ -226,67 +662,68 @@ def processFile(dataFile):
     # Determine total number of frames to process
     totalToProcess = util.countRecords(dataFile)
 
-    # Now loop through the frames received in the file, and find their corresponding raw camera files
-    counter = 0
+    # Continue from the previous run?
     dataFileOut = dataFile.replace('.msgpack','') + '.raw.msgpack'
     dbgFileOut  = dataFile.replace('.msgpack','') + '.raw.dbg'
+    if incremental and util.isCheckpointCurrent(dataFile, 'raw'):
+        print("Raw camera data is up to date: "+dataFile)
+        return
+    idx = util.openMocapIndex(dataFile)
+    checkpoint = util.loadCheckpoint(dataFile, 'raw', [dataFileOut, dbgFileOut], incremental)
+    firstFrame = checkpoint[0]['numFrames'] if checkpoint != None else 0
+    if checkpoint is None:
+        # The output is written from scratch, so its index (if any) is out of date
+        util.removeCheckpoint(dataFile, 'raw')
+        if os.path.exists(util.getMocapIndexFile(dataFileOut)):
+            os.remove(util.getMocapIndexFile(dataFileOut))
+    
+    # Incremental runs stop at the last indexed frame, as the file may still be growing. Only 
+    # complete batches are joined (as in a single run over the entire file, the raw data within 
+    # MAX_RAW_TIME_MISMATCH of each batch is loaded at once, which is reflected in the .dbg output)
+    numFrames = None
+    lastFrame = len(idx)
+    if incremental:
+        numFrames = RAW_JOIN_BATCH_SIZE * ((len(idx) - firstFrame) // RAW_JOIN_BATCH_SIZE)
+        lastFrame = firstFrame + numFrames
+
+    # Now loop through the frames received in the file, and find their corresponding raw camera files
+    counter = 0
+    window = VCWindow(c)
     with open(dataFile,'rb') as fIn:
-        with open(dataFileOut,'wb') as fOut, open(dbgFileOut, 'w') as fOutDbg:
+        if firstFrame > 0:
+            fIn.seek(int(idx.offsets[firstFrame]) if firstFrame < len(idx) else 
+                util.getMocapIndexEnd(dataFile, idx))
+        with open(dataFileOut,'ab' if firstFrame > 0 else 'wb') as fOut, \
+            open(dbgFileOut, 'a' if firstFrame > 0 else 'w') as fOutDbg:
+            frames = []
             for frame in msgpack.Unpacker(fIn):
-                # Get frame ID
-                frameID = frame[0]
-                # Recover the original Cortex frameID (first 24 bits)
-                originalFrameID = frameID & (2**24 - 1)
-                # Get time (in seconds, hence divide by 1000)
-                frameTime = frame[5] / 1000
-                # Query the raw data
-                results = [x for x in c.execute(
-                    'select frameID, cameraID, timestampPOSIX, centroids, capfile from vc where '+
-                    'frameID=? ORDER BY ABS(timestampPOSIX-?) ASC',
-                        [originalFrameID, frameTime])]
-
-                rawData = []
-                if len(results) > 0:
-                    # Print timing mismatch between raw frame found, and frame stored by ArenaAutomation
-                    fOutDbg.write( str(results[0][2] - frameTime) + '\n' )
-                    # Only keep the data with the closest matching frame
-                    # Note that the resultset is already ordered by the SQL query
-                    nresults = {}
-                    for result in results:
-                        if abs( result[2] - frameTime ) < MAX_RAW_TIME_MISMATCH:
-                            camID = result[1]
-                            if not camID in nresults:
-                                nresults[camID] = result
-                            else:
-                                print("Possible error. Multiple frames with the same frame index "
-                                      "occurred within MAX_RAW_TIME_MISMATCH of the XYZ data frame "
-                                      "recorded by the ArenaAutomation software... FrameID="+frameID+
-                                      "frameTime="+str(frameTime)+". The closest frame was selected.")
-                    # Process each result
-                    for camID, result in nresults.items():
-                        js = json.loads(result[3])
-                        calFile = getCalibrationFile(result[4], dataFile)
-                        rawData.append([
-                            camID,
-                            js["width"],
-                            js["height"],
-                            [[c["x"], c["y"], c["q"]] for c in js["centroids"]], 
-                            calFile
-                        ])
-
-                # Now, *finally* assign the centroids to the frame (we copy the original dataset, in
-                # order to get a complete reference.)
-                newframe = frame + [rawData,]
-                msgpack.dump(newframe, fOut)
-
+                if numFrames != None and counter >= numFrames:
+                    break
+                frames.append(frame)
+                if len(frames) == RAW_JOIN_BATCH_SIZE:
+                    joinRawFrames(frames, window, dataFile, fOut, fOutDbg)
+                    frames = []
+                
                 # Output debug info
                 if (counter%10000) == 0:
-                    print("Gathered raw frame data for "+str(counter)+"/"+str(totalToProcess)+" frames ")
+                    print("Gathered raw frame data for "+str(firstFrame+counter)+"/"+str(totalToProcess)+" frames ")
                 counter += 1
+            
+            if len(frames) > 0:
+                joinRawFrames(frames, window, dataFile, fOut, fOutDbg)
+
+    # Note: The checkpoint is saved before the index of the output is updated, so the index 
+    #       never includes frames that might be truncated by the next run
+    util.saveCheckpoint(dataFile, 'raw', lastFrame, [dataFileOut, dbgFileOut], None, 
+        final=not incremental)
+
+    # Fix indices of newly created file (only the frames added by this run are indexed)
+    util.updateMocapIndex(dataFileOut)
 
-    # Fix indices of newly created file (this is ensured by creating an index, which in turn is
-    # ensured by printing the number of items)
-    util.countRecords(dataFileOut)
+    # Convert the newly created file to a frame store, so the raw centroids can be read back
+    # without decoding the .raw.msgpack file again (not while the file is still growing)
+    if not incremental:
+        util.buildFrameStore(dataFileOut)
 
     # Done!
     pass
@@ -302,17 +739,17 @@ def run(async=False, settings = None):
         if DEBUG_FILE == '' :
             settings = util.askForExtractionSettings()
         else:
-            settings = util.ExtractionSettings([DEBUG_FILE,], False)
+            settings = util.ExtractionSettings([DEBUG_FILE,], False, False)
 
     # Process all log files:
     for file in settings.files:
         if DEBUG_FILE == '':
             try:
-                processFile(file)
+                processFile(file, settings.incremental)
             except Exception as e:
                 print(e)
         else:
-            processFile(file)
+            processFile(file, settings.incremental)
 
 if __name__ == "__main__":
     run()
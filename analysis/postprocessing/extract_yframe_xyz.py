@@ -13,9 +13,8 @@ if __name__ == "__main__":
 # Imports for this script
 # =======================================================================================
 
-import msgpack
 import numpy as np
-import math, os, multiprocessing
+import math, os
 from datetime import datetime
 from shared import util
 
@@ -31,30 +30,42 @@ SINGLE_FILE = "" #"2016-11-11 12-20-41_Cortex.msgpack"
 # Misc. constants
 CORTEX_NAN  = 9999999
 
-def processFile(file):
+# Write one line per ID'ed body in a batch of frames
+def processBatch(batch, filename):
+    # Average the markers of each body
+    bodyIdx = util._rowOwners(batch.markerOffsets)
+    hasValue = ~np.isnan(batch.markers)
+    sums   = np.array([np.bincount(bodyIdx, weights=np.where(hasValue[:,k], batch.markers[:,k], 0), 
+        minlength=len(batch.bodyNameIDs)) for k in range(3)]).T
+    counts = np.array([np.bincount(bodyIdx, weights=hasValue[:,k], 
+        minlength=len(batch.bodyNameIDs)) for k in range(3)]).T
+    with np.errstate(invalid='ignore', divide='ignore'):
+        pos = sums / counts
+    
+    names = [str(n.encode()) for n in batch.bodyNames]
+    lines = []
+    for i in range(len(batch.frameIDs)):
+        # Get time
+        dt = datetime.fromtimestamp(int(batch.times[i])//1000).strftime('%Y-%m-%d %H:%M:%S')
+        # Process ID'ed bodies
+        for b in range(batch.bodyOffsets[i], batch.bodyOffsets[i+1]):
+            lines.append(','.join([dt, filename, names[batch.bodyNameIDs[b]], str(batch.frameIDs[i])] + 
+                [str(y) for y in pos[b]]) + '\n')
+    return ''.join(lines)
+
+def processFile(file, numProcesses=None):
     print("Started file: "+file)
     outfile = file.replace('.msgpack','.xyz.csv')
     try:
         if OVERWRITE or not os.path.isfile( outfile ):
-            i = 0
             with open(outfile, 'w') as fo:
-                with open(file,'rb') as f:
-                    filename = file
-                    if '/' in filename:
-                        filename = filename[filename.rfind('/')+1:]
-                    for x in msgpack.Unpacker(f):
-                        if not isinstance(x, int):
-                            # Get time
-                            dt = datetime.fromtimestamp(x[5]//1000).strftime('%Y-%m-%d %H:%M:%S')
-                            # Process ID'ed bodies
-                            for b in x[2]:
-                                # Extract marker points
-                                pos = np.nanmean([[z if z!=CORTEX_NAN else float('NaN') for z in y] 
-                                    for y in b[1]], axis=0)
-                                fo.write(','.join([dt, filename, str(b[0]), str(x[0])] + [str(y) for y in pos]) + '\n')
-                        i+=1
-                        if ((i%1000000)==0): 
-                            print("[" + file + "] Processed "+str(i)+" frames")
+                filename = file
+                if '/' in filename:
+                    filename = filename[filename.rfind('/')+1:]
+                # Frames are decoded in parallel, and written in order
+                for lines in util.scanMocapFile(file, processBatch, args=(filename,), 
+                        numProcesses=numProcesses, verbose=True):
+                    fo.write(lines)
         else:
             print("Skipping file: "+file)
     except Exception as e:
@@ -62,15 +73,13 @@ def processFile(file):
         os.remove(outfile)
 
 def run(async=False):
+    # Note: Each file is scanned by all cores (see util.scanMocapFile), so files are processed 
+    # one at a time
     if SINGLE_FILE == "":
         settings = util.askForExtractionSettings()    
 
-        if len(settings.files) > 1:
-            with multiprocessing.Pool(processes=12) as pool:
-                (pool.map_async if async else pool.map)(processFile, settings.files)
-                return pool
-        else:
-            processFile(settings.files[0])
+        for file in settings.files:
+            processFile(file)
     else:
         processFile(SINGLE_FILE)
 
@@ -16,17 +16,46 @@ if __name__ == "__main__":
 # Imports for this script
 # =======================================================================================
 
-import msgpack
 import os, multiprocessing, shutil
 import datetime, time
 import sqlite3
+from shared import util
 
 OVERWRITE = False
 
+# Write the corrected frameIDs (unique across Cortex restarts) to the merged file. Either way, 
+# the merged file gets an index with the corrected frameIDs.
+CORRECT_FRAME_IDS = False
+
 # =======================================================================================
 # Process a given day
 # =======================================================================================
 
+# Note: Log files are merged by attaching each part to the merged database, and copying all
+#       rows with a single query.
+
+def mergeLogFiles(files, fnameOut):
+    if os.path.exists(fnameOut):
+        os.remove(fnameOut)
+    connOut = sqlite3.connect(fnameOut)
+    cOut = connOut.cursor()
+    cOut.execute('create table if not exists PLOG (id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp DATETIME, msg TEXT)')
+    for fnameIn in files:
+        cOut.execute('attach database ? as part', (fnameIn, ))
+        cOut.execute('insert into PLOG (timestamp,msg) select timestamp,msg from part.PLOG order by id')
+        connOut.commit()
+        cOut.execute('detach database part')
+    connOut.close()
+
+# Copy a file, unless the copy is already up to date
+# Note: The modification time is copied as well, so the outputs computed from the copy aren't 
+#       recomputed every time update_all is run (see shared/artifacts.py)
+def copyFile(src, dst):
+    if os.path.exists(dst) and os.path.getsize(dst) == os.path.getsize(src) and \
+        os.path.getmtime(dst) == os.path.getmtime(src):
+        return
+    shutil.copy2(src, dst)
+
 def processFile(folderPrefix, dayParts):
     
     # Create the output folder
@@ -36,42 +65,32 @@ def processFile(folderPrefix, dayParts):
     fnameOut    = folderPrefix + '/' + folderPrefix + '.msgpack'
 
     # If there is only one recording during this day, simply copy the data files to the new directory
-    if len(dayParts) == 1:
+    if len(dayParts) == 1 and not CORRECT_FRAME_IDS:
 
         print("Merging daily files (single part, so simple copy): "+folderPrefix)
 
         part = dayParts[0]
-        shutil.copyfile(part+'/'+part+'.msgpack', fnameOut)
-        shutil.copyfile(part+'/'+part+'.log'    , fnameOutLog)
+        copyFile(part+'/'+part+'.msgpack', fnameOut)
+        copyFile(part+'/'+part+'.log'    , fnameOutLog)
+
+        # The index of the part (if any) applies to the copy as well
+        if util.openMocapIndex(part+'/'+part+'.msgpack', createIndexIfNotExists=False) is not None:
+            copyFile(util.getMocapIndexFile(part+'/'+part+'.msgpack'), 
+                util.getMocapIndexFile(fnameOut))
+        elif os.path.exists(util.getMocapIndexFile(fnameOut)):
+            os.remove(util.getMocapIndexFile(fnameOut))
     else:
         print("Merging daily files: "+folderPrefix)
 
         # Join log file
         if not os.path.exists(fnameOutLog) or OVERWRITE:
-            connOut = sqlite3.connect(fnameOutLog)
-            cOut = connOut.cursor()
-            cOut.execute('create table if not exists PLOG (id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp DATETIME, msg TEXT)')
-            for part in dayParts:
-                fnameIn = part+'/'+part+'.log'
-                if os.path.exists(fnameIn):
-                    conn = sqlite3.connect(fnameIn)
-                    c = conn.cursor()
-                    for row in c.execute('select timestamp,msg from PLOG'):
-                        cOut.execute('insert into PLOG (timestamp,msg) values (?,?)', (row[0], row[1]))
-                    connOut.commit()
-                    conn.close()
-            connOut.close()
-
-        # Consolidate the MSGPACK files
+            mergeLogFiles([part+'/'+part+'.log' for part in dayParts if 
+                os.path.exists(part+'/'+part+'.log')], fnameOutLog)
+
+        # Consolidate the MSGPACK files (this also creates the index of the merged file)
         if not os.path.exists(fnameOut) or OVERWRITE:
-            with open(fnameOut,'wb') as fOut:
-                for part in dayParts:
-                    fnameIn = part+'/'+part+'.msgpack'
-                    if os.path.exists(fnameIn):
-                        with open(fnameIn,'rb') as fIn:
-                            unpacker = msgpack.Unpacker(fIn)
-                            for data in unpacker:
-                                fOut.write(msgpack.packb(data))
+            util.mergeMocapFiles([part+'/'+part+'.msgpack' for part in dayParts if 
+                os.path.exists(part+'/'+part+'.msgpack')], fnameOut, CORRECT_FRAME_IDS)
 
 # =======================================================================================
 # 
@@ -0,0 +1,161 @@
+# --------------------------------------------------------
+# Artifact cache for the post-processing outputs
+#
+# Author: Abel Corver
+#         abel.corver@gmail.com
+#         (Anthony Leonardo Lab, Dec. 2016)
+# --------------------------------------------------------
+
+import os, json, hashlib, zlib, contextlib
+import numpy as np
+
+from shared import util
+
+# =======================================================================================
+# Artifact keys
+#
+# Note: Every output (artifact) of a post-processing stage (see shared/pipeline.py) is keyed
+#       on everything it was computed from:
+#
+#         - the identity of each input file (size and modification time, or size and a 
+#           checksum of the frame index for indexed .msgpack files, so that copies of these 
+#           aren't taken to be different files),
+#         - the configuration of the stage: the values of the module constants it declares
+#           as parameters (VERSION, TRAJ_MAXDIST, TRAJ_TIMEOUT, ...),
+#         - whether the run was incremental (incremental runs leave open trajectories etc.
+#           unprocessed, so their outputs aren't the same as those of a final run).
+#
+#       Once a stage has finished, the key and the sizes of its outputs are written to a
+#       manifest (.msgpack.<stage>.artifacts). The outputs are up to date if the manifest
+#       holds the current key, and the outputs still have the recorded sizes. Changing a
+#       parameter (or increasing the VERSION of a module) thus recomputes only the stages
+#       that depend on it, and the stages downstream of them.
+#
+#       Each post-processing module declares a VERSION constant as a parameter of its stage. 
+#       Increase it when changing how the outputs of the module are computed, so update_all 
+#       recomputes the outputs that already exist.
+#
+#       Before a stage is run, its manifest is marked as in progress, so outputs of a run
+#       that is interrupted (or fails) are never taken to be up to date. Outputs are deleted
+#       up front, unless the stage is going to continue from its checkpoint (which truncates
+#       them to the checkpointed sizes, see "Checkpoints for incremental processing" in
+#       util.py). Checkpoints of a different configuration are deleted as well.
+#
+#       Outputs that are written in one go should be written with openArtifact, which only
+#       publishes the file (atomically, by renaming it) once it has been written completely.
+# =======================================================================================
+
+# Identities of input files, by (path, size, modification time)
+_identityCache = {}
+
+def getArtifact(file, suffix):
+    return file.replace('.msgpack', suffix)
+
+def getManifestFile(file, stage):
+    return file.replace('.msgpack', '.msgpack.' + stage.name + '.artifacts')
+
+def getInputIdentity(path):
+    if not os.path.exists(path):
+        return None
+    identity = [os.path.getsize(path), os.path.getmtime(path)]
+    if path.endswith('.msgpack') and util.hasMocapIndex(path):
+        fileIdx = util.getMocapIndexFile(path)
+        cacheKey = (path, identity[0], identity[1],
+            os.path.getmtime(fileIdx) if os.path.exists(fileIdx) else None)
+        if not cacheKey in _identityCache:
+            idx = util.openMocapIndex(path, createIndexIfNotExists=False)
+            _identityCache[cacheKey] = [identity[0], len(idx), zlib.crc32(
+                np.ascontiguousarray(idx.offsets).tobytes(),
+                zlib.crc32(np.ascontiguousarray(idx.frameIDs).tobytes()))]
+        identity = _identityCache[cacheKey]
+    return identity
+
+def _getParamValue(value):
+    return value.tolist() if isinstance(value, np.ndarray) else value
+
+def _hash(obj):
+    return hashlib.sha1(json.dumps(obj, sort_keys=True, default=repr).encode()).hexdigest()
+
+# Hash of the configuration of a stage
+def getStageConfig(stage):
+    return _hash([stage.name] + [(p, _getParamValue(getattr(stage.module, p)))
+        for p in stage.params])
+
+def getArtifactKey(stage, file, incremental):
+    return _hash([getStageConfig(stage), bool(incremental)] +
+        [(x, getInputIdentity(getArtifact(file, x))) for x in stage.inputs])
+
+# =======================================================================================
+# Manifests
+# =======================================================================================
+
+def readManifest(stage, file):
+    fname = getManifestFile(file, stage)
+    if not os.path.exists(fname):
+        return None
+    try:
+        with open(fname, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        return None
+
+def _writeManifest(stage, file, manifest):
+    fname = getManifestFile(file, stage)
+    with open(fname + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(fname + '.tmp', fname)
+
+# Are the outputs of the stage up to date (key as returned by getArtifactKey)?
+# Note: Stages that don't declare any outputs (e.g. plots) are always run.
+def isCached(stage, file, key):
+    manifest = readManifest(stage, file)
+    if len(stage.outputs) == 0 or manifest is None or manifest['key'] != key:
+        return False
+    for x in stage.outputs:
+        fname = getArtifact(file, x)
+        if not os.path.exists(fname) or os.path.getsize(fname) != manifest['outputs'].get(x):
+            return False
+    return True
+
+# Prepare for a run of the stage (called before it is started)
+def invalidate(stage, file, incremental):
+    manifest = readManifest(stage, file)
+    config = getStageConfig(stage)
+
+    # Is the stage going to continue from its checkpoint?
+    resume = False
+    if stage.checkpoint != None and manifest != None and manifest['config'] == config:
+        meta = util.readCheckpoint(getArtifact(file, stage.checkpoint[0]), stage.checkpoint[1])
+        resume = meta != None and (incremental or not meta['final'])
+
+    _writeManifest(stage, file, {'key': None, 'config': config, 'outputs': {}})
+    if not resume:
+        if stage.checkpoint != None:
+            util.removeCheckpoint(getArtifact(file, stage.checkpoint[0]), stage.checkpoint[1])
+        for x in stage.outputs:
+            if os.path.exists(getArtifact(file, x)):
+                os.remove(getArtifact(file, x))
+
+# Record the outputs of a successful run of the stage
+def publish(stage, file, key):
+    _writeManifest(stage, file, {'key': key, 'config': getStageConfig(stage),
+        'outputs': {x: os.path.getsize(getArtifact(file, x)) for x in stage.outputs
+            if os.path.exists(getArtifact(file, x))}})
+
+# =======================================================================================
+# Atomic writes
+# =======================================================================================
+
+# Open an output file for writing. It is written to a temporary file first, which replaces
+# the output file once it has been closed without errors.
+@contextlib.contextmanager
+def openArtifact(fname, mode='w'):
+    fnameTmp = fname + '.tmp'
+    try:
+        with open(fnameTmp, mode) as f:
+            yield f
+    except:
+        if os.path.exists(fnameTmp):
+            os.remove(fnameTmp)
+        raise
+    os.replace(fnameTmp, fname)
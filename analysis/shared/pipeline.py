@@ -0,0 +1,153 @@
+# --------------------------------------------------------
+# Dependency-aware scheduler for the post-processing steps
+#
+# Author: Abel Corver
+#         abel.corver@gmail.com
+#         (Anthony Leonardo Lab, Dec. 2016)
+# --------------------------------------------------------
+
+import os, sys, time, collections, traceback, multiprocessing
+from multiprocessing.connection import wait
+from datetime import datetime
+
+from shared import artifacts
+
+# =======================================================================================
+# Stages
+#
+# Note: A stage is a post-processing step that is run for each data file. It declares the
+#       artifacts it reads and writes, as suffixes that replace '.msgpack' in the name of
+#       the data file (e.g. '.flysim.csv'). A (stage, file) task depends on the tasks that
+#       write any of its inputs, and is run once these have finished. Independent tasks
+#       (e.g. the raw camera data and FlySim extraction) are run at the same time, on a
+#       bounded number of worker processes, so the time it takes to process a file comes
+#       down to its longest chain of dependent stages.
+#
+#       A task is skipped if its outputs are up to date: they are keyed on the inputs and on
+#       the parameters of the stage (the module constants listed in params), see
+#       shared/artifacts.py. Stages that save a checkpoint (see "Checkpoints for incremental
+#       processing" in util.py) name it as (suffix of the checkpointed file, checkpoint name).
+#
+#       func(file, settings) is called in a new process (with settings.files = [file]), as 
+#       most stages start worker processes of their own (which the daemonic workers of a 
+#       multiprocessing.Pool can't).
+# =======================================================================================
+
+Stage = collections.namedtuple('Stage', 
+    'name func inputs outputs checkpoint incremental module params')
+
+# Outcome of a task (status is 'done', 'skipped' (up to date), 'failed' or 'cancelled' (a
+# dependency failed))
+TaskResult = collections.namedtuple('TaskResult', 'stage file status seconds')
+
+# Wall time of every task is appended to this file
+PIPELINE_TIMINGS_FILE = 'pipeline.timings.csv'
+
+# =======================================================================================
+# Run the stages for a set of files
+# =======================================================================================
+
+# Process entry point of a task
+def _runTask(func, file, settings):
+    try:
+        func(file, settings)
+    except Exception:
+        traceback.print_exc()
+        sys.exit(1)
+
+def _saveTimings(results):
+    writeHeader = not os.path.exists(PIPELINE_TIMINGS_FILE)
+    with open(PIPELINE_TIMINGS_FILE, 'a') as f:
+        if writeHeader:
+            f.write('timestamp,stage,file,status,seconds\n')
+        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        for r in results:
+            f.write(','.join([timestamp, r.stage, r.file, r.status, '{0:.1f}'.format(r.seconds)]) + '\n')
+
+def runPipeline(stages, settings, numWorkers=4):
+    # Tasks in the order in which stages were declared (in incremental mode, only the stages
+    # that can continue from where they left off are run)
+    stages = [s for s in stages if s.incremental or not settings.incremental]
+    tasks = [(s, file) for file in settings.files for s in stages]
+
+    # Dependencies
+    producers = {}
+    for i, (stage, file) in enumerate(tasks):
+        for x in stage.outputs:
+            producers[artifacts.getArtifact(file, x)] = i
+    dependencies = [set([producers[artifacts.getArtifact(file, x)] for x in stage.inputs if
+        artifacts.getArtifact(file, x) in producers]) - set([i]) 
+        for i, (stage, file) in enumerate(tasks)]
+    dependents = [[] for t in tasks]
+    for i in range(len(tasks)):
+        for j in dependencies[i]:
+            dependents[j].append(i)
+
+    # Tasks at the start of the longest chains of dependent tasks are started first
+    chainLength = [None] * len(tasks)
+    def _chainLength(i):
+        if chainLength[i] is None:
+            chainLength[i] = 1 + max([0] + [_chainLength(j) for j in dependents[i]])
+        return chainLength[i]
+    for i in range(len(tasks)):
+        _chainLength(i)
+
+    results = [None] * len(tasks)
+    keys = [None] * len(tasks)
+    running = {}
+    tStart = time.time()
+    while None in results:
+        # Start the tasks of which all dependencies have finished (skipping or cancelling a 
+        # task can make other tasks ready)
+        resolved = True
+        while resolved:
+            resolved = False
+            ready = [i for i in range(len(tasks)) if results[i] is None and not i in running and
+                all([results[j] != None for j in dependencies[i]])]
+            ready.sort(key=lambda i: -chainLength[i])
+            for i in ready:
+                stage, file = tasks[i]
+                if keys[i] is None:
+                    keys[i] = artifacts.getArtifactKey(stage, file, settings.incremental)
+                if any([results[j].status in ('failed', 'cancelled') for j in dependencies[i]]):
+                    print("[pipeline] Cancelled " + stage.name + " (a dependency failed): " + file)
+                    results[i] = TaskResult(stage.name, file, 'cancelled', 0.0)
+                    resolved = True
+                elif artifacts.isCached(stage, file, keys[i]):
+                    print("[pipeline] Skipped " + stage.name + " (up to date): " + file)
+                    results[i] = TaskResult(stage.name, file, 'skipped', 0.0)
+                    resolved = True
+                elif len(running) < numWorkers:
+                    print("[pipeline] Started " + stage.name + ": " + file)
+                    artifacts.invalidate(stage, file, settings.incremental)
+                    p = multiprocessing.Process(target=_runTask, args=(stage.func, file, 
+                        settings._replace(files=[file])))
+                    p.start()
+                    running[i] = (p, time.time())
+
+        if len(running) == 0:
+            if None in results:
+                raise Exception("Circular dependency between post-processing stages.")
+            break
+
+        # Wait for a task to finish
+        finished = wait([p.sentinel for p, t in running.values()])
+        for i in [i for i, (p, t) in running.items() if p.sentinel in finished]:
+            p, t = running.pop(i)
+            p.join()
+            stage, file = tasks[i]
+            status = 'done' if p.exitcode == 0 else 'failed'
+            results[i] = TaskResult(stage.name, file, status, time.time() - t)
+            if status == 'done':
+                artifacts.publish(stage, file, keys[i])
+            print("[pipeline] " + ("Finished " if status == 'done' else "FAILED ") + stage.name +
+                " ({0:.1f}s): ".format(results[i].seconds) + file)
+
+    _saveTimings([r for r in results if r.status in ('done', 'failed')])
+    print("[pipeline] Processed " + str(len(settings.files)) + " file(s) in " +
+        "{0:.1f}s".format(time.time() - tStart) + " (" +
+        str(len([r for r in results if r.status == 'done'])) + " tasks run, " +
+        str(len([r for r in results if r.status == 'skipped'])) + " up to date, " +
+        str(len([r for r in results if r.status in ('failed', 'cancelled')])) + " failed)")
+
+    return results
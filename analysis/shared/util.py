@@ -7,7 +7,8 @@
 #         (Anthony Leonardo Lab, Dec. 2016)
 # --------------------------------------------------------
 
-import os, collections, msgpack
+import os, collections, msgpack, warnings, json, shutil, array, mmap
+import multiprocessing, threading
 import numpy as np
 from datetime import datetime
 import pandas as pd
@@ -31,10 +32,25 @@ MocapFrame = collections.namedtuple('MocapFrame', 'byteOffset frameID time yfram
 RawFrame = collections.namedtuple('RawFrame', 'cameraID width height centroids')
 Centroid = collections.namedtuple('Centroid', 'x y q')
 
-ExtractionSettings = collections.namedtuple('ExtractionSettings', 'files groupOutputByDay')
+# If incremental is set, the processing steps continue from where they left off in the previous 
+# run (see "Checkpoints for incremental processing")
+ExtractionSettings = collections.namedtuple('ExtractionSettings', 'files groupOutputByDay incremental')
+
+# Columnar representation of N consecutive mocap frames (see decodeMocapFrames)
+FrameBatch = collections.namedtuple('FrameBatch', 'byteOffsets frameIDs times '
+    'bodyOffsets bodyNameIDs bodyNames markerOffsets markers '
+    'yframeOffsets yframeBodies yframeVertices yframePositions '
+    'unidentifiedOffsets unidentifiedVertices '
+    'rawOffsets rawCameras centroidOffsets centroids calibrationFiles')
 
 CORTEX_NAN = 9999999
 
+# Number of markers on a Yframe
+YFRAME_NUM_MARKERS = 3
+
+# Number of frames decoded at a time
+MOCAP_BATCH_SIZE = 1000
+
 # =======================================================================================
 # Helper class
 # =======================================================================================
@@ -83,7 +99,7 @@ def askForExtractionSettings():
     if len(files) > 0:
         files.sort(key=lambda x: -os.path.getmtime(x))
 
-    return ExtractionSettings(files, False)
+    return ExtractionSettings(files, False, False)
 
 # =======================================================================================
 # Correct frame indices
@@ -104,8 +120,11 @@ def askForExtractionSettings():
 #       created, the original file is either renamed to ".msgpack.old" (when debugging)
 #       otherwise or deleted.
 #
-#       This function is run as part of the "buildMocapIndex" function, as that function requires
-#       a unique frame ID for lookup purposes. When a .msgpack.index file already exists,
+#       This function used to be run as part of the "buildMocapIndex" function, as that function 
+#       requires a unique frame ID for lookup purposes. Data files are no longer rewritten: the 
+#       index and all readers (MocapBatchIterator) instead detect restarts while streaming, and 
+#       apply the same correction on the fly (see correctFrameID). Files that were corrected by 
+#       this function before are read unchanged. When a .msgpack.index(.npy) file already exists,
 #       this function will refuse to execute.
 #
 #       Note that running this function will create an incompatibility in frame indices between
@@ -113,10 +132,24 @@ def askForExtractionSettings():
 #
 # =======================================================================================
 
+# Number of bits reserved for the original Cortex frameID (see above)
+FRAME_EPOCH_BITS = 24
+
+# Restarts are detected as a frameID that doesn't increase. Each restart starts a new "epoch".
+def isFrameIDRestart(rawFrameID, lastRawFrameID):
+    return lastRawFrameID != None and rawFrameID <= lastRawFrameID
+
+# Encode the epoch in the upper bits of a frameID (frameIDs that already have an epoch encoded,
+# i.e. from files corrected by correctFrameIndices, are left alone)
+def correctFrameID(rawFrameID, epoch):
+    if rawFrameID >= (1 << FRAME_EPOCH_BITS):
+        return rawFrameID
+    return rawFrameID + (epoch << FRAME_EPOCH_BITS)
+
 def correctFrameIndices(file):
 
     # Check if frame indices have already been corrected
-    if os.path.exists(file.replace('.msgpack','.msgpack.index')):
+    if hasMocapIndex(file):
         raise Exception("Index file already exists, so frame IDs have already been corrected.")
 
     # Set output paths
@@ -145,13 +178,13 @@ def correctFrameIndices(file):
                 frameID = data[0]
 
                 # Restart?
-                if lastFrameID != None and frameID <= lastFrameID:
+                if isFrameIDRestart(frameID, lastFrameID):
                     numRestarts += 1
                     print("Restart detected in frame index... adjusting frame "
                           "indices (#restarts="+str(numRestarts)+".")
                 lastFrameID = frameID
 
-                data[0] = frameID + (numRestarts << 24)
+                data[0] = frameID + (numRestarts << FRAME_EPOCH_BITS)
                 fOut.write(msgpack.packb(data))
 
     # Currently, we rename the current file to .original for security purposes,
@@ -177,54 +210,431 @@ def correctFrameIndices(file):
 
 # =======================================================================================
 # Build an index for a mocap file
+#
+# Note: The index is a (2, N) int64 array, saved as .msgpack.index.npy. The first row holds
+#       the (sorted, unique) frameIDs, the second row the byte offset at which each frame
+#       starts in the .msgpack file. The index is memory-mapped once per process (see
+#       openMocapIndex), and frames are looked up by binary search, so opening the index and
+#       looking up (many) frames costs microseconds.
+#
+#       The index is built in a single pass over the raw msgpack stream: only the frameID of
+#       each frame is decoded, the rest of the frame is skipped over. Cortex restarts are
+#       detected on the fly, and stored in the index as the epoch bits of the frameIDs (see
+#       correctFrameIndices), rather than by rewriting the data file.
+#
+#       Older data directories contain an SQLite index (.msgpack.index). These are converted
+#       to the new format the first time they are opened.
 # =======================================================================================
 
+def getMocapIndexFile(file):
+    return file.replace('.msgpack','.msgpack.index.npy')
+
+def hasMocapIndex(file):
+    return os.path.exists(getMocapIndexFile(file)) or \
+        os.path.exists(file.replace('.msgpack','.msgpack.index'))
+
+def _saveMocapIndex(ofile, frameIDs, offsets):
+    # Frame IDs have to be unique (and increasing) for lookups to work
+    iDup = np.flatnonzero(np.diff(frameIDs) <= 0)
+    if len(iDup) > 0:
+        print("Error indexing frame, frameID="+str(frameIDs[iDup[0]+1])+".")
+        print("Likely duplicate frame index.")
+        raise Exception("Mocap index requires unique, increasing frameIDs.")
+    
+    # Write to a temporary file first, so an interrupted build never leaves a partial index
+    with open(ofile + '.tmp', 'wb') as f:
+        np.save(f, np.vstack([frameIDs, offsets]).astype(np.int64))
+    os.replace(ofile + '.tmp', ofile)
+
+# Index the frames from a byte offset onwards, continuing from the given epoch and (raw) frameID
+def _scanMocapIndex(file, offset, epoch, lastRawFrameID, verbose=False):
+    frameIDs = array.array('q')
+    offsets  = array.array('q')
+    
+    with open(file, 'rb') as f:
+        fsize = os.fstat(f.fileno()).st_size
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if fsize > 0 else b''
+        f.seek(offset)
+        unpacker = msgpack.Unpacker(f)
+        try:
+            while True:
+                pos = offset + unpacker.tell()
+                if pos >= fsize:
+                    break
+                
+                # Skip over records that aren't frames (e.g. frame counters written by 
+                # older versions of the tracker)
+                if not _isMsgpackArrayHeader(mm[pos]):
+                    unpacker.skip()
+                    continue
+                
+                # Decode only the frameID, and skip over the rest of the frame
+                n = unpacker.read_array_header()
+                rawFrameID = unpacker.unpack()
+                for i in range(n - 1):
+                    unpacker.skip()
+                
+                # Restart?
+                if isFrameIDRestart(rawFrameID, lastRawFrameID):
+                    epoch += 1
+                    print("Restart detected in frame index (#restarts="+str(epoch)+").")
+                lastRawFrameID = rawFrameID
+                
+                frameIDs.append(correctFrameID(rawFrameID, epoch))
+                offsets.append(pos)
+                
+                if verbose and (len(frameIDs) % 100000) == 0:
+                    print("Processed "+str(len(frameIDs)))
+        except msgpack.OutOfData:
+            # Note: A partially written frame at the end of the file is not indexed
+            pass
+        if fsize > 0:
+            mm.close()
+    
+    return np.frombuffer(frameIDs, dtype=np.int64), np.frombuffer(offsets, dtype=np.int64)
+
 def buildMocapIndex(file, verbose=False):
-    ofile = file.replace('.msgpack','.msgpack.index')
-    i = 0
+    ofile = getMocapIndexFile(file)
     if not file.endswith('.msgpack'):
         raise Exception("Mocap data has to be in .msgpack format.")
-    elif os.path.exists(ofile):
+    elif hasMocapIndex(file):
         raise Exception("Mocap index already exists.")
     else:
-        # Correct frame indices to remove duplicates, if necessary
-        correctFrameIndices(file)
-
-        # Start creating index
-        conn = sqlite3.connect(ofile)
-        c = conn.cursor()
-        c.execute('''CREATE TABLE idx
-                (frameID integer PRIMARY KEY, offset integer)''')
-        c.execute('CREATE INDEX i1 ON idx (frameID)')
-        conn.commit()
-        
-        buf = []
-        curOffset = 0
-        for frame in iterMocapFrames(file):
-            buf.append( (frame.frameID, curOffset) )            
-            curOffset = frame.byteOffset
+        _saveMocapIndex(ofile, *_scanMocapIndex(file, 0, 0, None, verbose=verbose))
+
+# Return the (raw) frameID of the frame at an offset, and the offset right after the frame
+def _skipMocapFrame(file, offset):
+    with open(file, 'rb') as f:
+        f.seek(offset)
+        unpacker = msgpack.Unpacker(f)
+        n = unpacker.read_array_header()
+        rawFrameID = unpacker.unpack()
+        for i in range(n - 1):
+            unpacker.skip()
+        return rawFrameID, offset + unpacker.tell()
+
+# Return the offset right after the last indexed frame (the file may have grown since)
+def getMocapIndexEnd(file, idx):
+    return _skipMocapFrame(file, int(idx.offsets[-1]))[1] if len(idx) > 0 else 0
+
+# Build the index of a file that is still being written to, or add the frames that have been 
+# written since the index was last updated. Only the new part of the file is scanned.
+def updateMocapIndex(file, verbose=False):
+    idx = openMocapIndex(file, createIndexIfNotExists=False)
+    if idx is None:
+        buildMocapIndex(file, verbose=verbose)
+        return openMocapIndex(file)
+    if len(idx) == 0:
+        frameIDs, offsets = _scanMocapIndex(file, 0, 0, None, verbose=verbose)
+    else:
+        # Continue right after the last indexed frame (files corrected by correctFrameIndices 
+        # store the corrected frameIDs, and have no restarts)
+        lastRawFrameID, nextOffset = _skipMocapFrame(file, int(idx.offsets[-1]))
+        epoch = int(idx.frameIDs[-1]) >> FRAME_EPOCH_BITS if \
+            lastRawFrameID < (1 << FRAME_EPOCH_BITS) else 0
+        frameIDs, offsets = _scanMocapIndex(file, nextOffset, epoch, lastRawFrameID, verbose=verbose)
+    if len(frameIDs) > 0:
+        _saveMocapIndex(getMocapIndexFile(file), np.concatenate([idx.frameIDs, frameIDs]), 
+            np.concatenate([idx.offsets, offsets]))
+    return openMocapIndex(file)
+
+# fixarray (0x90-0x9f), array 16 (0xdc) and array 32 (0xdd)
+def _isMsgpackArrayHeader(b):
+    return (0x90 <= b <= 0x9f) or b == 0xdc or b == 0xdd
+
+def _convertSQLiteMocapIndex(file):
+    conn = sqlite3.connect(file.replace('.msgpack','.msgpack.index'))
+    c = conn.cursor()
+    idx = np.array([x for x in c.execute('select frameID, offset from idx order by frameID')], 
+        dtype=np.int64).reshape(-1, 2)
+    conn.close()
+    _saveMocapIndex(getMocapIndexFile(file), idx[:,0], idx[:,1])
+
+class MocapIndex:
+    def __init__(self, fileIdx):
+        self.data = np.load(fileIdx, mmap_mode='r')
+        self.frameIDs = self.data[0]
+        self.offsets = self.data[1]
+        self.mtime = os.path.getmtime(fileIdx)
+    
+    def __len__(self):
+        return len(self.frameIDs)
+
+    # Return the position in the index of the last frame with frameID <= the requested frame(s) 
+    # (or -1 if there is no such frame). Accepts a single frameID or an array of frameIDs.
+    def find(self, frameIDs):
+        return np.searchsorted(self.frameIDs, frameIDs, side='right') - 1
+
+    # Return the byte offset of the last frame with frameID <= the requested frame(s)
+    def lookup(self, frameIDs):
+        i = self.find(frameIDs)
+        if np.any(i < 0):
+            raise Exception("No frameID <= requested frame found (requested: "+str(frameIDs)+").")
+        return self.offsets[i]
+
+# Indexes that have been opened by this process
+_mocapIndexCache = {}
+
+def openMocapIndex(file, createIndexIfNotExists=True):
+    fileIdx = getMocapIndexFile(file)
+    if not os.path.exists(fileIdx):
+        if os.path.exists(file.replace('.msgpack','.msgpack.index')):
+            _convertSQLiteMocapIndex(file)
+        elif createIndexIfNotExists:
+            # Auto-build necessary index if it doesn't exist
+            buildMocapIndex(file)
+        else:
+            return None
+    
+    # Re-use an index that's already mapped, unless it has been rebuilt since
+    idx = _mocapIndexCache.get(fileIdx)
+    if idx is None or idx.mtime != os.path.getmtime(fileIdx):
+        idx = _mocapIndexCache[fileIdx] = MocapIndex(fileIdx)
+    return idx
+
+# =======================================================================================
+# Checkpoints for incremental processing
+#
+# Note: Data files grow while they are being recorded. Rather than re-processing an entire 
+#       file every time, a processing stage can save a checkpoint after each run: the number 
+#       of frames (in the index of the data file) that it has processed, the sizes of its 
+#       output files, and whatever state it needs to continue (e.g. open trajectories). The 
+#       next run truncates the outputs to these sizes (removing anything written after the 
+#       checkpoint), and continues from the next frame, appending to the outputs. Results are 
+#       identical to those of processing the entire file at once.
+#
+#       Incremental runs leave trajectories etc. that are still open unprocessed. A final run 
+#       (incremental=False) also processes these, after saving the checkpoint. If the file 
+#       grows after all, the next incremental run simply continues from the final checkpoint.
+#       A final run that has no checkpoint to continue from starts from scratch.
+#
+#       The checkpoint (.msgpack.<stage>.checkpoint) is a pickled metadata dictionary, 
+#       followed by the pickled state.
+# =======================================================================================
+
+def getCheckpointFile(file, stage):
+    return file.replace('.msgpack', '.msgpack.' + stage + '.checkpoint')
+
+def removeCheckpoint(file, stage):
+    if os.path.exists(getCheckpointFile(file, stage)):
+        os.remove(getCheckpointFile(file, stage))
+
+# Save a checkpoint after the first numFrames frames of the index have been processed. Any 
+# additional keyword arguments are stored in the metadata.
+def saveCheckpoint(file, stage, numFrames, outputs, state, final=False, **info):
+    idx = openMocapIndex(file, createIndexIfNotExists=False)
+    meta = dict(info)
+    meta['numFrames'] = numFrames
+    meta['frameID'] = int(idx.frameIDs[numFrames - 1]) if numFrames > 0 else None
+    meta['offset']  = int(idx.offsets[numFrames - 1])  if numFrames > 0 else None
+    meta['outputs'] = {o: os.path.getsize(o) for o in outputs}
+    meta['final'] = final
+    
+    ofile = getCheckpointFile(file, stage)
+    with open(ofile + '.tmp', 'wb') as f:
+        pickle.dump(meta, f)
+        pickle.dump(state, f)
+    os.replace(ofile + '.tmp', ofile)
+
+# Return the metadata of a checkpoint (or None if there is no checkpoint)
+def readCheckpoint(file, stage):
+    fname = getCheckpointFile(file, stage)
+    if not os.path.exists(fname):
+        return None
+    with open(fname, 'rb') as f:
+        return pickle.load(f)
+
+# A final checkpoint that includes the last frame in the index means there's nothing left to do
+def isCheckpointCurrent(file, stage):
+    meta = readCheckpoint(file, stage)
+    idx = openMocapIndex(file, createIndexIfNotExists=False)
+    return meta != None and idx != None and meta['final'] and meta['numFrames'] == len(idx)
+
+# Load a checkpoint to continue from, returns (metadata, state), or None if processing has to 
+# start from scratch. The outputs are truncated to their size at the time of the checkpoint.
+def loadCheckpoint(file, stage, outputs, incremental):
+    meta = readCheckpoint(file, stage)
+    if meta is None or (meta['final'] and not incremental):
+        return None
+    
+    # The frames that have been processed have to be the same as the ones in the index, and 
+    # the outputs can't have been overwritten since
+    idx = openMocapIndex(file, createIndexIfNotExists=False)
+    n = meta['numFrames']
+    valid = idx != None and n <= len(idx) and (n == 0 or (
+        int(idx.frameIDs[n - 1]) == meta['frameID'] and int(idx.offsets[n - 1]) == meta['offset']))
+    valid = valid and sorted(meta['outputs']) == sorted(outputs) and all([os.path.exists(o) and 
+        os.path.getsize(o) >= size for o, size in meta['outputs'].items()])
+    if not valid:
+        print("Checkpoint is out of date, starting from scratch: " + getCheckpointFile(file, stage))
+        return None
+    
+    with open(getCheckpointFile(file, stage), 'rb') as f:
+        pickle.load(f)
+        state = pickle.load(f)
+    for o, size in meta['outputs'].items():
+        with open(o, 'r+b') as f:
+            f.truncate(size)
+    
+    print("Continuing " + stage + " from frame " + str(n) + ": " + file)
+    return meta, state
+
+# =======================================================================================
+# Merge mocap files
+#
+# Note: Files are merged without decoding and re-encoding the frames: the (complete) msgpack 
+#       records of each part are copied as raw bytes, and the index of the merged file is 
+#       built from the index of each part by shifting its offsets and frameIDs. The index of
+#       a part is built first if it doesn't exist yet. A partially written record at the end 
+#       of a part is dropped.
+#
+#       Restarts between parts are detected in the same way as restarts within a part, so the
+#       merged index is identical to one built from the merged file. If correctFrameIDs is 
+#       set, the corrected frameIDs (see correctFrameIndices) are also written to the merged
+#       file, so they don't depend on restart detection anymore. Only the frameID of frames
+#       whose frameID changes is re-encoded, everything else is still copied as is.
+# =======================================================================================
+
+MERGE_BUFFER_SIZE = 16 << 20
+
+# Copy numBytes, starting at offset, from fIn to the end of fOut
+def _copyBytes(fIn, fOut, offset, numBytes):
+    if hasattr(os, 'copy_file_range'):
+        fOut.flush()
+        while numBytes > 0:
+            n = os.copy_file_range(fIn.fileno(), fOut.fileno(), 
+                min(numBytes, MERGE_BUFFER_SIZE), offset)
+            if n == 0:
+                break
+            offset += n
+            numBytes -= n
+    else:
+        fIn.seek(offset)
+        while numBytes > 0:
+            buf = fIn.read(min(numBytes, MERGE_BUFFER_SIZE))
+            if len(buf) == 0:
+                break
+            fOut.write(buf)
+            numBytes -= len(buf)
+    if numBytes > 0:
+        raise Exception("Unexpected end of file while copying " + fIn.name)
+
+# Return the frameID of the frame at an offset, the size of its array header, and the offset
+# (relative to the frame) of the data following the frameID
+def _readFrameID(mm, offset):
+    unpacker = msgpack.Unpacker()
+    unpacker.feed(mm[offset:(offset + 16)])
+    unpacker.read_array_header()
+    headerSize = unpacker.tell()
+    return unpacker.unpack(), headerSize, unpacker.tell()
+
+# Return the end of the last complete record in a file. Records after the last indexed frame 
+# are checked, to make sure the index is up to date.
+def _getMocapFileEnd(file, mm, fsize, idx):
+    start = int(idx.offsets[-1]) if len(idx) > 0 else 0
+    unpacker = msgpack.Unpacker(read_size=MERGE_BUFFER_SIZE)
+    unpacker.feed(mm[start:fsize])
+    end, numFrames = start, 0
+    try:
+        while end < fsize:
+            isFrame = _isMsgpackArrayHeader(mm[end])
+            unpacker.skip()
+            end = start + unpacker.tell()
+            numFrames += isFrame
+    except msgpack.OutOfData:
+        pass
+
+    # The last indexed frame should be the only complete frame
+    if numFrames > min(1, len(idx)):
+        raise Exception("Mocap index is out of date: " + getMocapIndexFile(file))
+    return end
+
+def mergeMocapFiles(files, fnameOut, correctFrameIDs=False):
+    frameIDs, offsets = [], []
+    epoch, lastRawFrameID = 0, None
+    outPos = 0
+    
+    try:
+        with open(fnameOut + '.tmp', 'wb') as fOut:
+            for file in files:
+                # (the index of a part may have been built while it was still being recorded)
+                idx = updateMocapIndex(file)
+                partFrameIDs = np.array(idx.frameIDs, dtype=np.int64)
+                partOffsets = np.array(idx.offsets, dtype=np.int64)
             
-            i += 1
-            if (i % 100000) == 0:
-                try:
-                    c.executemany('insert into idx (frameID, offset) values (?,?)', buf)
-                except:
-                    # If failed, find the conflicting frameID
-                    for b in buf:
-                        try:
-                            c.execute('insert into idx (frameID, offset) values (?,?)', b)
-                        except Exception as e:
-                            print("Error inserting frame, frameID="+str(b[0])+".")
-                            print("Likely duplicate frame index.")
-                            raise e # Make sure program is interrupted...
-                conn.commit()
-                buf = []
-                if verbose:
-                    print("Processed "+str(i))
-        
-        c.executemany('insert into idx (frameID, offset) values (?,?)', buf)
-        conn.commit()
-        conn.close()
+                with open(file, 'rb') as fIn:
+                    fsize = os.fstat(fIn.fileno()).st_size
+                    if fsize == 0:
+                        continue
+                    mm = mmap.mmap(fIn.fileno(), 0, access=mmap.ACCESS_READ)
+                    try:
+                        end = _getMocapFileEnd(file, mm, fsize, idx)
+                    
+                        if len(idx) == 0:
+                            _copyBytes(fIn, fOut, 0, end)
+                            outPos += end
+                            continue
+                    
+                        # Recover the frameIDs as they are stored in the file (files corrected by
+                        # correctFrameIndices store the corrected frameIDs, and have no restarts)
+                        if _readFrameID(mm, int(partOffsets[-1]))[0] >= (1 << FRAME_EPOCH_BITS):
+                            rawFrameIDs = partFrameIDs
+                            partEpochs = np.zeros(len(partFrameIDs), dtype=np.int64)
+                        else:
+                            rawFrameIDs = partFrameIDs & ((1 << FRAME_EPOCH_BITS) - 1)
+                            partEpochs = partFrameIDs >> FRAME_EPOCH_BITS
+                    
+                        # Restart between this part and the previous one?
+                        if isFrameIDRestart(int(rawFrameIDs[0]), lastRawFrameID):
+                            epoch += 1
+                            print("Restart detected in frame index (#restarts="+str(epoch)+").")
+                        newFrameIDs = np.where(rawFrameIDs >= (1 << FRAME_EPOCH_BITS), rawFrameIDs, 
+                            rawFrameIDs + ((epoch + partEpochs) << FRAME_EPOCH_BITS))
+                        epoch += int(partEpochs[-1])
+                        lastRawFrameID = int(rawFrameIDs[-1])
+                    
+                        iChanged = np.flatnonzero(newFrameIDs != rawFrameIDs) if \
+                            correctFrameIDs else []
+                        if len(iChanged) == 0:
+                            # Copy the whole part at once
+                            _copyBytes(fIn, fOut, 0, end)
+                            newOffsets = partOffsets + outPos
+                        else:
+                            # Copy everything in between the frameIDs that change
+                            sizeChange = np.zeros(len(partOffsets), dtype=np.int64)
+                            pos = 0
+                            with memoryview(mm) as mv:
+                                for i in iChanged.tolist():
+                                    offset = int(partOffsets[i])
+                                    oldFrameID, headerSize, dataStart = _readFrameID(mm, offset)
+                                    newFrameID = msgpack.packb(int(newFrameIDs[i]))
+                                    fOut.write(mv[pos:(offset + headerSize)])
+                                    fOut.write(newFrameID)
+                                    pos = offset + dataStart
+                                    sizeChange[i] = len(newFrameID) - (dataStart - headerSize)
+                                fOut.write(mv[pos:end])
+                            newOffsets = partOffsets + outPos + np.cumsum(sizeChange) - sizeChange
+                            end += int(sizeChange.sum())
+                    finally:
+                        mm.close()
+            
+                frameIDs.append(newFrameIDs)
+                offsets.append(newOffsets)
+                outPos += end
+    
+    except:
+        if os.path.exists(fnameOut + '.tmp'):
+            os.remove(fnameOut + '.tmp')
+        raise
+    
+    # Replace the output file (and its index)
+    ofileIdx = getMocapIndexFile(fnameOut)
+    if os.path.exists(ofileIdx):
+        os.remove(ofileIdx)
+    os.replace(fnameOut + '.tmp', fnameOut)
+    _saveMocapIndex(ofileIdx, 
+        np.concatenate(frameIDs) if len(frameIDs) > 0 else np.zeros(0, dtype=np.int64), 
+        np.concatenate(offsets) if len(offsets) > 0 else np.zeros(0, dtype=np.int64))
 
 # =======================================================================================
 # Return all 3d markers in a MocapFrame, regardless of whether they're recognized or not
@@ -242,24 +652,12 @@ def getAllMarkersInFrame(frame):
 # =======================================================================================
 
 def iterMocapFrameIDs(fname):
+    for i, frameID in enumerate(openMocapIndex(fname).frameIDs.tolist()):
+        yield i, frameID
 
-    # Get the index file, and ensure it exists
-    fileIdx = fname.replace('.msgpack', '.msgpack.index')
-    if not os.path.exists(fileIdx):
-        # Auto-build necessary index if it doesn't exist
-        buildMocapIndex(fname)
-
-    # Connect to the index file, and loop over its indices
-    conn = sqlite3.connect(fileIdx)
-    c = conn.cursor()
-    i = 0
-    for x in c.execute('select frameID from idx',()):
-        yield i, x[0]
-        i += 1
-    conn.close()
 
 # =======================================================================================
-# Iterator for Yframes and return the parsed structure... 
+# Decode batches of mocap frames into columnar arrays
 # =======================================================================================
 
 # This function currently parses the .msgpack file format
@@ -267,133 +665,465 @@ def iterMocapFrameIDs(fname):
 #    o In the future, we may switch to another data format, in which case this function 
 #      can simply be expanded, without having to change other functions.
 #
+# Rather than building NumPy arrays and namedtuples for every single frame, frames are 
+# decoded N at a time into one set of columns per batch (see FrameBatch). Ragged data 
+# (bodies, markers, unidentified vertices, cameras, centroids) is stored CSR-style: the rows 
+# belonging to frame i are values[offsets[i]:offsets[i+1]]. CORTEX_NAN substitution and 
+# Yframe averaging are done in a single vectorized pass over the whole batch.
+#
 
-class MocapFrameIterator:
-    def __init__(self, file, nearbyVertexRange=None, startFrame=None, endFrame=None, numFrames=None):
-        self.counter = StreamCounter()
+def _offsetsFromCounts(counts):
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return offsets
+
+def _rowOwners(offsets):
+    # For each row of a CSR column, the index of the frame (or body, ...) it belongs to
+    return np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+def _vertexArray(values):
+    vertices = np.array(values, dtype=np.float64).reshape(-1, 3)
+    vertices[vertices == CORTEX_NAN] = np.nan
+    return vertices
+
+# Gather the markers of the Yframes into a (numYframes, numMarkers, 3) block, where numMarkers is
+# YFRAME_NUM_MARKERS, or the largest number of markers of any Yframe. Yframes with fewer markers
+# are padded with NaN.
+def _gatherYframeVertices(markerOffsets, markers, yframeBodies):
+    yframeMarkerCounts = np.diff(markerOffsets)[yframeBodies]
+    numMarkers = max([YFRAME_NUM_MARKERS] + list(yframeMarkerCounts))
+    yframeVertices = np.full((len(yframeBodies), numMarkers, 3), np.nan)
+    markerIdx = markerOffsets[yframeBodies][:,None] + np.arange(numMarkers)[None,:]
+    markerValid = np.arange(numMarkers)[None,:] < yframeMarkerCounts[:,None]
+    yframeVertices[markerValid] = markers[markerIdx[markerValid]]
+    return yframeVertices
+
+def decodeMocapFrames(records, byteOffsets):
+    
+    # Gather all values of this batch in flat lists first (one allocation per column, 
+    # rather than per frame)
+    frameIDs, times, calibrationFiles = [], [], []
+    bodyCounts, bodyNameIDs, markerCounts, markers = [], [], [], []
+    unidentifiedCounts, unidentified = [], []
+    rawCounts, rawCameras, centroidCounts, centroids = [], [], [], []
+    names = {}
+    
+    for x in records:
+        frameIDs.append(x[0])
+        
+        # Get time if it exists (older files don't have a time field)
+        times.append(x[5] if len(x) >= 6 else 0)
+        
+        # ID'ed bodies (body names are stored once per batch)
+        bodyCounts.append(len(x[2]))
+        for b in x[2]:
+            nameID = names.get(b[0])
+            if nameID is None:
+                nameID = names[b[0]] = len(names)
+            bodyNameIDs.append(nameID)
+            markerCounts.append(len(b[1]))
+            markers += b[1]
+        
+        # UnID'ed markers
+        unidentifiedCounts.append(len(x[3]))
+        unidentified += x[3]
+        
+        # Centroids, if they have been added to this data file...
+        if len(x) >= 7:
+            rawCounts.append(len(x[6]))
+            for c in x[6]:
+                rawCameras.append(c[0:3])
+                centroidCounts.append(len(c[3]))
+                centroids += c[3]
+        else:
+            rawCounts.append(0)
+        
+        # Get calfile, if it exists
+        calibrationFiles.append((x[7].decode() if isinstance(x[7], bytes) else x[7]) if len(x) >= 8 else '')
+
+    numFrames = len(frameIDs)
+    
+    # Bodies and their markers
+    bodyNames = [n.decode() if isinstance(n, bytes) else n for n in sorted(names, key=names.get)]
+    bodyNameIDs = np.array(bodyNameIDs, dtype=np.int64)
+    bodyOffsets = _offsetsFromCounts(bodyCounts)
+    markerOffsets = _offsetsFromCounts(markerCounts)
+    markers = _vertexArray(markers)
+    
+    # Yframes are the ID'ed bodies with "Yframe" in their name, skipping those that are all NaN
+    isYframeName = np.array(['Yframe' in n for n in bodyNames], dtype=bool)
+    markerHasValue = ~np.all(np.isnan(markers), axis=1)
+    bodyHasValue = np.bincount(_rowOwners(markerOffsets), weights=markerHasValue, 
+        minlength=len(bodyNameIDs)) > 0
+    yframeBodies = np.flatnonzero(isYframeName[bodyNameIDs] & bodyHasValue)
+    yframeOffsets = _offsetsFromCounts(np.bincount(
+        _rowOwners(bodyOffsets)[yframeBodies], minlength=numFrames))
+    
+    # Gather Yframe markers and average them
+    yframeVertices = _gatherYframeVertices(markerOffsets, markers, yframeBodies)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        yframePositions = np.nanmean(yframeVertices, axis=1)
+    
+    # UnID'ed markers (skipping those that are all NaN)
+    unidentifiedVertices = _vertexArray(unidentified)
+    keep = ~np.all(np.isnan(unidentifiedVertices), axis=1)
+    unidentifiedOffsets = _offsetsFromCounts(np.bincount(
+        _rowOwners(_offsetsFromCounts(unidentifiedCounts))[keep], minlength=numFrames))
+    unidentifiedVertices = unidentifiedVertices[keep]
+    
+    # Cameras (ID, width, height) and their centroids (x, y, q)
+    rawOffsets = _offsetsFromCounts(rawCounts)
+    rawCameras = np.array(rawCameras, dtype=np.int64).reshape(-1, 3)
+    centroidOffsets = _offsetsFromCounts(centroidCounts)
+    centroids = np.array(centroids, dtype=np.float64).reshape(-1, 3)
+
+    return FrameBatch(
+        byteOffsets = np.array(byteOffsets, dtype=np.int64),
+        frameIDs = np.array(frameIDs, dtype=np.int64),
+        times = np.array(times, dtype=np.int64),
+        bodyOffsets = bodyOffsets,
+        bodyNameIDs = bodyNameIDs,
+        bodyNames = bodyNames,
+        markerOffsets = markerOffsets,
+        markers = markers,
+        yframeOffsets = yframeOffsets,
+        yframeBodies = yframeBodies,
+        yframeVertices = yframeVertices,
+        yframePositions = yframePositions,
+        unidentifiedOffsets = unidentifiedOffsets,
+        unidentifiedVertices = unidentifiedVertices,
+        rawOffsets = rawOffsets,
+        rawCameras = rawCameras,
+        centroidOffsets = centroidOffsets,
+        centroids = centroids,
+        calibrationFiles = calibrationFiles)
+
+# =======================================================================================
+# Iterate over batches of mocap frames
+# =======================================================================================
+
+class MocapBatchIterator:
+    def __init__(self, file, startFrame=None, endFrame=None, numFrames=None, batchSize=MOCAP_BATCH_SIZE, 
+                 useFrameStore=True):
         self.numFramesYielded = 0
         self.startFrame = startFrame
         self.endFrame = endFrame
         self.numFrames = numFrames
-        self.nearbyVertexRange = nearbyVertexRange
-
-        if file.endswith('.msgpack'):
+        self.batchSize = batchSize
+        self.startOffset = 0
+        self.done = False
+        self.f = None
+        self.store = None
+        self.epoch = 0
+        self.lastRawFrameID = None
+
+        if not file.endswith('.msgpack'):
+            raise Exception("Mocap Batch Iterator currently only parses .msgpack files.")
+
+        if useFrameStore and isFrameStoreCurrent(file):
+
+            # Read from the memory-mapped frame store, which requires no parsing at all
+            self.store = openFrameStore(file)
+            self.storePos = 0
+            if startFrame != None:
+                self.storePos = np.searchsorted(self.store.frameIDs, startFrame, side='right') - 1
+                if self.storePos < 0:
+                    raise Exception("Start frame specified, but no frameID <= requested frame found "
+                        "in frame store (startFrame="+str(startFrame)+").")
+        else:
 
             # Open the data file
             self.f = open(file,'rb')
 
-            # If a start frame is requested, look it up in the index
+            # If a start frame is requested, look it up in the index, and seek to right point in file
             if startFrame != None:
-                fileIdx = file.replace('.msgpack','.msgpack.index')
-                if not os.path.exists(fileIdx):
-                    # Auto-build necessary index if it doesn't exist
-                    buildMocapIndex(file)
-                
-                # Seek to right point in file
-                conn = sqlite3.connect(fileIdx)
-                c = conn.cursor()
-                s = [x for x in c.execute(
-                    'select frameID, offset from idx where frameID <= ? order by frameID DESC limit 2', 
-                        (int(startFrame),))]
-                # Note: This code above has been found not to work when type(startFrame)==np.int64...
-                #       We're therefore forcing 'int' type here!
-                conn.close()
-                if len(s) == 0:
-                    raise Exception("Start frame specified, but no frameID <= requested frame found... \n" + 
-                        "Tried query: 'select frameID, offset from idx where frameID <= "+str(startFrame)+" order by frameID desc limit 1'")
-                else:
-                    self.f.seek(s[0][1])
+                idx = openMocapIndex(file)
+                self.startOffset = int(idx.lookup(startFrame))
+                self.epoch = int(idx.frameIDs[idx.find(startFrame)]) >> FRAME_EPOCH_BITS
+                self.f.seek(self.startOffset)
             
             self.unpacker = msgpack.Unpacker(self.f)
+    
+    def __iter__(self):
+        return self
+
+    def close(self):
+        if self.f != None:
+            self.f.close()
+
+    def __next__(self):
+        if self.done:
+            self.close()
+            raise StopIteration
+        
+        # Don't decode more frames than requested
+        n = self.batchSize
+        if self.numFrames != None:
+            n = min(n, self.numFrames - self.numFramesYielded)
+        
+        if self.store != None:
+            batch = self._nextFromStore(n)
         else:
-            raise Exception("Mocap Frame Iterator currently only parses .msgpack files.")
+            batch = self._nextFromFile(n)
+
+        if batch is None:
+            self.close()
+            raise StopIteration
+
+        self.numFramesYielded += len(batch.frameIDs)
+        if self.numFrames != None and self.numFramesYielded >= self.numFrames:
+            self.done = True
+        
+        return batch
+
+    def _nextFromStore(self, n):
+        start = self.storePos
+        end = min(start + n, self.store.numFrames)
+        if self.endFrame != None:
+            end = start + np.searchsorted(self.store.frameIDs[start:end], self.endFrame, side='left')
+            if end < min(start + n, self.store.numFrames):
+                self.done = True
+        if end >= self.store.numFrames:
+            self.done = True
+        if end <= start:
+            return None
+        self.storePos = end
+        return self.store.getBatch(start, end)
+
+    def _nextFromFile(self, n):
+        # Unpack the raw records of this batch, and keep track of where each frame starts
+        records = []
+        byteOffsets = [self.startOffset + self.unpacker.tell()]
+        try:
+            while len(records) < n:
+                x = self.unpacker.unpack()
+                if isinstance(x, int):
+                    byteOffsets[-1] = self.startOffset + self.unpacker.tell()
+                    continue
+                
+                # Make frameIDs unique across Cortex restarts
+                if isFrameIDRestart(x[0], self.lastRawFrameID):
+                    self.epoch += 1
+                self.lastRawFrameID = x[0]
+                x[0] = correctFrameID(x[0], self.epoch)
+                
+                if self.endFrame != None and x[0] >= self.endFrame:
+                    self.done = True
+                    break
+                records.append(x)
+                byteOffsets.append(self.startOffset + self.unpacker.tell())
+        except msgpack.OutOfData:
+            self.done = True
+        
+        if len(records) == 0:
+            return None
+        
+        return decodeMocapFrames(records, byteOffsets)
+
+# =======================================================================================
+# Convert a decoded batch back to the MocapFrame structure
+# =======================================================================================
+
+def frameFromBatch(batch, i, nearbyVertexRange=None):
+    frameID = int(batch.frameIDs[i])
+    timestamp = int(batch.times[i])
+    unidentifiedVertices = batch.unidentifiedVertices[
+        batch.unidentifiedOffsets[i]:batch.unidentifiedOffsets[i+1]]
+
+    # ID'ed markers
+    yframes = []
+    for j in range(batch.yframeOffsets[i], batch.yframeOffsets[i+1]):
+        b = batch.yframeBodies[j]
+        vertices = batch.markers[batch.markerOffsets[b]:batch.markerOffsets[b+1]]
+        pos = batch.yframePositions[j]
+        
+        # Optionally get nearby vertices (don't accept markers with any NaN's at this point)
+        nearbyVertices = None
+        if nearbyVertexRange != None:
+            v = unidentifiedVertices[~np.any(np.isnan(unidentifiedVertices), axis=1)]
+            nearbyVertices = list(v[np.linalg.norm(v - pos, axis=1) < nearbyVertexRange])
+        
+        yframes.append( Frame(frame=frameID, vertices=vertices, pos=pos, 
+            trajectory=-1, time=timestamp, nearbyVertices=nearbyVertices) )
+    
+    # Centroids
+    centroids = {}
+    for r in range(batch.rawOffsets[i], batch.rawOffsets[i+1]):
+        cameraID, width, height = batch.rawCameras[r].tolist()
+        cs = [Centroid(*c) for c in 
+            batch.centroids[batch.centroidOffsets[r]:batch.centroidOffsets[r+1]].tolist()]
+        centroids[cameraID] = RawFrame(cameraID, width, height, cs)
+    
+    return MocapFrame(int(batch.byteOffsets[i+1]), frameID, timestamp, yframes, 
+        list(unidentifiedVertices), centroids, batch.calibrationFiles[i])
+
+def batchToFrames(batch, nearbyVertexRange=None):
+    return [frameFromBatch(batch, i, nearbyVertexRange) for i in range(len(batch.frameIDs))]
+
+# =======================================================================================
+# Iterator for Yframes and return the parsed structure... 
+# =======================================================================================
+
+# This iterator yields one MocapFrame at a time, but decodes the underlying data file in 
+# batches (see MocapBatchIterator)
+
+class MocapFrameIterator:
+    def __init__(self, file, nearbyVertexRange=None, startFrame=None, endFrame=None, numFrames=None,
+                 batchSize=MOCAP_BATCH_SIZE):
+        self.numFramesYielded = 0
+        self.nearbyVertexRange = nearbyVertexRange
+        self.batches = MocapBatchIterator(file, startFrame=startFrame, endFrame=endFrame, 
+            numFrames=numFrames, batchSize=batchSize)
+        self.batch = None
+        self.batchPos = 0
     
     def __iter__(self):
         return self
 
     def stopIteration(self, raiseStopIteration=True):
-        self.f.close()
+        self.batches.close()
         if raiseStopIteration:
             raise StopIteration
     
     def __next__(self):
-        try:
-            x = self.unpacker.unpack(write_bytes=self.counter)
-                    
-            iframe = x[0]
-            yframes = []
-            unidentifiedVertices = []
-            
-            # Get time if it exists (older files don't have a time field)
-            timestamp = x[5] if len(x)>=6 else 0        
-                           
-            byteOffset = self.counter.nbytes
-                
-            if self.endFrame != None and iframe >= self.endFrame:
+        if self.batch is None or self.batchPos >= len(self.batch.frameIDs):
+            try:
+                self.batch = self.batches.__next__()
+            except StopIteration:
                 self.stopIteration()
+            self.batchPos = 0
+        
+        frame = frameFromBatch(self.batch, self.batchPos, self.nearbyVertexRange)
+        self.batchPos += 1
+        self.numFramesYielded += 1
+        return frame
 
-            if not isinstance(x, int):
-                    
-                # Parse ID'ed markers
-                for b in x[2]:
-                    if 'Yframe' in b[0].decode():
-                        vertices = np.array([[z if z!=CORTEX_NAN else 
-                            float('NaN') for z in y] for y in b[1]])
+# =======================================================================================
+# 2D centroid histograms
+# =======================================================================================
 
-                        # Continue if all vertices are NaN
-                        if np.all(vertices!=vertices): continue
+# Note: Centroids are accumulated as flat (camID, x, y) arrays into one (height x width) 
+#       histogram per camera, using linearized pixel indices. Cameras (and their image size) 
+#       are taken from the data. Histograms of separate chunks can be merged, and the result 
+#       can be saved to (and loaded from) an .npz file.
 
-                        pos = np.nanmean(vertices, axis=0)
-                    
-                        # Optionally get nearby vertices
-                        nearbyVertices = None
-                        if self.nearbyVertexRange != None:
-                            nearbyVertices = []
-                            for c in x[3]:
-                                # Get vertex
-                                v = np.array([z if z!=CORTEX_NAN else 
-                                    float('NaN') for z in c])
-                                # Don't accept markers with any NaN's at this point
-                                if not np.any(v!=v):
-                                    # Only proceed if this vertex is close enough
-                                    if np.linalg.norm(v - pos) < self.nearbyVertexRange:
-                                        nearbyVertices.append(v)
-                                    
-                        # Pass data to processing function
-                        yframes.append( Frame(frame=iframe, vertices=vertices, pos=pos, 
-                            trajectory=-1, time=timestamp, nearbyVertices=nearbyVertices) )
-    
-                # Parse unID'ed markers
-                for b in x[3]:
-                    pos = np.array([z if z!=CORTEX_NAN else float('NaN') for z in b])
-                        
-                    # Continue if all vertices are NaN
-                    if np.all(pos!=pos): continue
-                    
-                    unidentifiedVertices.append(pos)
-                
-            # Parse centroids, if they have been added to this data file...
-            centroids = {}
-                
-            if len(x) >= 7:
-                for c in x[6]:
-                    cs = [Centroid(y[0], y[1], y[2]) for y in c[3]]
-                    rf = RawFrame(c[0], c[1], c[2], cs)
-                    centroids[rf.cameraID] = rf
-            
-            # Get calfile, if it exists
-            calfile = ''
-            if len(x) >= 8:
-                calfile = x[7]
-            
-            # Done!
-            if self.numFrames == None or self.numFramesYielded < self.numFrames:
-                self.numFramesYielded += 1
-                return MocapFrame(byteOffset, iframe, timestamp, yframes, unidentifiedVertices, centroids, calfile)
+class CentroidHistograms:
+    def __init__(self):
+        self.images = {}
+
+    # Add centroids, cameras is an (N x 3) array of (camID, width, height)
+    def add(self, camIDs, x, y, cameras=()):
+        for camID, width, height in np.asarray(cameras).tolist():
+            if not camID in self.images:
+                self.images[camID] = np.zeros((height, width), dtype=np.int64)
+        
+        for camID in np.unique(camIDs).tolist():
+            img = self.images[camID]
+            m = camIDs == camID
+            ix = np.clip(x[m].astype(np.int64), 0, img.shape[1] - 1)
+            iy = np.clip(y[m].astype(np.int64), 0, img.shape[0] - 1)
+            np.add.at(img.reshape(-1), iy * img.shape[1] + ix, 1)
+        return self
+
+    def merge(self, other):
+        for camID, img in other.images.items():
+            if camID in self.images:
+                self.images[camID] += img
             else:
-                self.stopIteration()
-        except msgpack.OutOfData:
-            self.stopIteration()
+                self.images[camID] = img
+        return self
+
+    def save(self, fname):
+        np.savez_compressed(fname, **{str(camID): img for camID, img in self.images.items()})
+
+    @staticmethod
+    def load(fname):
+        h = CentroidHistograms()
+        with np.load(fname) as f:
+            h.images = {int(camID): f[camID] for camID in f.files}
+        return h
+
+# Functions for scanMocapFile(file, getBatchCentroids, reduceFunc=accumulateCentroids)
+def getBatchCentroids(batch):
+    return np.repeat(batch.rawCameras[:,0], np.diff(batch.centroidOffsets)), \
+        batch.centroids[:,0], batch.centroids[:,1], batch.rawCameras
+
+def accumulateCentroids(histograms, centroids):
+    if histograms is None:
+        histograms = CentroidHistograms()
+    return histograms.add(*centroids)
+
+# =======================================================================================
+# Pass frame batches to worker processes through shared memory
+# =======================================================================================
+
+# Note: Sending decoded frames to worker processes through a multiprocessing.Queue means 
+#       pickling (and unpickling) every frame. Instead, the columns of a FrameBatch are copied 
+#       into one of a fixed number of shared memory slots, and only a small descriptor (slot, 
+#       column layout, and the name tables) is sent through the queue. Workers reconstruct the 
+#       FrameBatch as NumPy views on the slot, and return the slot to the pool when done.
+#
+#       Slots are allocated with multiprocessing.RawArray (multiprocessing.shared_memory is not 
+#       available in Python 3.6), so the pool has to be passed to the worker processes when 
+#       they're created (e.g. as an argument of the Pool initializer). A batch that doesn't 
+#       fit in a slot is sent along with the descriptor instead.
+#
+#       Note that the arrays of a batch returned by get(...) are only valid until release(...).
+
+SharedBatch = collections.namedtuple('SharedBatch', 'slot layout bodyNames calibrationFiles batch')
+
+SHARED_BATCH_COLUMNS = [x for x in FrameBatch._fields if x not in ('bodyNames', 'calibrationFiles')]
+
+class SharedBatchPool:
+    def __init__(self, numSlots, slotSize=16 << 20):
+        self.slots = [multiprocessing.RawArray('B', slotSize) for i in range(numSlots)]
+        self.freeSlots = multiprocessing.Queue()
+        for i in range(numSlots):
+            self.freeSlots.put(i)
+
+    # Copy a batch into a free slot (blocks until a slot is available), and return its descriptor
+    def put(self, batch):
+        # Calibration files are stored as IDs into a (short) table
+        calibrationFiles = sorted(set(batch.calibrationFiles))
+        calibrationIDs = {x: i for i, x in enumerate(calibrationFiles)}
+        columns = [(x, np.ascontiguousarray(getattr(batch, x))) for x in SHARED_BATCH_COLUMNS] + \
+            [('calibrationIDs', np.array([calibrationIDs[x] for x in batch.calibrationFiles], dtype=np.int64))]
+        
+        # Determine the layout of the columns in the slot
+        layout, size = [], 0
+        for name, values in columns:
+            layout.append((name, values.dtype.str, values.shape, size))
+            size += -(-values.nbytes // FRAME_STORE_ALIGN) * FRAME_STORE_ALIGN
+        if size > len(self.slots[0]):
+            return SharedBatch(None, None, None, None, batch)
+        
+        slot = self.freeSlots.get()
+        buffer = np.frombuffer(self.slots[slot], dtype=np.uint8)
+        for (name, values), (_, _, _, offset) in zip(columns, layout):
+            buffer[offset:(offset + values.nbytes)] = values.reshape(-1).view(np.uint8)
+        
+        return SharedBatch(slot, layout, batch.bodyNames, calibrationFiles, None)
+
+    # Reconstruct a batch from its descriptor
+    def get(self, descriptor):
+        if descriptor.slot == None:
+            return descriptor.batch
+        
+        buffer = np.frombuffer(self.slots[descriptor.slot], dtype=np.uint8)
+        c = {}
+        for name, dtype, shape, offset in descriptor.layout:
+            dtype = np.dtype(dtype)
+            c[name] = buffer[offset:(offset + int(np.prod(shape)) * dtype.itemsize)].view(dtype).reshape(shape)
+        
+        calibrationIDs = c.pop('calibrationIDs')
+        return FrameBatch(bodyNames=descriptor.bodyNames, 
+            calibrationFiles=[descriptor.calibrationFiles[i] for i in calibrationIDs], **c)
+
+    # Return the slot of a batch to the pool
+    def release(self, descriptor):
+        if descriptor.slot != None:
+            self.freeSlots.put(descriptor.slot)
 
 # =======================================================================================
 # [DEPRECATED] Read Yframes and return the parsed structure (use this as iterator in for loop) 
@@ -411,13 +1141,307 @@ def iterMocapFrames(file, nearbyVertexRange=None, startFrame=None, endFrame=None
     for frame in mocap:
         yield frame
 
+# =======================================================================================
+# Memory-mapped frame store
+#
+# Note: Decoding msgpack is CPU-bound, and every post-processing stage decodes the same data 
+#       file again. The frame store is a one-time conversion of a .msgpack file into a 
+#       fixed-layout binary sidecar (.msgpack.frames) that holds the columns of FrameBatch 
+#       for the entire file. Reading it back is a matter of memory-mapping the file: any 
+#       range of frames can be sliced without parsing, and without copying the (large) 
+#       vertex and centroid columns.
+#
+#       Layout: 8-byte magic, uint32 format version, uint32 header length, a JSON header
+#       (column offsets/dtypes/shapes, body name and calibration file tables), then each
+#       column as a raw little-endian array, aligned to FRAME_STORE_ALIGN bytes. All
+#       offset columns are global (i.e. relative to the start of the file, not of a batch).
+#
+#       Yframe markers aren't stored separately (a Yframe can have more than 
+#       YFRAME_NUM_MARKERS markers), but gathered from the markers column when a batch is read.
+#
+#       MocapBatchIterator (and thereby MocapFrameIterator) automatically reads from the 
+#       frame store whenever an up-to-date one exists.
+# =======================================================================================
+
+FRAME_STORE_MAGIC   = b'AAFRAMES'
+FRAME_STORE_VERSION = 2
+FRAME_STORE_ALIGN   = 64
+
+# (column name, dtype, shape of a single row)
+FRAME_STORE_COLUMNS = [
+    ('byteOffsets',         '<i8', ()),
+    ('frameIDs',            '<i8', ()),
+    ('times',               '<i8', ()),
+    ('calibrationIDs',      '<i4', ()),
+    ('bodyOffsets',         '<i8', ()),
+    ('bodyNameIDs',         '<i4', ()),
+    ('markerOffsets',       '<i8', ()),
+    ('markers',             '<f8', (3,)),
+    ('yframeOffsets',       '<i8', ()),
+    ('yframeBodies',        '<i8', ()),
+    ('yframePositions',     '<f8', (3,)),
+    ('unidentifiedOffsets', '<i8', ()),
+    ('unidentifiedVertices','<f8', (3,)),
+    ('rawOffsets',          '<i8', ()),
+    ('rawCameras',          '<i8', (3,)),
+    ('centroidOffsets',     '<i8', ()),
+    ('centroids',           '<f8', (3,))]
+
+def isFrameStoreCurrent(file):
+    fileStore = file.replace('.msgpack','.msgpack.frames')
+    return os.path.exists(fileStore) and os.path.getmtime(fileStore) >= os.path.getmtime(file)
+
+def buildFrameStore(file, verbose=False):
+    ofile = file.replace('.msgpack','.msgpack.frames')
+    if not file.endswith('.msgpack'):
+        raise Exception("Mocap data has to be in .msgpack format.")
+
+    # If the data file has not been indexed yet, the index is written in the same pass
+    buildIndex = not hasMocapIndex(file)
+    idxFrameIDs, idxOffsets = [], []
+
+    # Each column is first streamed to its own temporary file, as the column sizes are not known
+    # up front. The columns are then concatenated into the final file.
+    dtypes = {name: np.dtype(dtype) for name, dtype, shape in FRAME_STORE_COLUMNS}
+    tmpDir = ofile + '.tmp'
+    os.makedirs(tmpDir, exist_ok=True)
+    fCols = {name: open(os.path.join(tmpDir, name), 'wb') for name in dtypes}
+    def write(name, values):
+        fCols[name].write(np.ascontiguousarray(values, dtype=dtypes[name]).tobytes())
+
+    bodyNames, calibrationFiles = {}, {}
+    numFrames, numBodies, numMarkers, numYframes, numUnidentified, numRaw, numCentroids = \
+        0, 0, 0, 0, 0, 0, 0
+    lastByteOffset = 0
+    try:
+        for name in ['bodyOffsets', 'markerOffsets', 'yframeOffsets', 'unidentifiedOffsets',
+                     'rawOffsets', 'centroidOffsets']:
+            write(name, [0])
+        
+        for batch in MocapBatchIterator(file, useFrameStore=False):
+            
+            # Map the per-batch name tables onto global ones
+            nameIDs = np.array([bodyNames.setdefault(n, len(bodyNames)) for n in batch.bodyNames], 
+                dtype=np.int64)
+            calibrationIDs = [calibrationFiles.setdefault(c, len(calibrationFiles)) 
+                for c in batch.calibrationFiles]
+            
+            # Frame columns
+            write('byteOffsets', batch.byteOffsets[:-1])
+            write('frameIDs', batch.frameIDs)
+            write('times', batch.times)
+            write('calibrationIDs', calibrationIDs)
+            lastByteOffset = batch.byteOffsets[-1]
+            
+            # CSR columns (offsets are shifted to be global)
+            write('bodyOffsets', batch.bodyOffsets[1:] + numBodies)
+            write('bodyNameIDs', nameIDs[batch.bodyNameIDs])
+            write('markerOffsets', batch.markerOffsets[1:] + numMarkers)
+            write('markers', batch.markers)
+            write('yframeOffsets', batch.yframeOffsets[1:] + numYframes)
+            write('yframeBodies', batch.yframeBodies + numBodies)
+            write('yframePositions', batch.yframePositions)
+            write('unidentifiedOffsets', batch.unidentifiedOffsets[1:] + numUnidentified)
+            write('unidentifiedVertices', batch.unidentifiedVertices)
+            write('rawOffsets', batch.rawOffsets[1:] + numRaw)
+            write('rawCameras', batch.rawCameras)
+            write('centroidOffsets', batch.centroidOffsets[1:] + numCentroids)
+            write('centroids', batch.centroids)
+            
+            if buildIndex:
+                idxFrameIDs.append(np.array(batch.frameIDs))
+                idxOffsets.append(np.array(batch.byteOffsets[:-1]))
+            
+            numFrames       += len(batch.frameIDs)
+            numBodies       += len(batch.bodyNameIDs)
+            numMarkers      += len(batch.markers)
+            numYframes      += len(batch.yframeBodies)
+            numUnidentified += len(batch.unidentifiedVertices)
+            numRaw          += len(batch.rawCameras)
+            numCentroids    += len(batch.centroids)
+            
+            if verbose:
+                print("Processed "+str(numFrames))
+
+        write('byteOffsets', [lastByteOffset])
+    finally:
+        for f in fCols.values():
+            f.close()
+    
+    # Determine the layout of the final file
+    columns = {}
+    dataSize = 0
+    for name, dtype, shape in FRAME_STORE_COLUMNS:
+        nbytes = os.path.getsize(os.path.join(tmpDir, name))
+        rowSize = dtypes[name].itemsize * int(np.prod(shape))
+        columns[name] = [dataSize, dtype, [nbytes // rowSize] + list(shape)]
+        dataSize += nbytes + (-nbytes % FRAME_STORE_ALIGN)
+    header = json.dumps({
+        'numFrames': numFrames,
+        'columns': columns,
+        'bodyNames': sorted(bodyNames, key=bodyNames.get),
+        'calibrationFiles': sorted(calibrationFiles, key=calibrationFiles.get)}).encode()
+    
+    # Write the final file (first to a temporary file, so a crash never leaves a partial store behind)
+    with open(ofile + '.tmp.frames', 'wb') as fOut:
+        fOut.write(FRAME_STORE_MAGIC)
+        fOut.write(np.array([FRAME_STORE_VERSION, len(header)], dtype='<u4').tobytes())
+        fOut.write(header)
+        fOut.write(b'\0' * (-fOut.tell() % FRAME_STORE_ALIGN))
+        for name, dtype, shape in FRAME_STORE_COLUMNS:
+            with open(os.path.join(tmpDir, name), 'rb') as fIn:
+                shutil.copyfileobj(fIn, fOut, 16 * 1024 * 1024)
+            fOut.write(b'\0' * (-fOut.tell() % FRAME_STORE_ALIGN))
+    os.replace(ofile + '.tmp.frames', ofile)
+    shutil.rmtree(tmpDir)
+
+    if buildIndex:
+        _saveMocapIndex(getMocapIndexFile(file), 
+            np.concatenate(idxFrameIDs) if numFrames > 0 else np.zeros(0, dtype=np.int64),
+            np.concatenate(idxOffsets)  if numFrames > 0 else np.zeros(0, dtype=np.int64))
+
+class FrameStore:
+    def __init__(self, fileStore):
+        with open(fileStore, 'rb') as f:
+            magic = f.read(len(FRAME_STORE_MAGIC))
+            version, headerSize = np.frombuffer(f.read(8), dtype='<u4')
+            if magic != FRAME_STORE_MAGIC or version != FRAME_STORE_VERSION:
+                raise Exception("Unsupported frame store format: " + fileStore)
+            header = json.loads(f.read(int(headerSize)).decode())
+            dataStart = f.tell() + (-f.tell() % FRAME_STORE_ALIGN)
+        
+        # Map the whole file once, and create (read-only) views for each column
+        self.mmap = np.memmap(fileStore, dtype=np.uint8, mode='r')
+        self.columns = {}
+        for name, (offset, dtype, shape) in header['columns'].items():
+            self.columns[name] = np.ndarray(shape=tuple(shape), dtype=np.dtype(dtype), 
+                buffer=self.mmap, offset=dataStart + offset)
+        
+        self.numFrames = header['numFrames']
+        self.bodyNames = header['bodyNames']
+        self.calibrationFiles = header['calibrationFiles']
+        self.frameIDs = self.columns['frameIDs']
+    
+    # Return frames [start, end) as a FrameBatch. All vertex/centroid columns are views into 
+    # the memory-mapped file (except the Yframe markers, which are gathered), only the (small) 
+    # offset columns are rebased.
+    def getBatch(self, start, end):
+        c = self.columns
+        bodyOffsets    = c['bodyOffsets'][start:end+1]
+        yframeOffsets  = c['yframeOffsets'][start:end+1]
+        unidOffsets    = c['unidentifiedOffsets'][start:end+1]
+        rawOffsets     = c['rawOffsets'][start:end+1]
+        markerOffsets  = c['markerOffsets'][bodyOffsets[0]:bodyOffsets[-1]+1]
+        centroidOffsets= c['centroidOffsets'][rawOffsets[0]:rawOffsets[-1]+1]
+        markers        = c['markers'][markerOffsets[0]:markerOffsets[-1]]
+        yframeBodies   = c['yframeBodies'][yframeOffsets[0]:yframeOffsets[-1]] - bodyOffsets[0]
+        markerOffsets  = markerOffsets - markerOffsets[0]
+        
+        return FrameBatch(
+            byteOffsets = c['byteOffsets'][start:end+1],
+            frameIDs = c['frameIDs'][start:end],
+            times = c['times'][start:end],
+            bodyOffsets = bodyOffsets - bodyOffsets[0],
+            bodyNameIDs = c['bodyNameIDs'][bodyOffsets[0]:bodyOffsets[-1]],
+            bodyNames = self.bodyNames,
+            markerOffsets = markerOffsets,
+            markers = markers,
+            yframeOffsets = yframeOffsets - yframeOffsets[0],
+            yframeBodies = yframeBodies,
+            yframeVertices = _gatherYframeVertices(markerOffsets, markers, yframeBodies),
+            yframePositions = c['yframePositions'][yframeOffsets[0]:yframeOffsets[-1]],
+            unidentifiedOffsets = unidOffsets - unidOffsets[0],
+            unidentifiedVertices = c['unidentifiedVertices'][unidOffsets[0]:unidOffsets[-1]],
+            rawOffsets = rawOffsets - rawOffsets[0],
+            rawCameras = c['rawCameras'][rawOffsets[0]:rawOffsets[-1]],
+            centroidOffsets = centroidOffsets - centroidOffsets[0],
+            centroids = c['centroids'][centroidOffsets[0]:centroidOffsets[-1]],
+            calibrationFiles = [self.calibrationFiles[i] for i in c['calibrationIDs'][start:end]])
+
+def openFrameStore(file):
+    return FrameStore(file.replace('.msgpack','.msgpack.frames'))
+
+# =======================================================================================
+# Parallel scan over a mocap file
+# =======================================================================================
+
+# Note: msgpack has no frame markers, so a reader can only start decoding at the start of the
+#       file, or at an offset found in the index. The index is used to split the file into 
+#       chunks of consecutive frames, which are decoded (and processed) by a pool of workers. 
+#       Results are returned in frame order.
+#
+#       "func" is called as func(batch, *args) for every FrameBatch in the file, and has to be
+#       a module-level function (so it can be sent to the worker processes). Use this for 
+#       map-style work, that doesn't depend on state carried over from previous frames.
+#
+#       Optionally, "reduceFunc" is called as acc = reduceFunc(acc, result) (with acc None for 
+#       the first batch) to combine the results of all batches in a chunk in the worker, so 
+#       that only a single result per chunk is returned (e.g. for histograms).
+
+# Number of frames per chunk
+MOCAP_SCAN_CHUNK_SIZE = 50000
+
+def getMocapChunks(file, chunkSize=MOCAP_SCAN_CHUNK_SIZE):
+    idx = openMocapIndex(file)
+    chunks = []
+    for i in range(0, len(idx), chunkSize):
+        # The last chunk continues to the end of the file (which may have grown since it was 
+        # indexed)
+        numFrames = chunkSize if i + chunkSize < len(idx) else None
+        chunks.append((int(idx.frameIDs[i]), numFrames))
+    return chunks
+
+def _scanMocapChunk(task):
+    file, startFrame, numFrames, func, args, reduceFunc = task
+    results = []
+    numFramesScanned = 0
+    for batch in MocapBatchIterator(file, startFrame=startFrame, numFrames=numFrames):
+        if reduceFunc is None:
+            results.append(func(batch, *args))
+        else:
+            results = [reduceFunc(results[0] if len(results) > 0 else None, func(batch, *args))]
+        numFramesScanned += len(batch.frameIDs)
+    return numFramesScanned, results
+
+def scanMocapFile(file, func, args=(), numProcesses=None, chunkSize=MOCAP_SCAN_CHUNK_SIZE, 
+                  verbose=False, reduceFunc=None):
+    tasks = [(file, startFrame, numFrames, func, args, reduceFunc) 
+        for startFrame, numFrames in getMocapChunks(file, chunkSize)]
+    
+    numFramesScanned = 0
+    def _progress(n):
+        if verbose:
+            print("[" + file + "] Processed "+str(n)+" frames")
+
+    # Scan in this process (e.g. for debugging, or when running inside a worker process)
+    if numProcesses == 1:
+        for task in tasks:
+            n, results = _scanMocapChunk(task)
+            numFramesScanned += n
+            _progress(numFramesScanned)
+            for r in results:
+                yield r
+    else:
+        with multiprocessing.Pool(numProcesses or multiprocessing.cpu_count()) as pool:
+            for n, results in pool.imap(_scanMocapChunk, tasks):
+                numFramesScanned += n
+                _progress(numFramesScanned)
+                for r in results:
+                    yield r
+
+
 # =======================================================================================
 # [DEPRECATED] Read Yframes and return the parsed structure (use this as iterator in for loop)
 # =======================================================================================
 
-def readYFrames(file, nearbyVertexRange=None):
+# (Optionally, only the records from startOffset up to endOffset are read)
+def readYFrames(file, nearbyVertexRange=None, startOffset=0, endOffset=None):
     with open(file,'rb') as f:
-        for x in msgpack.Unpacker(f):
+        f.seek(startOffset)
+        unpacker = msgpack.Unpacker(f)
+        for x in unpacker:
+            if endOffset != None and startOffset + unpacker.tell() > endOffset:
+                break
             if not isinstance(x, int):
                 for b in x[2]:
                     if 'Yframe' in b[0].decode():
@@ -474,21 +1498,15 @@ def countRecords(file, includeFrameRange=False, createIndexIfNotExists=True):
     minFrameIdx =  99999999
     maxFrameIdx = -99999999
     
-    fnameIdx = file.replace('.msgpack','.msgpack.index')
-    
-    # Create an index if it doesn't exist
-    if createIndexIfNotExists and not os.path.exists(fnameIdx):
-        buildMocapIndex(file)
+    # Open the index (creating it if it doesn't exist)
+    idx = openMocapIndex(file, createIndexIfNotExists=createIndexIfNotExists)
         
     # Is an index available already?
-    if os.path.exists(fnameIdx):
-        print("Using pre-computed index: "+fnameIdx)
-        conn = sqlite3.connect(fnameIdx)
-        c = conn.cursor()
-        totalNumRecords = [x for x in c.execute('select count(*) from idx')][0][0]
-        minFrameIdx = [x for x in c.execute('select min(frameid) from idx')][0][0]
-        maxFrameIdx = [x for x in c.execute('select max(frameid) from idx')][0][0]
-        conn.close()
+    if idx != None:
+        print("Using pre-computed index: "+getMocapIndexFile(file))
+        totalNumRecords = len(idx)
+        minFrameIdx = int(idx.frameIDs[0])  if totalNumRecords > 0 else None
+        maxFrameIdx = int(idx.frameIDs[-1]) if totalNumRecords > 0 else None
     else:
         for frame in MocapFrameIterator(file):
             totalNumRecords += 1
@@ -8,7 +8,7 @@
 # Imports
 # =======================================================================================
 
-import os, multiprocessing
+import os
 from subprocess import call
 
 from df_reports import generate_reports
@@ -26,6 +26,7 @@ from postprocessing import plot_takeoffs
 from postprocessing import merge_daily_data
 
 from shared import util
+from shared import pipeline
 
 # TODO: Make arena interface display list of reports... =) And generate placeholder "in progress" html files?
 
@@ -38,73 +39,123 @@ os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)),'../data'))
 #    that facilitates easy plotting and analysis. This will also generate HTML reports.
 # =======================================================================================
 
-def updateAll_p1(settings):
-    print("Extracting raw camera data.")
-    p4 = extract_raw_mac_data.run(async=False, settings=settings)
-
-    print("Done extracting raw camera data, now extracting alignment triggers.")
-    extract_mocap_trigger.run(settings=settings)
-
-    print("Extracting telemetry")
-    pass
-
-def updateAll_p2(settings):
-    # Process data with Python scripts
-    p1 = extract_flysim.run(async=False, settings=settings)
-    print("Done processing FlySim, now extracting log info.")
-
-    extract_log_info.run(settings=settings)
-    print("Done extracting log info, now computing perch locations.")
-
-    p2 = extract_perch_locations.run(async=False, settings=settings)
-
-    # Make sure the previous processes have finished before starting the next ones
-    # p1.join()
-    # p2.join()
-
-    print("Done extracting perch locations, now computing takeoffs / perching locations.")
+# Note: Each step declares the files it reads and writes (see shared/pipeline.py), so the steps 
+#       for all files can be run in parallel wherever their dependencies allow it, and steps of 
+#       which the output is up to date are skipped. The time it takes to process the data of a 
+#       day comes down to the longest chain of dependent steps (currently: frame store, FlySim, 
+#       takeoffs / perching locations, plots).
+#
+#       In incremental mode (settings.incremental), only the steps that can continue from where 
+#       they left off are run (see "Checkpoints for incremental processing" in shared/util.py). 
+#       Steps that need the entire file (perch locations, plots, reports) are left for the final 
+#       run, once the file is no longer being recorded.
+#
+#       extract_headmovements is not part of the pipeline yet (it's still work in progress).
+
+# Maximum number of steps that are run at the same time (most steps use several processes)
+NUM_PIPELINE_WORKERS = 4
+
+def buildFrameStore(file, settings):
+    # Convert each data file to a memory-mapped frame store once, so the post-processing steps 
+    # don't each have to decode the .msgpack file from scratch
+    util.buildFrameStore(file)
+
+def extractRawMacData(file, settings):
+    extract_raw_mac_data.processFile(file, settings.incremental)
+
+def extractMocapTrigger(file, settings):
+    extract_mocap_trigger.processFile(file, settings.incremental)
+
+def extractFlysim(file, settings):
+    extract_flysim.processFile(file, settings.incremental)
+
+def extractLogInfo(file, settings):
+    extract_log_info.processFile(file)
+
+def extractPerchLocations(file, settings):
+    extract_perch_locations.processFile(file)
+
+def extractPerchingLocations(file, settings):
+    extract_perching_locations.processFile(file, settings.incremental)
+
+def extractPerchingOrientations(file, settings):
+    extract_perching_orientations.processFile(file)
+
+def plotTakeoffs(file, settings):
+    plot_takeoffs.run(async=False, settings=settings)
+
+# (name, function, inputs, outputs, checkpoint, run in incremental mode, module, parameters)
+# Note: Outputs are recomputed when any of the parameters (constants of the module) change, 
+#       see shared/artifacts.py. Increase the VERSION of a module when changing how its 
+#       outputs are computed.
+# Note: The raw camera data isn't joined in incremental mode, as vc.sqlite (see 
+#       extract_raw_mac_data.py) is only created once, from the capture files that exist at the 
+#       time. The trigger search depends on the raw camera data, so it isn't run either.
+PIPELINE_STAGES = [
+    pipeline.Stage('frame_store', buildFrameStore, 
+        ['.msgpack'], ['.msgpack.frames'], None, False, 
+        util, ['FRAME_STORE_VERSION']),
+    pipeline.Stage('extract_raw_mac_data', extractRawMacData, 
+        ['.msgpack'], ['.raw.msgpack', '.raw.dbg'], ('.msgpack', 'raw'), False, 
+        extract_raw_mac_data, ['VERSION', 'MAX_RAW_TIME_MISMATCH', 'RAW_JOIN_BATCH_SIZE']),
+    pipeline.Stage('extract_mocap_trigger', extractMocapTrigger, 
+        ['.raw.msgpack'], ['.led_triggers_tmp', '.led_triggers'], ('.raw.msgpack', 'triggers'), False, 
+        extract_mocap_trigger, ['VERSION', 'SYNCBOX_LOCK_RADIUS', 'SYNCBOX_MAX_CONFIDENCE', 
+            'SYNC_SAMPLE_INTERVAL', 'SYNC_SAMPLE_NUM_FRAMES', 'SYNC_MIN_FRACTION']),
+    pipeline.Stage('extract_flysim', extractFlysim, 
+        ['.msgpack', '.msgpack.frames'], ['.flysim.csv', '.flysim.tracking.csv'], ('.msgpack', 'flysim'), True, 
+        extract_flysim, ['VERSION', 'TRAJ_TIMEOUT', 'TRAJ_MAXDIST', 'TRAJ_SAVE_MINDIST', 
+            'TRAJ_SAVE_MINLEN', 'MAX_FLYSIM_DURATION_FRAMES', 'STATIONARY_WINDOW']),
+    pipeline.Stage('extract_log_info', extractLogInfo, 
+        ['.log'], ['.trials.csv'], None, True, 
+        extract_log_info, ['VERSION']),
+    pipeline.Stage('extract_perch_locations', extractPerchLocations, 
+        ['.msgpack', '.msgpack.frames'], ['.perch_objects.csv'], None, False, 
+        extract_perch_locations, ['VERSION', 'SUBSAMPLE']),
+    pipeline.Stage('extract_perching_locations', extractPerchingLocations, 
+        ['.msgpack', '.msgpack.frames', '.flysim.csv', '.flysim.tracking.csv'], 
+        ['.perches.csv', '.takeoffs.csv', '.tracking.csv', '.fsdbg.csv'], ('.msgpack', 'perching'), True, 
+        extract_perching_locations, ['VERSION', 'TRAJ_TIMEOUT', 'TRAJ_MAXDIST', 
+            'MAX_STATIONARY_MOVEMENT', 'TRAJ_SAVE_MINLEN', 'TRAJ_TAKEOFF_MINLEN', 
+            'FLYSIM_AXIS_PT1', 'FLYSIM_AXIS_PT2']),
+    pipeline.Stage('extract_perching_orientations', extractPerchingOrientations, 
+        ['.msgpack', '.msgpack.frames', '.perches.csv'], ['.angles.csv'], None, False, 
+        extract_perching_orientations, ['VERSION']),
+    pipeline.Stage('plot_takeoffs', plotTakeoffs, 
+        ['.takeoffs.csv', '.tracking.csv', '.flysim.tracking.csv'], [], None, False, 
+        plot_takeoffs, []),
+]
 
-    # After FlySim trajectories have been extracted, we can process perching locations
-    p3 = extract_perching_locations.run(async=False, settings=settings)
+def updateAll(settings):
+    # Create daily files (by default, we now always compute the data over entire days, rather than segments)
+    # Note: Days that are still being recorded aren't merged anyway
+    if not settings.incremental:
+        merge_daily_data.run(settings)
 
-    # extract_perching_orientations.run(async=True)
-    # extract_headmovements.run()
+    # Index the frames that have been added since the last run (this is done here rather than in 
+    # each of the steps, as these run in parallel)
+    for file in settings.files:
+        util.updateMocapIndex(file)
 
-    # Make sure the previous processes have finished before starting the next ones
-    # p3.join()
+    # Run all steps for all files
+    pipeline.runPipeline(PIPELINE_STAGES, settings, numWorkers=NUM_PIPELINE_WORKERS)
 
-    print("Done processing data, now plotting takeoffs.")
+    if settings.incremental:
+        print("Done processing new data.")
+        return
 
-    p5 = plot_takeoffs.run(async=False, settings=settings)
+    # These steps process all data files at once
+    print("Done processing data, now creating highspeed links.")
     create_highspeed_links.run(async=False, settings=settings)
 
-    # Make sure the previous processes have finished before generating the final report
-    # p5.join()
-
-    print("Done plotting takeoffs, now generating reports.")
+    print("Now generating reports.")
 
     # Generate the final report
-    generate_reports.run(settings=settings)
+    generate_reports.run()
 
     # Print done
     print("All data analysis is up to date.")
 
-
-def updateAll(settings):
-    # Create daily files (by default, we now always compute the data over entire days, rather than segments)
-    merge_daily_data.run(settings)
-
-    # Run other scripts (in parallel where possible, hence part 1 (p1) and part 2 (p2)
-    p1 = multiprocessing.Process(target=updateAll_p1, args=(settings,))
-    p1.start()
-
-    p2 = multiprocessing.Process(target=updateAll_p2, args=(settings,))
-    p2.start()
-
-    # Wait for subprocesses to finish
-    p1.join()
-    p2.join()
-
 # =======================================================================================
 # Main entry point: Allows this script to be run directly by user, who will be queried for input
 # =======================================================================================